@@ -0,0 +1,175 @@
+"""
+    Admission control under object storage pressure.
+
+The object storage requests in flight and their recent latency are tracked
+per server process and across the node (in an anonymous shared memory
+segment created before forking, like the connection tracking), so new logins
+and transfers are rejected while the object storage is overloaded instead of
+piling up blocked sessions.
+"""
+
+import os
+import time
+import mmap
+import errno
+import struct
+import logging
+import threading
+import multiprocessing
+
+__all__ = ['AdmissionController']
+
+class AdmissionController(object):
+    """
+    Object storage requests in flight and latency per process and node.
+
+    - max_requests: requests in flight in a process.
+    - max_node_requests: requests in flight in all the processes.
+    - max_latency: average seconds to get a response, in a process or in
+      all the processes that got one recently.
+
+    A limit of 0 disables it. Every process has a slot in shared memory
+    (pid, requests in flight, average latency and time of the last
+    response); the slots of the processes that are gone are reused. The
+    average latency is halved every halflife seconds without responses, so
+    an overloaded node admits work again once it's idle.
+    """
+    SLOT = struct.Struct("<iIdd")
+    # weight of a new latency in the average
+    ALPHA = 0.2
+
+    def __init__(self, max_requests=0, max_node_requests=0, max_latency=0, retry_after=5,
+                 halflife=10, workers=1024):
+        if min(max_requests, max_node_requests, max_latency) < 0 or retry_after < 1 \
+                or halflife <= 0 or workers < 1:
+            raise ValueError("Invalid admission limits")
+        self.max_requests = max_requests
+        self.max_node_requests = max_node_requests
+        self.max_latency = max_latency
+        self.retry_after = retry_after
+        self.halflife = halflife
+        self.workers = workers
+        self.map = mmap.mmap(-1, workers*self.SLOT.size, mmap.MAP_SHARED)
+        # to claim the slots
+        self.lock = multiprocessing.Lock()
+        self.local = threading.Lock()
+        self.pid = None
+
+    def _check_pid(self):
+        """Start from scratch in a new process, must be called holding the local lock"""
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            # offset of the slot of the process (None: not claimed yet, -1: not tracked)
+            self.slot = None
+            self.requests = 0
+            self.latency = 0
+            self.stamp = 0
+            self.rejected = 0
+
+    @staticmethod
+    def _alive(pid):
+        try:
+            os.kill(pid, 0)
+        except OSError, e:
+            return e.errno != errno.ESRCH
+        return True
+
+    def _claim(self):
+        """Returns the offset of a free slot for the process, or -1 if there's none"""
+        with self.lock:
+            free = None
+            for offset in xrange(0, self.workers*self.SLOT.size, self.SLOT.size):
+                pid = self.SLOT.unpack_from(self.map, offset)[0]
+                if pid == self.pid:
+                    # left by a process with the same pid
+                    return offset
+                if free is None and (not pid or not self._alive(pid)):
+                    free = offset
+            if free is None:
+                logging.warning("admission control: no free slot for process %s" % self.pid)
+                return -1
+            self.SLOT.pack_into(self.map, free, self.pid, 0, 0, 0)
+        return free
+
+    def _publish(self):
+        if self.slot is None:
+            self.slot = self._claim()
+        if self.slot >= 0:
+            self.SLOT.pack_into(self.map, self.slot, self.pid, self.requests, self.latency, self.stamp)
+
+    def _decayed(self, latency, stamp, now):
+        if not stamp:
+            return 0
+        return latency * 0.5 ** (max(now - stamp, 0) / self.halflife)
+
+    def start(self):
+        """A request is sent to the object storage"""
+        with self.local:
+            self._check_pid()
+            self.requests += 1
+            self._publish()
+
+    def finish(self, latency=None):
+        """
+        A request started with start is done, latency are the seconds to
+        get the response (None if it doesn't tell the object storage load,
+        like an upload or a failure without response).
+        """
+        with self.local:
+            self._check_pid()
+            self.requests = max(self.requests - 1, 0)
+            if latency is not None:
+                now = time.time()
+                self.latency = self._decayed(self.latency, self.stamp, now) * (1 - self.ALPHA) \
+                    + latency * self.ALPHA
+                self.stamp = now
+            self._publish()
+
+    def node(self):
+        """Returns the requests in flight and the average latency of all the processes"""
+        now = time.time()
+        requests = 0
+        latencies = []
+        for offset in xrange(0, self.workers*self.SLOT.size, self.SLOT.size):
+            pid, count, latency, stamp = self.SLOT.unpack_from(self.map, offset)
+            recent = stamp and now - stamp < self.halflife
+            if not pid or not (count or recent) or not self._alive(pid):
+                continue
+            requests += count
+            if recent:
+                latencies.append(self._decayed(latency, stamp, now))
+        return requests, sum(latencies) / len(latencies) if latencies else 0
+
+    def overloaded(self):
+        """Returns why new work must be rejected, or None if it can be admitted"""
+        with self.local:
+            self._check_pid()
+            requests = self.requests
+            latency = self._decayed(self.latency, self.stamp, time.time())
+        reason = None
+        if self.max_requests and requests >= self.max_requests:
+            reason = "%s requests in flight" % requests
+        elif self.max_latency and latency > self.max_latency:
+            reason = "latency of %.2f seconds" % latency
+        elif self.max_node_requests or self.max_latency:
+            node_requests, node_latency = self.node()
+            if self.max_node_requests and node_requests >= self.max_node_requests:
+                reason = "%s requests in flight in the node" % node_requests
+            elif self.max_latency and node_latency > self.max_latency:
+                reason = "latency of %.2f seconds in the node" % node_latency
+        if reason is not None:
+            with self.local:
+                self.rejected += 1
+        return reason
+
+    def stats(self):
+        """Returns a dict with the admission statistics"""
+        with self.local:
+            self._check_pid()
+            stats = dict(requests=self.requests,
+                         latency=round(self._decayed(self.latency, self.stamp, time.time()), 3),
+                         rejected=self.rejected,
+                         )
+        node_requests, node_latency = self.node()
+        stats.update(node_requests=node_requests, node_latency=round(node_latency, 3))
+        return stats
@@ -0,0 +1,172 @@
+"""
+    Authentication token cache for ObjectStorageFS.
+
+Tokens are cached with their expiry time so they are reused while they're
+valid and refreshed shortly before they expire, and the credentials used to
+get them are cached as salted hashes so a login can be verified without the
+auth service.
+"""
+
+import os
+import hmac
+import time
+import hashlib
+import logging
+import threading
+from urlparse import urlparse, urlunparse
+from swiftclient.client import ClientException, http_connection
+
+from cache import LocalCache
+from utils import smart_str
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+__all__ = ['TokenCache', 'CredentialCache', 'get_auth_1_0']
+
+class TieredCache(object):
+    """
+    Cache of JSON lists with an expiry time as last element.
+
+    The values are kept in process and in the shared cache backend (if any),
+    used as a fallback to get the values stored by other processes.
+
+    A value is not returned if it expires in less than refresh_margin seconds.
+    """
+
+    def __init__(self, refresh_margin=0, max_entries=1000):
+        self.refresh_margin = refresh_margin
+        self.local = LocalCache(max_entries)
+        self.lock = threading.Lock()
+
+    def _decode(self, value):
+        """Returns the cached list, or None if it's expiring"""
+        value = json.loads(value)
+        if value[-1] - self.refresh_margin < time.time():
+            return None
+        return value
+
+    def _get(self, key, backend=None):
+        """Returns the list cached for key, or None"""
+        with self.lock:
+            value = self.local.get(key)
+        cached = value and self._decode(value)
+        if not cached and backend is not None:
+            # another process may have a fresh value
+            value = backend.get(key)
+            cached = value and self._decode(value)
+            if cached:
+                with self.lock:
+                    self.local.set(key, value, int(cached[-1] - time.time()))
+        return cached or None
+
+    def _set(self, key, values, expires, backend=None):
+        """Cache a list of values until expires"""
+        ttl = int(expires - time.time())
+        if ttl <= 0:
+            return
+        value = json.dumps(list(values) + [expires])
+        with self.lock:
+            self.local.set(key, value, ttl)
+        if backend is not None:
+            backend.set(key, value, ttl)
+
+    def invalidate(self, key, backend=None):
+        """Remove the value cached for key"""
+        with self.lock:
+            self.local.delete(key)
+        if backend is not None:
+            backend.delete(key)
+
+    def stats(self):
+        """Returns a dict with the in-process cache statistics"""
+        return self.local.stats()
+
+class TokenCache(TieredCache):
+    """
+    Cache of authentication tokens.
+
+    A token is not returned if it expires in less than refresh_margin seconds,
+    so it's refreshed before the requests using it start failing. The expiry
+    time of a token is default_ttl seconds if the auth service doesn't
+    provide it.
+    """
+
+    def __init__(self, default_ttl=3600, refresh_margin=300, max_entries=1000):
+        super(TokenCache, self).__init__(refresh_margin, max_entries)
+        self.default_ttl = default_ttl
+
+    def get(self, key, backend=None):
+        """Returns the (url, token, expires) cached for key, or None"""
+        cached = self._get(key, backend)
+        return cached and tuple(cached)
+
+    def set(self, key, url, token, expires=None, backend=None):
+        """Cache a token, expires is the expiry time (or None if not known)"""
+        if expires is None:
+            expires = time.time() + self.default_ttl
+        self._set(key, (url, token), expires, backend)
+        return expires
+
+class CredentialCache(TieredCache):
+    """
+    Cache of verified credentials.
+
+    Only a random salt and a PBKDF2 hash of the secret are stored, so the
+    secret can't be recovered from a shared cache without brute-forcing
+    every entry. A secret that doesn't match is not rejected, it must be
+    checked with the auth service (it may have been changed).
+    """
+    ITERATIONS = 10000
+
+    def set(self, key, secret, expires, backend=None):
+        """Cache the secret verified for key until expires"""
+        salt = os.urandom(16)
+        digest = hashlib.pbkdf2_hmac('sha256', smart_str(secret), salt, self.ITERATIONS)
+        self._set(key, (salt.encode("hex"), digest.encode("hex")), expires, backend)
+
+    def verify(self, key, secret, backend=None):
+        """Check if the secret was verified for key"""
+        cached = self._get(key, backend)
+        if not cached:
+            return False
+        salt, digest, _ = cached
+        computed = hashlib.pbkdf2_hmac('sha256', smart_str(secret), str(salt).decode("hex"), self.ITERATIONS)
+        return hmac.compare_digest(computed, str(digest).decode("hex"))
+
+def get_auth_1_0(url, user, key, snet, **kwargs):
+    """
+    Auth 1.0 as swiftclient.client.get_auth_1_0, but returns the token's
+    expiry time too (or None if X-Auth-Token-Expires is not provided).
+    """
+    # only the options that are set, older swiftclient versions don't support all of them
+    options = dict((name, kwargs[name]) for name in ('cacert', 'insecure', 'cert', 'cert_key', 'timeout')
+                   if kwargs.get(name) is not None)
+    parsed, conn = http_connection(url, **options)
+    conn.request('GET', parsed.path, '', {'X-Auth-User': user, 'X-Auth-Key': key})
+    resp = conn.getresponse()
+    body = resp.read()
+    resp.close()
+    conn.close()
+    url = resp.getheader('x-storage-url')
+
+    # see swiftclient, a bad URL could get a document page and a 200
+    if resp.status < 200 or resp.status >= 300 or (body and not url):
+        # ClientException.from_response is swiftclient >= 3.0
+        raise ClientException('Auth GET failed', http_scheme=parsed.scheme, http_host=parsed.netloc,
+                              http_path=parsed.path, http_status=resp.status, http_reason=resp.reason,
+                              http_response_content=body)
+    if snet:
+        parsed = list(urlparse(url))
+        parsed[1] = 'snet-' + parsed[1]
+        url = urlunparse(parsed)
+
+    token = resp.getheader('x-storage-token', resp.getheader('x-auth-token'))
+    expires = None
+    try:
+        expires = time.time() + int(resp.getheader('x-auth-token-expires'))
+    except (TypeError, ValueError):
+        logging.debug("token expiry not provided")
+    return url, token, expires
@@ -0,0 +1,274 @@
+"""
+    Bandwidth of the data transfers shared by the server processes.
+
+The token buckets of the users and IPs live in an anonymous shared memory
+segment created before forking (like the connection tracking), so the limits
+apply to all the transfers of a user or IP whatever process serves them.
+"""
+
+import os
+import time
+import mmap
+import errno
+import struct
+import logging
+import multiprocessing
+from hashlib import md5
+
+from ftpcloudfs.utils import smart_str
+
+__all__ = ['BandwidthScheduler', 'Transfer']
+
+class Transfer(object):
+    """An active transfer of user from ip (see BandwidthScheduler.start)"""
+
+    def __init__(self, user, ip):
+        self.user = user
+        self.ip = ip
+        # offsets of the user and ip slots (None: not tracked)
+        self.user_slot = None
+        self.ip_slot = None
+        # offset of the transfer in the table of transfers (None: not in the table)
+        self.entry = None
+        # bucket of the fair share of the transfer (full)
+        self.tokens = 0
+        self.stamp = -1
+
+class BandwidthScheduler(object):
+    """
+    Token buckets limiting the bytes per second of the transfers.
+
+    - limit: bytes per second of all the transfers, shared between the users
+      transferring by weight (weights maps users to weights, 1 by default)
+      and between the transfers of a user equally.
+    - user_limit and ip_limit: bytes per second of the transfers of a user
+      and of an IP.
+    - burst: seconds of a limit that can be transferred at once after an
+      idle period.
+
+    A limit of 0 disables it. The buckets are hashed to slots like in
+    ConnectionTracker (digest, active transfers, tokens and time of the last
+    update); if all the slots of a bucket are in use the key isn't limited.
+
+    Every transfer has an entry in a table of transfers (pid of the process,
+    slots and weight), so the transfers of the processes that are gone
+    without finishing them are reclaimed every sweep_interval seconds (and
+    when the table is full), like the passive ports.
+    """
+    WAYS = 8
+    SLOT = struct.Struct("<16sIdd")
+    # total weight of the users transferring, users transferring, reclaimed transfers
+    HEADER = struct.Struct("<dII")
+    # pid, user slot, ip slot (0: not tracked), weight
+    ENTRY = struct.Struct("<iIId")
+
+    def __init__(self, limit=0, user_limit=0, ip_limit=0, burst=1, weights=None, buckets=4096, stripes=64,
+                 transfers=4096, sweep_interval=10):
+        if min(limit, user_limit, ip_limit) < 0 or burst <= 0 or buckets < 1 or transfers < 1:
+            raise ValueError("Invalid bandwidth limits")
+        self.limit = limit
+        self.user_limit = user_limit
+        self.ip_limit = ip_limit
+        self.burst = burst
+        self.weights = weights or {}
+        self.buckets = buckets
+        self.transfers = transfers
+        self.sweep_interval = sweep_interval
+        self.table = self.HEADER.size + buckets*self.WAYS*self.SLOT.size
+        self.map = mmap.mmap(-1, self.table + transfers*self.ENTRY.size, mmap.MAP_SHARED)
+        self.lock = multiprocessing.Lock()
+        self.locks = [multiprocessing.Lock() for _ in xrange(min(stripes, buckets))]
+        # to add and remove the entries of the table
+        self.table_lock = multiprocessing.Lock()
+        self.next_sweep = 0
+
+    def weight(self, user):
+        return self.weights.get(user, 1)
+
+    def _bucket(self, key):
+        """Returns the key digest, the lock and the offsets of its bucket slots"""
+        digest = md5(smart_str(key)).digest()
+        bucket = struct.unpack("<Q", digest[:8])[0] % self.buckets
+        start = self.HEADER.size + bucket*self.WAYS*self.SLOT.size
+        return digest, self.locks[bucket % len(self.locks)], \
+            [start + way*self.SLOT.size for way in xrange(self.WAYS)]
+
+    def _slot_lock(self, offset):
+        """Returns the lock of the bucket of the slot at offset"""
+        bucket = (offset - self.HEADER.size) // (self.WAYS*self.SLOT.size)
+        return self.locks[bucket % len(self.locks)]
+
+    def _acquire(self, key):
+        """Add a transfer of key, returns the offset of its slot and its transfers (None if it can't be tracked)"""
+        digest, lock, offsets = self._bucket(key)
+        with lock:
+            free = None
+            for offset in offsets:
+                slot_digest, count, tokens, stamp = self.SLOT.unpack_from(self.map, offset)
+                if slot_digest == digest:
+                    self.SLOT.pack_into(self.map, offset, digest, count + 1, tokens, stamp)
+                    return offset, count + 1
+                if not count and free is None:
+                    free = offset
+            if free is None:
+                logging.warning("bandwidth: no free slot for %s" % key)
+                return None
+            # a new bucket is full (negative time)
+            self.SLOT.pack_into(self.map, free, digest, 1, 0, -1)
+        return free, 1
+
+    def _release(self, offset):
+        """Remove a transfer from the slot at offset, returns the transfers left"""
+        with self._slot_lock(offset):
+            digest, count, tokens, stamp = self.SLOT.unpack_from(self.map, offset)
+            if not count:
+                return 0
+            self.SLOT.pack_into(self.map, offset, digest, count - 1, tokens, stamp)
+        return count - 1
+
+    def _drop(self, user_slot, ip_slot, weight):
+        """Remove a transfer from its slots (None: not tracked)"""
+        if user_slot is not None and self._release(user_slot) == 0:
+            # the user isn't transferring anymore
+            with self.lock:
+                total_weight, users, reclaimed = self.HEADER.unpack_from(self.map, 0)
+                self.HEADER.pack_into(self.map, 0, max(total_weight - weight, 0), max(users - 1, 0),
+                                      reclaimed)
+        if ip_slot is not None:
+            self._release(ip_slot)
+
+    @staticmethod
+    def _alive(pid):
+        try:
+            os.kill(pid, 0)
+        except OSError, e:
+            return e.errno != errno.ESRCH
+        return True
+
+    def _add_entry(self, transfer, weight):
+        """Add transfer to the table, must be called holding the table lock"""
+        for index in xrange(self.transfers):
+            offset = self.table + index*self.ENTRY.size
+            if not self.ENTRY.unpack_from(self.map, offset)[0]:
+                self.ENTRY.pack_into(self.map, offset, os.getpid(), transfer.user_slot or 0,
+                                     transfer.ip_slot or 0, weight)
+                transfer.entry = offset
+                return True
+        return False
+
+    def sweep(self):
+        """Reclaim the transfers of the processes that are gone, returns how many were reclaimed"""
+        dead = []
+        alive = {}
+        with self.table_lock:
+            for index in xrange(self.transfers):
+                offset = self.table + index*self.ENTRY.size
+                entry = self.ENTRY.unpack_from(self.map, offset)
+                pid = entry[0]
+                if not pid:
+                    continue
+                if pid not in alive:
+                    alive[pid] = self._alive(pid)
+                if not alive[pid]:
+                    self.ENTRY.pack_into(self.map, offset, 0, 0, 0, 0)
+                    dead.append(entry)
+        for pid, user_slot, ip_slot, weight in dead:
+            self._drop(user_slot or None, ip_slot or None, weight)
+        if dead:
+            with self.lock:
+                total_weight, users, reclaimed = self.HEADER.unpack_from(self.map, 0)
+                self.HEADER.pack_into(self.map, 0, total_weight, users, reclaimed + len(dead))
+            logging.debug("bandwidth: reclaimed %s transfers" % len(dead))
+        return len(dead)
+
+    def _take(self, tokens, stamp, rate, nbytes, now):
+        """Take nbytes from a bucket, returns the tokens left and the seconds to wait"""
+        burst = rate * self.burst
+        if stamp < 0:
+            tokens = burst
+        else:
+            tokens = min(burst, tokens + (now - stamp) * rate)
+        tokens -= nbytes
+        return tokens, -tokens / rate if tokens < 0 else 0
+
+    def _consume(self, key, offset, rate, nbytes, now):
+        """Take nbytes from the bucket of key, returns the seconds to wait and the transfers of key"""
+        digest, lock, _ = self._bucket(key)
+        with lock:
+            slot_digest, count, tokens, stamp = self.SLOT.unpack_from(self.map, offset)
+            if slot_digest != digest:
+                return 0, 1
+            delay = 0
+            if rate:
+                tokens, delay = self._take(tokens, stamp, rate, nbytes, now)
+                self.SLOT.pack_into(self.map, offset, digest, count, tokens, now)
+        return delay, max(count, 1)
+
+    def start(self, user, ip):
+        """Returns the Transfer of a new transfer of user from ip"""
+        now = time.time()
+        if now >= self.next_sweep:
+            self.next_sweep = now + self.sweep_interval
+            self.sweep()
+        transfer = Transfer(user, ip)
+        weight = self.weight(user)
+        acquired = self._acquire("u:%s" % user)
+        if acquired is not None:
+            transfer.user_slot, count = acquired
+            if count == 1:
+                with self.lock:
+                    total_weight, users, reclaimed = self.HEADER.unpack_from(self.map, 0)
+                    self.HEADER.pack_into(self.map, 0, total_weight + weight, users + 1, reclaimed)
+        if self.ip_limit:
+            acquired = self._acquire("i:%s" % ip)
+            if acquired is not None:
+                transfer.ip_slot = acquired[0]
+        if transfer.user_slot is None and transfer.ip_slot is None:
+            return transfer
+        with self.table_lock:
+            added = self._add_entry(transfer, weight)
+        if not added and self.sweep():
+            with self.table_lock:
+                added = self._add_entry(transfer, weight)
+        if not added:
+            # it can't be reclaimed if the process is gone, it's not tracked
+            logging.warning("bandwidth: the table of transfers is full")
+            self._drop(transfer.user_slot, transfer.ip_slot, weight)
+            transfer.user_slot = transfer.ip_slot = None
+        return transfer
+
+    def finish(self, transfer):
+        """The transfer is done"""
+        if transfer.entry is not None:
+            with self.table_lock:
+                self.ENTRY.pack_into(self.map, transfer.entry, 0, 0, 0, 0)
+            transfer.entry = None
+        self._drop(transfer.user_slot, transfer.ip_slot, self.weight(transfer.user))
+        transfer.user_slot = None
+        transfer.ip_slot = None
+
+    def charge(self, transfer, nbytes, now=None):
+        """Account nbytes transferred, returns the seconds the transfer must wait to stay within the limits"""
+        if now is None:
+            now = time.time()
+        delay, transfers = 0, 1
+        if transfer.user_slot is not None:
+            delay, transfers = self._consume("u:%s" % transfer.user, transfer.user_slot,
+                                             self.user_limit, nbytes, now)
+        if transfer.ip_slot is not None:
+            delay = max(delay, self._consume("i:%s" % transfer.ip, transfer.ip_slot,
+                                             self.ip_limit, nbytes, now)[0])
+        if self.limit:
+            weight = self.weight(transfer.user)
+            with self.lock:
+                total_weight = self.HEADER.unpack_from(self.map, 0)[0]
+            share = self.limit * weight / max(total_weight, weight) / transfers
+            transfer.tokens, fair_delay = self._take(transfer.tokens, transfer.stamp, share, nbytes, now)
+            transfer.stamp = now
+            delay = max(delay, fair_delay)
+        return delay
+
+    def stats(self):
+        """Returns a dict with the users transferring, their weight and the reclaimed transfers"""
+        weight, users, reclaimed = self.HEADER.unpack_from(self.map, 0)
+        return dict(users=users, weight=weight, reclaimed=reclaimed)
@@ -0,0 +1,105 @@
+"""
+    Circuit breaker for the object storage requests.
+
+When the object storage keeps failing, the requests fail fast instead of
+waiting for timeouts and retrying, so the server doesn't pile up sessions
+and the object storage can recover.
+"""
+
+import time
+import logging
+import threading
+from swiftclient.client import ClientException
+
+__all__ = ['CircuitBreaker', 'CircuitOpen']
+
+class CircuitOpen(ClientException):
+    """The request wasn't sent because the circuit is open"""
+
+    def __init__(self, retry_after):
+        super(CircuitOpen, self).__init__("Object storage unavailable", http_status=503,
+                                          http_reason="Circuit open")
+        self.retry_after = retry_after
+
+class CircuitBreaker(object):
+    """
+    Per process circuit breaker.
+
+    The circuit opens after max_failures failed requests in a row (no
+    response, or 5xx replies). While it's open the requests fail with
+    CircuitOpen, and after reset_timeout seconds a single request is
+    allowed to test the object storage (half open): the circuit closes if
+    it succeeds and opens again otherwise. If the result of the test isn't
+    recorded within reset_timeout seconds, another request is allowed.
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+    def __init__(self, max_failures=10, reset_timeout=30):
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.half_opened_at = 0
+        self.opened = 0
+        self.rejected = 0
+
+    def retry_after(self):
+        """Returns the seconds until a request will be allowed (0 if the circuit is closed)"""
+        if self.state == self.CLOSED:
+            return 0
+        since = self.half_opened_at if self.state == self.HALF_OPEN else self.opened_at
+        return max(0, int(since + self.reset_timeout - time.time() + 0.5))
+
+    def is_open(self):
+        """Check if the requests are failing fast"""
+        with self.lock:
+            if self.state == self.OPEN:
+                return self.opened_at + self.reset_timeout > time.time()
+            if self.state == self.HALF_OPEN:
+                return self.half_opened_at + self.reset_timeout > time.time()
+            return False
+
+    def check(self):
+        """Call before a request, raises CircuitOpen if it's not allowed"""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return
+            now = time.time()
+            if self.state == self.OPEN and self.opened_at + self.reset_timeout <= now:
+                logging.info("circuit half open, testing the object storage")
+                self.state = self.HALF_OPEN
+                self.half_opened_at = now
+                return
+            if self.state == self.HALF_OPEN and self.half_opened_at + self.reset_timeout <= now:
+                # the result of the test wasn't recorded
+                logging.info("circuit half open, testing the object storage again")
+                self.half_opened_at = now
+                return
+            self.rejected += 1
+        raise CircuitOpen(self.retry_after())
+
+    def record(self, ok):
+        """Record the result of a request"""
+        with self.lock:
+            if ok:
+                if self.state != self.CLOSED:
+                    logging.info("circuit closed")
+                self.state = self.CLOSED
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.max_failures):
+                logging.warning("circuit open for %s seconds after %s failures" % (self.reset_timeout, self.failures))
+                self.state = self.OPEN
+                self.opened_at = time.time()
+                self.opened += 1
+
+    def stats(self):
+        """Returns a dict with the breaker statistics"""
+        return dict(state=self.state,
+                    failures=self.failures,
+                    opened=self.opened,
+                    rejected=self.rejected,
+                    )
@@ -0,0 +1,409 @@
+"""
+    Cache backends for ObjectStorageFS.
+
+The directory listings and the authentication tokens are cached using one
+of these backends. All of them store string values with a time to live and
+keep their own hit/miss statistics.
+"""
+
+import os
+import stat
+import time
+import zlib
+import mmap
+import fcntl
+import struct
+import logging
+import threading
+import multiprocessing
+from hashlib import md5
+from collections import OrderedDict
+
+__all__ = ['LocalCache', 'MemcacheCache', 'MmapCache', 'SharedMemoryCache', 'create_cache']
+
+class CacheBackend(object):
+    """
+    Base class for the cache backends.
+
+    Subclasses implement _get, _set and _delete.
+    """
+    name = None
+    # the cache is shared with other sessions
+    shared = False
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.failed_sets = 0
+
+    def get(self, key):
+        """Returns the value stored for key or None"""
+        value = self._get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, ttl):
+        """Store value for key during ttl seconds, returns False on failure"""
+        if self._set(key, value, ttl):
+            self.sets += 1
+            return True
+        self.failed_sets += 1
+        return False
+
+    def delete(self, key):
+        """Remove key from the cache"""
+        self._delete(key)
+
+    def stats(self):
+        """Returns a dict with the cache statistics"""
+        lookups = self.hits + self.misses
+        return dict(backend=self.name,
+                    hits=self.hits,
+                    misses=self.misses,
+                    sets=self.sets,
+                    failed_sets=self.failed_sets,
+                    hit_ratio=float(self.hits) / lookups if lookups else 0.0,
+                    )
+
+class LocalCache(CacheBackend):
+    """In-process LRU cache, shared by the threads of the process."""
+    name = 'local'
+
+    def __init__(self, max_entries=1000):
+        super(LocalCache, self).__init__()
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def _get(self, key):
+        with self.lock:
+            try:
+                expires, value = self.entries.pop(key)
+            except KeyError:
+                return None
+            if expires < time.time():
+                return None
+            # most recently used go last
+            self.entries[key] = (expires, value)
+        return value
+
+    def _set(self, key, value, ttl):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + ttl, value)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return True
+
+    def _delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def stats(self):
+        stats = super(LocalCache, self).stats()
+        stats.update(entries=len(self.entries), evictions=self.evictions)
+        return stats
+
+class MemcacheCache(CacheBackend):
+    """Memcache cache, shared by all the servers using the same memcache servers."""
+    name = 'memcache'
+    shared = True
+    MIN_COMPRESS_LEN = 4096     # min length in bytes to compress cache entries
+
+    def __init__(self, hosts):
+        super(MemcacheCache, self).__init__()
+        import memcache
+        logging.debug("connecting to memcache %r" % hosts)
+        self.client = memcache.Client(hosts)
+
+    def _get(self, key):
+        return self.client.get(key)
+
+    def _set(self, key, value, ttl):
+        return self.client.set(key, value, ttl, min_compress_len=self.MIN_COMPRESS_LEN)
+
+    def _delete(self, key):
+        self.client.delete(key)
+
+class MmapCache(CacheBackend):
+    """
+    Cache in a memory mapped file, shared by the processes of a single host.
+
+    The file is split in fixed size slots, and the slot of a key is chosen by
+    its hash (a new key evicts whatever was stored in its slot). Values are
+    compressed, values that don't fit in a slot are not cached. Every slot is
+    protected by a byte-range lock on the file (and the threads of a process
+    by a lock, byte-range locks are per process).
+
+    The cache holds auth tokens, so it's not used if the file isn't a regular
+    file owned by the user running the server and private to it.
+    """
+    name = 'mmap'
+    shared = True
+    # slot header: key digest, expiry time, value length
+    HEADER = struct.Struct("<16sdI")
+
+    def __init__(self, path, size=64*1024**2, slot_size=128*1024):
+        super(MmapCache, self).__init__()
+        if slot_size <= self.HEADER.size or size < slot_size:
+            raise ValueError("Invalid cache size")
+        self.path = path
+        self.slot_size = slot_size
+        self.slots = size // slot_size
+        self.size = self.slots * slot_size
+        self.too_large = 0
+        self.thread_lock = threading.Lock()
+        self.pid = None
+        self.fd = None
+        self.map = None
+        # the file can't be used safely
+        self.unsafe = False
+
+    def _open(self):
+        """Open the file, once per process, returns False if the cache can't be used"""
+        if self.pid == os.getpid():
+            return not self.unsafe
+        with self.thread_lock:
+            if self.pid == os.getpid():
+                return not self.unsafe
+            logging.debug("opening mmap cache %r (%s slots)" % (self.path, self.slots))
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT | getattr(os, "O_NOFOLLOW", 0), 0600)
+            st = os.fstat(fd)
+            if not stat.S_ISREG(st.st_mode) or st.st_uid != os.geteuid() or st.st_mode & 0077:
+                os.close(fd)
+                logging.error("mmap cache %r disabled: it must be a regular file owned by uid %s "
+                              "and not accessible by group or others" % (self.path, os.geteuid()))
+                self.unsafe = True
+                self.pid = os.getpid()
+                return False
+            if st.st_size < self.size:
+                os.ftruncate(fd, self.size)
+            self.fd = fd
+            self.map = mmap.mmap(self.fd, self.size, mmap.MAP_SHARED)
+            self.unsafe = False
+            self.pid = os.getpid()
+        return True
+
+    def _slot(self, key):
+        """Returns the (digest, offset) of the key's slot"""
+        digest = md5(key).digest()
+        return digest, (struct.unpack("<Q", digest[:8])[0] % self.slots) * self.slot_size
+
+    def _lock(self, offset, exclusive):
+        self.thread_lock.acquire()
+        fcntl.lockf(self.fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH, self.slot_size, offset, os.SEEK_SET)
+
+    def _unlock(self, offset):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN, self.slot_size, offset, os.SEEK_SET)
+        self.thread_lock.release()
+
+    def _get(self, key):
+        if not self._open():
+            return None
+        digest, offset = self._slot(key)
+        self._lock(offset, False)
+        try:
+            slot_digest, expires, length = self.HEADER.unpack_from(self.map, offset)
+            if slot_digest != digest or expires < time.time() or length > self.slot_size - self.HEADER.size:
+                return None
+            start = offset + self.HEADER.size
+            data = self.map[start:start+length]
+        finally:
+            self._unlock(offset)
+        try:
+            return zlib.decompress(data)
+        except zlib.error:
+            logging.debug("corrupt value in the mmap cache")
+            return None
+
+    def _set(self, key, value, ttl):
+        data = zlib.compress(value)
+        if len(data) > self.slot_size - self.HEADER.size:
+            logging.debug("value too large for the mmap cache (%s bytes)" % len(data))
+            self.too_large += 1
+            return False
+        if not self._open():
+            return False
+        digest, offset = self._slot(key)
+        self._lock(offset, True)
+        try:
+            self.HEADER.pack_into(self.map, offset, digest, time.time() + ttl, len(data))
+            start = offset + self.HEADER.size
+            self.map[start:start+len(data)] = data
+        finally:
+            self._unlock(offset)
+        return True
+
+    def _delete(self, key):
+        if not self._open():
+            return
+        digest, offset = self._slot(key)
+        self._lock(offset, True)
+        try:
+            slot_digest, _, _ = self.HEADER.unpack_from(self.map, offset)
+            if slot_digest == digest:
+                self.HEADER.pack_into(self.map, offset, digest, 0, 0)
+        finally:
+            self._unlock(offset)
+
+    def stats(self):
+        stats = super(MmapCache, self).stats()
+        stats.update(slots=self.slots, too_large=self.too_large)
+        return stats
+
+class SharedMemoryCache(CacheBackend):
+    """
+    Cache in an anonymous shared memory segment.
+
+    The segment must be created before forking the server processes, then
+    all of them can use it without any IPC.
+
+    The keys are hashed to buckets of WAYS slots, a new key replaces an
+    expired slot in its bucket or the oldest one. Writers lock a stripe of
+    buckets with a semaphore, readers don't lock: every slot has a sequence
+    number that is odd while the slot is being written and a checksum, and
+    the read is retried if the slot changed while it was being read.
+    """
+    name = 'shm'
+    shared = True
+    WAYS = 4
+    READ_RETRIES = 3
+    # slot header: sequence, key digest, time stored, expiry time, value length, value crc
+    HEADER = struct.Struct("<I16sddII")
+    SEQ = struct.Struct("<I")
+
+    def __init__(self, size=64*1024**2, slot_size=128*1024, stripes=64):
+        super(SharedMemoryCache, self).__init__()
+        if slot_size <= self.HEADER.size or size < slot_size*self.WAYS:
+            raise ValueError("Invalid cache size")
+        self.slot_size = slot_size
+        self.buckets = size // (slot_size*self.WAYS)
+        self.map = mmap.mmap(-1, self.buckets*self.WAYS*slot_size, mmap.MAP_SHARED)
+        self.locks = [multiprocessing.Lock() for _ in xrange(min(stripes, self.buckets))]
+        self.too_large = 0
+        self.evictions = 0
+        self.torn_reads = 0
+        logging.debug("shared memory cache: %s buckets of %s slots" % (self.buckets, self.WAYS))
+
+    def _bucket(self, key):
+        """Returns the key digest and the offsets of its bucket slots"""
+        digest = md5(key).digest()
+        bucket = struct.unpack("<Q", digest[:8])[0] % self.buckets
+        start = bucket*self.WAYS*self.slot_size
+        return digest, bucket, [start + way*self.slot_size for way in xrange(self.WAYS)]
+
+    def _lock(self, bucket):
+        return self.locks[bucket % len(self.locks)]
+
+    def _read(self, offset, digest):
+        """Read the value of the slot if it is stored for digest and not expired"""
+        max_length = self.slot_size - self.HEADER.size
+        for _ in xrange(self.READ_RETRIES):
+            seq, slot_digest, _, expires, length, crc = self.HEADER.unpack_from(self.map, offset)
+            if seq & 1:
+                # being written
+                continue
+            if slot_digest != digest:
+                return None
+            start = offset + self.HEADER.size
+            data = self.map[start:start+min(length, max_length)]
+            if self.SEQ.unpack_from(self.map, offset)[0] != seq:
+                continue
+            if expires < time.time() or length > max_length or zlib.crc32(data) & 0xffffffff != crc:
+                return None
+            return data
+        self.torn_reads += 1
+        return None
+
+    def _write(self, offset, digest, expires, data):
+        """Write the slot, must be called holding the bucket lock"""
+        seq = self.SEQ.unpack_from(self.map, offset)[0]
+        self.HEADER.pack_into(self.map, offset, (seq + 1) & 0xffffffff, digest, time.time(), expires,
+                              len(data), zlib.crc32(data) & 0xffffffff)
+        start = offset + self.HEADER.size
+        self.map[start:start+len(data)] = data
+        self.SEQ.pack_into(self.map, offset, (seq + 2) & 0xffffffff)
+
+    def _get(self, key):
+        digest, _, offsets = self._bucket(key)
+        for offset in offsets:
+            data = self._read(offset, digest)
+            if data is not None:
+                try:
+                    return zlib.decompress(data)
+                except zlib.error:
+                    logging.debug("corrupt value in the shared memory cache")
+                    return None
+        return None
+
+    def _set(self, key, value, ttl):
+        data = zlib.compress(value)
+        if len(data) > self.slot_size - self.HEADER.size:
+            logging.debug("value too large for the shared memory cache (%s bytes)" % len(data))
+            self.too_large += 1
+            return False
+        digest, bucket, offsets = self._bucket(key)
+        now = time.time()
+        with self._lock(bucket):
+            victim = None
+            for offset in offsets:
+                _, slot_digest, stored, expires, _, _ = self.HEADER.unpack_from(self.map, offset)
+                if slot_digest == digest or expires < now:
+                    victim = offset
+                    break
+                if victim is None or stored < victim_stored:
+                    victim, victim_stored = offset, stored
+            else:
+                self.evictions += 1
+            self._write(victim, digest, now + ttl, data)
+        return True
+
+    def _delete(self, key):
+        digest, bucket, offsets = self._bucket(key)
+        with self._lock(bucket):
+            for offset in offsets:
+                if self.HEADER.unpack_from(self.map, offset)[1] == digest:
+                    self._write(offset, digest, 0, "")
+
+    def stats(self):
+        stats = super(SharedMemoryCache, self).stats()
+        stats.update(slots=self.buckets*self.WAYS, too_large=self.too_large,
+                     evictions=self.evictions, torn_reads=self.torn_reads)
+        return stats
+
+def create_cache(backend, memcache_hosts=None, entries=1000, path=None, size=64*1024**2):
+    """
+    Create a cache backend.
+
+    backend - 'local', 'memcache', 'mmap', 'shm' or None (no cache)
+    memcache_hosts - list of memcache servers (memcache backend)
+    entries - max number of entries (local backend)
+    path - file to map (mmap backend)
+    size - size in bytes of the file (mmap backend) or the segment (shm backend)
+
+    The shm backend is only shared with the processes forked after it is
+    created.
+
+    Raises ValueError if the backend is not supported.
+    """
+    if backend is None or backend == 'none':
+        return None
+    if backend == 'local':
+        return LocalCache(entries)
+    if backend == 'memcache':
+        if not memcache_hosts:
+            raise ValueError("memcache cache requires memcache servers")
+        return MemcacheCache(memcache_hosts)
+    if backend == 'mmap':
+        if not path:
+            raise ValueError("mmap cache requires a file")
+        return MmapCache(path, size)
+    if backend == 'shm':
+        return SharedMemoryCache(size)
+    raise ValueError("Unsupported cache backend: %s" % backend)
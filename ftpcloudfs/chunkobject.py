@@ -1,13 +1,26 @@
 
+import sys
+import errno
+import socket
 import logging
+from collections import deque
 from urllib import quote
 from httplib import HTTPException
-from socket import timeout
+from socket import timeout, error
 from ssl import SSLError
-from swiftclient.client import ClientException, http_connection
+from requests.packages.urllib3.exceptions import HTTPError as URLLib3Error
+from swiftclient.client import ClientException
 
 from ftpcloudfs.utils import smart_str
 
+_RETRY = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+# send more data in the same TCP segments (Linux, not in the socket module of python 2)
+MSG_MORE = getattr(socket, "MSG_MORE", 0x8000 if sys.platform.startswith("linux") else 0)
+# chunks smaller than this are framed in one string, bigger ones are sent without copying them
+SMALL_CHUNK = 4096
+# errors connecting to and talking with the object storage (urllib3 connects the raw connection)
+CONNECTION_ERRORS = (timeout, error, SSLError, HTTPException, URLLib3Error)
+
 class ChunkObject(object):
 
     def __init__(self, conn, container, name, content_type=None, reuse_token = True):
@@ -18,7 +31,20 @@ class ChunkObject(object):
             token = conn.token
         else:
             self.url, token = conn.get_auth()
-        self.parsed, self.conn = http_connection(self.url)
+        self.swift_conn = conn
+        if conn.breaker is not None:
+            conn.breaker.check()
+        # the endpoint is acquired while the PUT is in progress
+        self.endpoints = conn.endpoints
+        self.endpoint = None
+        # in flight in the admission control from the request until it's reported
+        self.admitted = False
+        self.reported = False
+        if self.endpoints is not None:
+            self.endpoint = self.endpoints.acquire()
+            self.url = self.endpoint.route(self.url)
+        self.parsed, self.conn = conn.http_connection(self.url)
+        self.http_pool = None
 
         self.path = '%s/%s/%s' % (self.parsed.path.rstrip('/'),
                                   quote(smart_str(container)),
@@ -27,7 +53,6 @@ class ChunkObject(object):
         self.headers = { 'X-Auth-Token': token,
                          'Content-Type': content_type or 'application/octet-stream',
                          'Transfer-Encoding': 'chunked',
-                         'Connection': 'close',
                          # User-Agent ?
                          }
         if conn.real_ip:
@@ -38,55 +63,241 @@ class ChunkObject(object):
 
         self.already_sent = 0
 
+        # evented sends (see attach)
+        self.ioloop = None
+        self.on_drain = None
+        self.pending = deque()
+        self.pending_bytes = 0
+        self.events = None
+        self.error = None
+        # the put timeout while there's data pending (the socket isn't blocking)
+        self.deadline = None
+
+    def attach(self, ioloop, on_drain):
+        """
+        Send the chunks from ioloop without blocking (plain HTTP only).
+
+        The chunks are buffered until the socket is ready, and on_drain is
+        called when some data is sent (see backlog).
+        """
+        if self.parsed.scheme != "http" or self.raw_conn is not None:
+            return
+        self.ioloop = ioloop
+        self.on_drain = on_drain
+
+    def backlog(self):
+        """Returns the bytes waiting to be sent"""
+        return self.pending_bytes
+
     def _open_connection(self):
         logging.debug("ChunkObject: new connection open (%r, %r)" % (self.parsed, self.conn))
 
         # we can't use the generator interface offered by requests to do a
         # chunked transfer encoded PUT, so we do this is to get control over the
         # "real" http connection and do the HTTP request ourselves
-        self.raw_conn = self.conn.request_session.get_adapter(self.url).get_connection(self.url)._get_conn()
+        self.http_pool = self.conn.request_session.get_adapter(self.url).get_connection(self.url)
+        self.raw_conn = self.http_pool._get_conn()
+        # max time between writes (and to get the response)
+        put_timeout = self.swift_conn.timeouts.get("put")
+        self.raw_conn.timeout = put_timeout
+        if self.raw_conn.sock is not None:
+            self.raw_conn.sock.settimeout(put_timeout)
 
+        if self.swift_conn.admission is not None:
+            self.swift_conn.admission.start()
+            self.admitted = True
         self.raw_conn.putrequest('PUT', self.path, skip_accept_encoding=True)
         for key, value in self.headers.iteritems():
             self.raw_conn.putheader(key, value)
         self.raw_conn.endheaders()
 
+        if self.ioloop is not None:
+            self.raw_conn.sock.setblocking(0)
+            self.events = 0
+            self.ioloop.register(self.raw_conn.sock.fileno(), self, 0)
+
+    def _flush(self):
+        """Send the pending data until the socket would block"""
+        sock = self.raw_conn.sock
+        progress = False
+        while self.pending:
+            try:
+                sent = sock.send(self.pending[0], MSG_MORE if len(self.pending) > 1 else 0)
+            except error, err:
+                if err.args[0] in _RETRY:
+                    break
+                self._stop("%s" % err)
+                raise ClientException(self.error)
+            progress = True
+            self.pending_bytes -= sent
+            if sent < len(self.pending[0]):
+                self.pending[0] = memoryview(self.pending[0])[sent:]
+                break
+            self.pending.popleft()
+        events = self.ioloop.WRITE if self.pending else 0
+        if events != self.events:
+            self.events = events
+            self.ioloop.modify(sock.fileno(), events)
+        put_timeout = self.swift_conn.timeouts.get("put")
+        if not self.pending or not put_timeout:
+            self._cancel_deadline()
+        elif self.deadline is None:
+            self.deadline = self.ioloop.call_later(put_timeout, self._timed_out, _errback=self.handle_error)
+        elif progress:
+            self.deadline.reset()
+
+    def _cancel_deadline(self):
+        if self.deadline is not None:
+            self.deadline.cancel()
+            self.deadline = None
+
+    def _timed_out(self):
+        """The object storage didn't take the pending data in time"""
+        self.deadline = None
+        logging.error("ChunkObject: timed out sending from the IOLoop")
+        self._stop("timed out")
+        self.on_drain()
+
+    def _stop(self, error):
+        """Stop sending from the IOLoop after error, the PUT failed"""
+        self.error = error
+        self.pending.clear()
+        self.pending_bytes = 0
+        self._detach()
+        self._report(False)
+
+    def _detach(self):
+        """Stop sending from the IOLoop, the socket is blocking again"""
+        self._cancel_deadline()
+        if self.events is None:
+            return
+        try:
+            self.ioloop.unregister(self.raw_conn.sock.fileno())
+        except (KeyError, EnvironmentError):
+            pass
+        self.events = None
+        self.raw_conn.sock.settimeout(self.swift_conn.timeouts.get("put"))
+
+    # IOLoop events
+
+    def readable(self):
+        return False
+
+    def writable(self):
+        return True
+
+    def handle_read_event(self):
+        pass
+
+    def handle_write_event(self):
+        try:
+            self._flush()
+        except ClientException:
+            # the next write of the data channel gets the error
+            pass
+        self.on_drain()
+
+    def handle_close(self):
+        self.handle_write_event()
+
+    def handle_error(self):
+        logging.exception("ChunkObject: error sending from the IOLoop")
+        self._stop("Internal error")
+        self.on_drain()
+
+    @staticmethod
+    def _frame(chunk):
+        """Returns the strings to send chunk with the chunked transfer encoding"""
+        if len(chunk) < SMALL_CHUNK:
+            if not isinstance(chunk, str):
+                chunk = chunk.tobytes()
+            return ("%X\r\n%s\r\n" % (len(chunk), chunk),)
+        return ("%X\r\n" % len(chunk), chunk, "\r\n")
+
+    def _connect(self):
+        """Open the connection if it's not open yet"""
+        if self.raw_conn is None and self.error is None:
+            try:
+                self._open_connection()
+            except CONNECTION_ERRORS, err:
+                self._fail(err)
+
+    def _fail(self, err):
+        """The PUT failed, report it and raise ClientException"""
+        self.error = "%s" % err
+        self._detach()
+        if self.raw_conn is not None:
+            self.raw_conn.close()
+        self._report(False)
+        raise ClientException(self.error)
+
     def send_chunk(self, chunk):
-        if self.raw_conn is None:
-            self._open_connection()
+        """
+        Send chunk, that can be a string or a memoryview.
+
+        The chunk is not copied, unless it's kept to be sent later from the
+        IOLoop (the memoryview may be of a buffer reused by the caller).
+        """
+        self._connect()
+        if self.error is not None:
+            raise ClientException(self.error)
 
         logging.debug("ChunkObject: sending %s bytes" % len(chunk))
-        try:
-            self.raw_conn.send("%X\r\n" % len(chunk))
-            self.raw_conn.send(chunk)
-            self.raw_conn.send("\r\n")
-        except (timeout, SSLError, HTTPException), err:
-            raise ClientException(err.message)
-        else:
+        frame = self._frame(chunk)
+        if self.ioloop is not None:
+            self.pending.extend(frame)
+            self.pending_bytes += sum(len(data) for data in frame)
             self.already_sent += len(chunk)
-            logging.debug("ChunkObject: already sent %s bytes" % self.already_sent)
+            self._flush()
+            for index, data in enumerate(self.pending):
+                if isinstance(data, memoryview):
+                    self.pending[index] = data.tobytes()
+            return
+        try:
+            if self.parsed.scheme == "http":
+                # the framing and the data go in the same TCP segments
+                sock = self.raw_conn.sock
+                for index, data in enumerate(frame):
+                    sock.sendall(data, MSG_MORE if index < len(frame) - 1 else 0)
+            else:
+                for data in frame:
+                    self.raw_conn.send(data)
+        except CONNECTION_ERRORS, err:
+            self._fail(err)
+        self.already_sent += len(chunk)
+        logging.debug("ChunkObject: already sent %s bytes" % self.already_sent)
 
     def finish_chunk(self):
-        if self.raw_conn is None:
-            self._open_connection()
+        self._connect()
 
         logging.debug("ChunkObject: finish_chunk")
+        if self.ioloop is not None:
+            # the data channel is done, send the rest blocking
+            self._detach()
+        if self.error is not None:
+            if self.raw_conn is not None:
+                self.raw_conn.close()
+            raise ClientException(self.error)
         try:
+            if self.pending:
+                self.raw_conn.send("".join(self.pending))
+                self.pending.clear()
+                self.pending_bytes = 0
             self.raw_conn.send("0\r\n\r\n")
             response = self.raw_conn.getresponse()
-        except (timeout, SSLError, HTTPException), err:
-            self.raw_conn.close()
-            raise ClientException(err.message)
+        except CONNECTION_ERRORS, err:
+            self._fail(err)
 
         try:
             response.read()
         except (timeout, SSLError):
             # this is not relevant, keep going
-            pass
-
-        # we always close the connection
-        self.raw_conn.close()
-        self.conn.request_session.close()
+            self.raw_conn.close()
+        else:
+            # the connection can be reused (it reopens itself if the server closed it)
+            self.http_pool._put_conn(self.raw_conn)
+        self.swift_conn.release_http_connection((self.parsed, self.conn), self.url)
+        self._report(response.status < 500)
 
         if response.status // 100 != 2:
             raise ClientException(response.reason,
@@ -94,3 +305,29 @@ class ChunkObject(object):
                                   http_reason=response.reason,
                                   )
 
+    def close(self):
+        """Abandon the PUT if it's not finished (the connection can't be reused)"""
+        if self.reported:
+            return
+        self._detach()
+        if self.raw_conn is not None:
+            self.raw_conn.close()
+        self._report(None)
+
+    def _report(self, ok):
+        """
+        Report the result of the PUT to the endpoint pool (the latency depends
+        on the upload), the circuit breaker and the admission control, once
+        (ok is None if it was abandoned).
+        """
+        if self.reported:
+            return
+        self.reported = True
+        if self.endpoint is not None:
+            self.endpoints.release(self.endpoint, ok)
+        if self.swift_conn.breaker is not None and ok is not None:
+            self.swift_conn.breaker.record(ok)
+        if self.admitted:
+            self.admitted = False
+            # the time depends on the upload
+            self.swift_conn.admission.finish()
@@ -0,0 +1,80 @@
+"""
+    Connections per IP shared by the server processes.
+
+The counters live in an anonymous shared memory segment created before
+forking, so tracking a connection is a few memory operations instead of a
+round trip to a manager process.
+"""
+
+import mmap
+import struct
+import logging
+import multiprocessing
+from hashlib import md5
+
+__all__ = ['ConnectionTracker']
+
+class ConnectionTracker(object):
+    """
+    Per IP connection counters in shared memory.
+
+    The IPs are hashed to buckets of WAYS slots (IP digest and count, a
+    count of 0 means the slot is free). Updates lock a stripe of buckets
+    with a semaphore, reads don't lock. If all the slots of a bucket are in
+    use the IP isn't tracked (the connection is allowed).
+    """
+    WAYS = 8
+    SLOT = struct.Struct("<16sI")
+
+    def __init__(self, buckets=4096, stripes=64):
+        if buckets < 1:
+            raise ValueError("Invalid number of buckets")
+        self.buckets = buckets
+        self.map = mmap.mmap(-1, buckets*self.WAYS*self.SLOT.size, mmap.MAP_SHARED)
+        self.locks = [multiprocessing.Lock() for _ in xrange(min(stripes, buckets))]
+
+    def _bucket(self, ip):
+        """Returns the ip digest, the lock and the offsets of its bucket slots"""
+        digest = md5(ip).digest()
+        bucket = struct.unpack("<Q", digest[:8])[0] % self.buckets
+        start = bucket*self.WAYS*self.SLOT.size
+        return digest, self.locks[bucket % len(self.locks)], \
+            [start + way*self.SLOT.size for way in xrange(self.WAYS)]
+
+    def get(self, ip):
+        """Returns the number of connections from ip"""
+        digest, _, offsets = self._bucket(ip)
+        for offset in offsets:
+            slot_digest, count = self.SLOT.unpack_from(self.map, offset)
+            if count and slot_digest == digest:
+                return count
+        return 0
+
+    def connect(self, ip):
+        """Add a connection from ip, returns the number of connections or None if it can't be tracked"""
+        digest, lock, offsets = self._bucket(ip)
+        with lock:
+            free = None
+            for offset in offsets:
+                slot_digest, count = self.SLOT.unpack_from(self.map, offset)
+                if count and slot_digest == digest:
+                    self.SLOT.pack_into(self.map, offset, digest, count + 1)
+                    return count + 1
+                if not count and free is None:
+                    free = offset
+            if free is None:
+                logging.warning("connection tracking: no free slot for %s" % ip)
+                return None
+            self.SLOT.pack_into(self.map, free, digest, 1)
+        return 1
+
+    def disconnect(self, ip):
+        """Remove a connection from ip, returns the number of connections left"""
+        digest, lock, offsets = self._bucket(ip)
+        with lock:
+            for offset in offsets:
+                slot_digest, count = self.SLOT.unpack_from(self.map, offset)
+                if count and slot_digest == digest:
+                    self.SLOT.pack_into(self.map, offset, digest, count - 1)
+                    return count - 1
+        return 0
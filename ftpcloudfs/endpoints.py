@@ -0,0 +1,273 @@
+"""
+    Load balancing of the object storage requests between several endpoints.
+
+The storage URL returned by the auth service is routed to one of the
+configured proxy endpoints (same path, different scheme and host). The
+endpoints are health checked passively (the result of every request) and
+actively (a health check request in the background, by a single server
+process that shares the results with the others).
+"""
+
+import os
+import time
+import mmap
+import errno
+import struct
+import logging
+import threading
+import multiprocessing
+from urlparse import urlparse, urlunparse
+from swiftclient.client import http_connection
+
+__all__ = ['Endpoint', 'EndpointPool']
+
+class Endpoint(object):
+    """
+    A proxy endpoint and its health.
+
+    latency is an exponentially weighted moving average of the time to get
+    a response, in seconds.
+    """
+    # weight of the last request in the latency average
+    LATENCY_WEIGHT = 0.2
+
+    def __init__(self, url, index=0):
+        parsed = urlparse(url)
+        if parsed.scheme not in ('http', 'https') or not parsed.netloc:
+            raise ValueError("Invalid endpoint: %r" % url)
+        self.scheme, self.netloc = parsed.scheme, parsed.netloc
+        self.url = "%s://%s" % (self.scheme, self.netloc)
+        # position of the endpoint in the shared health check results
+        self.index = index
+        # time of the last health check result applied
+        self.checked = 0
+        self.in_flight = 0
+        self.latency = 0.0
+        self.failures = 0
+        self.ejected_until = 0
+        self.ejections = 0
+        self.requests = 0
+
+    def route(self, url):
+        """Returns url with the scheme and host of the endpoint"""
+        parsed = list(urlparse(url))
+        parsed[0], parsed[1] = self.scheme, self.netloc
+        return urlunparse(parsed)
+
+    def available(self, now):
+        return self.ejected_until <= now
+
+    def update_latency(self, latency):
+        if self.latency:
+            self.latency += self.LATENCY_WEIGHT * (latency - self.latency)
+        else:
+            self.latency = latency
+
+    def stats(self):
+        return dict(in_flight=self.in_flight,
+                    latency=self.latency,
+                    failures=self.failures,
+                    ejected=self.ejected_until > time.time(),
+                    ejections=self.ejections,
+                    requests=self.requests,
+                    )
+
+    def __repr__(self):
+        return "<Endpoint %s>" % self.url
+
+class EndpointPool(object):
+    """
+    Per process pool of proxy endpoints.
+
+    policy is 'least-loaded' (fewer requests in flight, then lower latency)
+    or 'latency' (lower latency, then fewer requests in flight).
+
+    An endpoint failing max_failures requests in a row (connection errors
+    and 5xx replies) is ejected for eject_time seconds, doubled every time
+    it's ejected again up to max_eject_time. If check_interval is not 0, a
+    thread checks all the endpoints every check_interval seconds requesting
+    check_path: a failed check ejects the endpoint, a successful check
+    brings it back. If all the endpoints are ejected, the one that will be
+    back sooner is used anyway.
+
+    The health checks run in one process at a time (the first one using the
+    pool, replaced if it's gone or stops checking), and their results are
+    shared with the other processes in a shared memory segment created with
+    the pool (so it must be created before forking).
+    """
+    POLICIES = ('least-loaded', 'latency')
+    # process running the health checks, time of its last round of checks
+    CHECKER = struct.Struct("<id")
+    # health check result of an endpoint: time of the check, ok, ejected until
+    CHECK = struct.Struct("<dId")
+
+    def __init__(self, urls, policy='least-loaded', max_failures=3, eject_time=30, max_eject_time=300,
+                 check_interval=10, check_path='/healthcheck', check_timeout=5, insecure=False):
+        if not urls:
+            raise ValueError("No endpoints")
+        if policy not in self.POLICIES:
+            raise ValueError("Unsupported policy: %r" % policy)
+        self.urls = list(urls)
+        self.policy = policy
+        self.max_failures = max_failures
+        self.eject_time = eject_time
+        self.max_eject_time = max_eject_time
+        self.check_interval = check_interval
+        self.check_path = check_path
+        self.check_timeout = check_timeout
+        self.insecure = insecure
+        self.lock = threading.Lock()
+        self.endpoints = [Endpoint(url, index) for index, url in enumerate(self.urls)]
+        self.pid = os.getpid()
+        self.checker = None
+        # when to try to become the checker process again
+        self.next_claim = 0
+        self.map = mmap.mmap(-1, self.CHECKER.size + len(self.urls)*self.CHECK.size, mmap.MAP_SHARED)
+        self.shared_lock = multiprocessing.Lock()
+
+    def _check_pid(self):
+        """Start from scratch in a new process, must be called holding the lock"""
+        if self.pid != os.getpid():
+            self.endpoints = [Endpoint(url, index) for index, url in enumerate(self.urls)]
+            self.pid = os.getpid()
+            self.checker = None
+            self.next_claim = 0
+        if self.check_interval and self.checker is None and self.next_claim <= time.time():
+            self.next_claim = time.time() + self.check_interval
+            if self._claim_checker():
+                self.checker = threading.Thread(target=self._checker, name="ftpcloudfs-healthcheck")
+                self.checker.daemon = True
+                self.checker.start()
+
+    @staticmethod
+    def _alive(pid):
+        try:
+            os.kill(pid, 0)
+        except OSError, e:
+            return e.errno != errno.ESRCH
+        return True
+
+    def _claim_checker(self):
+        """Returns True if this process must run the health checks"""
+        with self.shared_lock:
+            pid, beat = self.CHECKER.unpack_from(self.map, 0)
+            if pid and pid != self.pid and self._alive(pid) and beat > time.time() - 3*self.check_interval:
+                return False
+            self.CHECKER.pack_into(self.map, 0, self.pid, time.time())
+        logging.debug("running the endpoint health checks in process %s" % self.pid)
+        return True
+
+    def _sync(self):
+        """Apply the health check results of the checker process, must be called holding the lock"""
+        for endpoint in self.endpoints:
+            checked, ok, ejected_until = self.CHECK.unpack_from(self.map, self.CHECKER.size
+                                                                + endpoint.index*self.CHECK.size)
+            if checked <= endpoint.checked:
+                continue
+            endpoint.checked = checked
+            if ok:
+                endpoint.ejected_until = 0
+                endpoint.ejections = 0
+                endpoint.failures = 0
+            else:
+                endpoint.ejected_until = max(endpoint.ejected_until, ejected_until)
+
+    def _key(self, endpoint):
+        if self.policy == 'latency':
+            return (endpoint.latency, endpoint.in_flight)
+        return (endpoint.in_flight, endpoint.latency)
+
+    def acquire(self):
+        """Returns the endpoint to use for a request, release must be called when it's done"""
+        now = time.time()
+        with self.lock:
+            self._check_pid()
+            self._sync()
+            available = [endpoint for endpoint in self.endpoints if endpoint.available(now)]
+            if available:
+                endpoint = min(available, key=self._key)
+            else:
+                endpoint = min(self.endpoints, key=lambda endpoint: endpoint.ejected_until)
+            endpoint.in_flight += 1
+            endpoint.requests += 1
+        return endpoint
+
+    def release(self, endpoint, ok, latency=None):
+        """
+        The request sent to endpoint is done, ok is False if the endpoint
+        failed (None if the request was aborted and it doesn't tell).
+        """
+        with self.lock:
+            endpoint.in_flight = max(0, endpoint.in_flight - 1)
+            if ok is not None:
+                self._report(endpoint, ok, latency)
+
+    def _report(self, endpoint, ok, latency=None):
+        """Update the health of endpoint, must be called holding the lock"""
+        if ok:
+            endpoint.failures = 0
+            if latency is not None:
+                endpoint.update_latency(latency)
+            return
+        endpoint.failures += 1
+        if endpoint.failures >= self.max_failures and endpoint.available(time.time()):
+            self._eject(endpoint)
+
+    def _eject(self, endpoint):
+        eject_time = min(self.eject_time * 2 ** min(endpoint.ejections, 16), self.max_eject_time)
+        endpoint.ejected_until = time.time() + eject_time
+        endpoint.ejections += 1
+        logging.warning("endpoint %s ejected for %s seconds" % (endpoint.url, eject_time))
+
+    def check(self, endpoint):
+        """Active health check of endpoint"""
+        start = time.time()
+        try:
+            parsed, conn = http_connection(endpoint.url + self.check_path,
+                                           insecure=self.insecure,
+                                           timeout=self.check_timeout)
+            try:
+                conn.request('GET', parsed.path, '', {})
+                resp = conn.getresponse()
+                resp.read()
+                ok = resp.status // 100 == 2
+            finally:
+                conn.request_session.close()
+        except Exception, e:
+            logging.debug("health check of %s failed: %s" % (endpoint.url, e))
+            ok = False
+        with self.lock:
+            if ok:
+                if not endpoint.available(time.time()):
+                    logging.info("endpoint %s is back" % endpoint.url)
+                endpoint.ejected_until = 0
+                endpoint.ejections = 0
+                self._report(endpoint, True, time.time() - start)
+            elif endpoint.available(time.time()):
+                endpoint.failures = self.max_failures
+                self._eject(endpoint)
+            # for the other processes
+            endpoint.checked = time.time()
+            self.CHECK.pack_into(self.map, self.CHECKER.size + endpoint.index*self.CHECK.size,
+                                 endpoint.checked, ok, endpoint.ejected_until)
+        return ok
+
+    def _checker(self):
+        pid = os.getpid()
+        while pid == self.pid:
+            time.sleep(self.check_interval)
+            with self.shared_lock:
+                if self.CHECKER.unpack_from(self.map, 0)[0] != pid:
+                    # replaced by another process
+                    break
+                self.CHECKER.pack_into(self.map, 0, pid, time.time())
+            for endpoint in list(self.endpoints):
+                self.check(endpoint)
+        with self.lock:
+            if self.pid == pid:
+                self.checker = None
+
+    def stats(self):
+        """Returns a dict with the statistics of every endpoint"""
+        with self.lock:
+            return dict((endpoint.url, endpoint.stats()) for endpoint in self.endpoints)
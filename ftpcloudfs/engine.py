@@ -0,0 +1,150 @@
+"""
+    Concurrent object storage requests.
+
+The requests that don't depend on each other (eg. the HEAD requests of a
+listing) run concurrently in a pool of threads, each one with its own
+connection, and the objects are read ahead while the data is sent to the
+client.
+"""
+
+import os
+import logging
+import threading
+from Queue import Queue, Empty, Full
+
+__all__ = ['StorageEngine', 'ReadAhead']
+
+class StorageEngine(object):
+    """
+    Per process pool of threads running object storage requests.
+
+    The pool is reset in a forked process (threads don't survive a fork).
+    """
+
+    def __init__(self, threads=4):
+        self.threads = threads
+        self.lock = threading.Lock()
+        self.pid = None
+        self.requests = 0
+
+    def _check_pid(self):
+        """Start from scratch in a new process, must be called holding the lock"""
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.queue = Queue()
+            self.workers = []
+
+    def _worker(self):
+        while True:
+            self.queue.get()()
+
+    def map(self, connection, func, items):
+        """
+        Returns [func(conn, item) for item in items] running the calls in the pool.
+
+        Every call gets a new connection from connection() that is closed
+        when the call is done. If any call raises an exception, the one of
+        the first item is raised when all the calls are done.
+        """
+        items = list(items)
+        with self.lock:
+            self._check_pid()
+            while len(self.workers) < min(len(items), self.threads):
+                worker = threading.Thread(target=self._worker, name="ftpcloudfs-engine")
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+            self.requests += len(items)
+
+        done = Queue()
+        def run(index, item):
+            try:
+                conn = connection()
+                try:
+                    result, error = func(conn, item), None
+                finally:
+                    conn.close()
+            except Exception, e:
+                result, error = None, e
+            done.put((index, result, error))
+
+        for index, item in enumerate(items):
+            self.queue.put(lambda index=index, item=item: run(index, item))
+
+        results = [None] * len(items)
+        errors = {}
+        for _ in items:
+            index, result, error = done.get()
+            if error is not None:
+                errors[index] = error
+            results[index] = result
+        if errors:
+            logging.debug("%s of %s concurrent requests failed" % (len(errors), len(items)))
+            raise errors[min(errors)]
+        return results
+
+    def stats(self):
+        """Returns a dict with the engine statistics"""
+        return dict(workers=len(getattr(self, "workers", [])), requests=self.requests)
+
+class ReadAhead(object):
+    """
+    Iterator reading up to depth items of iterator ahead in a thread.
+
+    close stops the thread and closes iterator (if it has a close method).
+    """
+    _END = object()
+
+    def __init__(self, iterator, depth=2):
+        self.iterator = iterator
+        self.items = Queue(depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._reader, name="ftpcloudfs-read-ahead")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _put(self, item):
+        """Returns False if the reader was stopped while waiting"""
+        while not self.stopped.is_set():
+            try:
+                self.items.put(item, True, 1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _reader(self):
+        try:
+            for item in self.iterator:
+                if not self._put((item, None)):
+                    return
+            self._put((self._END, None))
+        except Exception, e:
+            self._put((None, e))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.stopped.is_set():
+            raise StopIteration()
+        item, error = self.items.get()
+        if error is not None:
+            self.stopped.set()
+            raise error
+        if item is self._END:
+            self.stopped.set()
+            raise StopIteration()
+        return item
+
+    def close(self):
+        self.stopped.set()
+        while self.thread.is_alive():
+            # make room if the reader is waiting
+            try:
+                self.items.get_nowait()
+            except Empty:
+                pass
+            self.thread.join(0.1)
+        if hasattr(self.iterator, "close"):
+            self.iterator.close()
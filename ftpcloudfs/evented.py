@@ -0,0 +1,359 @@
+"""
+    Object storage transfers driven by the pyftpdlib IOLoop.
+
+The socket of the object storage request is registered in the IOLoop of the
+session, and the data is relayed between it and the data channel as the
+sockets are ready, without blocking the IOLoop while the object storage or
+the client are slow. Only plain HTTP is supported.
+"""
+
+import time
+import errno
+import socket
+import logging
+from urllib import quote
+from swiftclient.client import ClientException
+
+from ftpcloudfs.utils import smart_str
+
+__all__ = ['ResponseParser', 'ObjectStream', 'HIGH_WATER', 'LOW_WATER']
+
+# bytes waiting to be sent on one side before pausing the other side,
+# and bytes left to resume it (at least 4 and 1 chunks)
+HIGH_WATER = 256 * 1024
+LOW_WATER = 64 * 1024
+
+_RETRY = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+class ResponseParser(object):
+    """
+    Incremental parser of a HTTP/1.1 response.
+
+    feed returns the body data in the data (without the chunked transfer
+    encoding). status, reason and headers are set once the headers are
+    parsed, and done once the body is complete.
+    """
+    MAX_HEADERS = 64 * 1024
+
+    def __init__(self):
+        self.buffer = ""
+        self.status = None
+        self.reason = None
+        self.headers = None
+        self.done = False
+        self.length = None
+        self.chunked = False
+        # bytes left of the body (or of the current chunk)
+        self.left = None
+        self.state = "headers"
+
+    def _parse_headers(self, block):
+        lines = block.split("\r\n")
+        try:
+            version, status, reason = (lines[0].split(" ", 2) + [""])[:3]
+            self.status = int(status)
+        except ValueError:
+            raise ClientException("Invalid response: %r" % lines[0][:80])
+        self.reason = reason
+        self.headers = {}
+        for line in lines[1:]:
+            key, _, value = line.partition(":")
+            self.headers[key.strip().lower()] = value.strip()
+        if "chunked" in self.headers.get("transfer-encoding", "").lower():
+            self.chunked = True
+            self.state = "size"
+        elif "content-length" in self.headers:
+            self.left = int(self.headers["content-length"])
+            self.state = "body"
+        else:
+            # until the connection is closed
+            self.state = "close"
+
+    def feed(self, data):
+        """Parse data, returns the body data found"""
+        if self.state == "body" and not self.buffer and len(data) < self.left:
+            # most of the time, no need to copy it
+            self.left -= len(data)
+            return data
+        self.buffer += data
+        body = []
+        while self.buffer and not self.done:
+            if self.state == "headers":
+                end = self.buffer.find("\r\n\r\n")
+                if end < 0:
+                    if len(self.buffer) > self.MAX_HEADERS:
+                        raise ClientException("Response headers too long")
+                    break
+                block, self.buffer = self.buffer[:end], self.buffer[end+4:]
+                self._parse_headers(block)
+                if self.state == "body" and self.left == 0:
+                    self.done = True
+            elif self.state == "body":
+                piece, self.buffer = self.buffer[:self.left], self.buffer[self.left:]
+                body.append(piece)
+                self.left -= len(piece)
+                if self.left == 0:
+                    self.done = True
+            elif self.state == "close":
+                body.append(self.buffer)
+                self.buffer = ""
+            elif self.state == "size":
+                end = self.buffer.find("\r\n")
+                if end < 0:
+                    break
+                line, self.buffer = self.buffer[:end], self.buffer[end+2:]
+                try:
+                    self.left = int(line.split(";", 1)[0], 16)
+                except ValueError:
+                    raise ClientException("Invalid chunk size: %r" % line[:80])
+                self.state = "chunk" if self.left else "trailers"
+            elif self.state == "chunk":
+                piece, self.buffer = self.buffer[:self.left], self.buffer[self.left:]
+                body.append(piece)
+                self.left -= len(piece)
+                if self.left == 0:
+                    self.state = "crlf"
+            elif self.state == "crlf":
+                if len(self.buffer) < 2:
+                    break
+                self.buffer = self.buffer[2:]
+                self.state = "size"
+            elif self.state == "trailers":
+                end = self.buffer.find("\r\n")
+                if end < 0:
+                    break
+                line, self.buffer = self.buffer[:end], self.buffer[end+2:]
+                if not line:
+                    self.done = True
+        return "".join(body)
+
+    def eof(self):
+        """The connection was closed, returns True if the response is complete"""
+        if self.state == "close":
+            self.done = True
+        return self.done
+
+class ObjectStream(object):
+    """
+    GET an object and push it to a data channel from the IOLoop.
+
+    The data channel must implement end_stream (all the data was pushed),
+    abort_stream (the transfer failed) and fallback_stream (the request
+    failed before sending any data, use a blocking read instead), and call
+    sent when it sends data so the stream is resumed.
+    """
+    recv_size = 65536
+
+    def __init__(self, conn, container, name, offset=0):
+        self.conn = conn
+        self.container = container
+        self.name = name
+        self.offset = offset
+        self.dtp = None
+        self.ioloop = None
+        self.raw_conn = None
+        self.http_pool = None
+        self.sock = None
+        self.fileno = None
+        self.endpoint = None
+        self.parser = ResponseParser()
+        self.pushed = 0
+        self.paused = False
+        self.closed = False
+        self.reported = False
+        # in flight in the admission control until the response starts
+        self.admitted = False
+        self.start_time = None
+        # the get timeout between reads (the socket isn't blocking)
+        self.deadline = None
+
+    def start(self, dtp):
+        """Send the request, returns False if it can't be done from the IOLoop"""
+        conn = self.conn
+        url = conn.url
+        if conn.breaker is not None and conn.breaker.is_open():
+            return False
+        if conn.endpoints is not None:
+            self.endpoint = conn.endpoints.acquire()
+            url = self.endpoint.route(url)
+        parsed, http_conn = conn.http_connection(url)
+        if parsed.scheme != "http":
+            self._report(True)
+            conn.release_http_connection((parsed, http_conn), url)
+            return False
+
+        path = "%s/%s/%s" % (parsed.path.rstrip("/"), quote(smart_str(self.container)), quote(smart_str(self.name)))
+        headers = { 'X-Auth-Token': conn.token }
+        if self.offset:
+            headers['Range'] = "bytes=%d-" % self.offset
+        if conn.real_ip:
+            headers['X-Forwarded-For'] = conn.real_ip
+            headers['X-Client-IP'] = conn.real_ip
+
+        if conn.admission is not None:
+            conn.admission.start()
+            self.admitted = True
+        self.start_time = time.time()
+        try:
+            self.http_pool = http_conn.request_session.get_adapter(url).get_connection(url)
+            self.raw_conn = self.http_pool._get_conn()
+            self.raw_conn.timeout = conn.timeouts.get("get")
+            self.raw_conn.putrequest('GET', path, skip_accept_encoding=True)
+            for key, value in headers.iteritems():
+                self.raw_conn.putheader(key, value)
+            self.raw_conn.endheaders()
+        except Exception, e:
+            logging.debug("evented GET failed to start: %s" % e)
+            self._report(False)
+            self._admitted()
+            self._close_connection()
+            return False
+        finally:
+            conn.release_http_connection((parsed, http_conn), url)
+
+        self.dtp = dtp
+        self.ioloop = dtp.ioloop
+        self.sock = self.raw_conn.sock
+        self.sock.setblocking(0)
+        self.fileno = self.sock.fileno()
+        self.ioloop.register(self.fileno, self, self.ioloop.READ)
+        self._set_deadline()
+        logging.debug("evented GET %r/%r from %s" % (self.container, self.name, self.offset))
+        return True
+
+    # IOLoop events
+
+    def readable(self):
+        return not self.paused
+
+    def writable(self):
+        return False
+
+    def handle_read_event(self):
+        try:
+            data = self.sock.recv(self.recv_size)
+        except socket.error, e:
+            if e.args[0] in _RETRY:
+                return
+            return self._fail(e)
+        if self.deadline is not None:
+            self.deadline.reset()
+        try:
+            if not data:
+                if not self.parser.eof():
+                    raise ClientException("Connection closed before the end of the response")
+                return self._finish()
+            body = self.parser.feed(data)
+            if self.parser.status is not None:
+                self._admitted(time.time() - self.start_time)
+            if self.parser.status is not None and self.parser.status // 100 != 2:
+                raise ClientException(self.parser.reason, http_status=self.parser.status,
+                                      http_reason=self.parser.reason)
+        except ClientException, e:
+            return self._fail(e)
+        if body:
+            self.pushed += len(body)
+            self.dtp.push(body)
+        if self.parser.done:
+            return self._finish()
+        if self.pushed - self.dtp.tot_bytes_sent > max(HIGH_WATER, 4*self.recv_size):
+            self.paused = True
+            self.ioloop.modify(self.fileno, 0)
+
+    def handle_write_event(self):
+        pass
+
+    def handle_close(self):
+        self.handle_read_event()
+
+    def handle_error(self):
+        logging.exception("evented GET error")
+        self._fail(ClientException("Internal error"))
+
+    # data channel events
+
+    def sent(self):
+        """The data channel sent data, resume reading if it's waiting for more"""
+        if self.paused and not self.closed and \
+                self.pushed - self.dtp.tot_bytes_sent < max(LOW_WATER, self.recv_size):
+            self.paused = False
+            self.ioloop.modify(self.fileno, self.ioloop.READ)
+
+    # helpers
+
+    def _set_deadline(self):
+        timeout = self.conn.timeouts.get("get")
+        if timeout:
+            self.deadline = self.ioloop.call_later(timeout, self._timed_out, _errback=self.handle_error)
+
+    def _timed_out(self):
+        self.deadline = None
+        if self.paused:
+            # waiting for the data channel, not for the object storage
+            self._set_deadline()
+            return
+        self._fail(ClientException("timed out"))
+
+    def _finish(self):
+        logging.debug("evented GET done, %s bytes" % self.pushed)
+        self._report(True, time.time() - self.start_time)
+        self.close()
+        self.dtp.end_stream()
+
+    def _fail(self, error):
+        status = getattr(error, "http_status", None)
+        self._report(status is not None and status < 500)
+        self.close()
+        if self.pushed == 0:
+            logging.debug("evented GET failed, falling back to a blocking read: %s" % error)
+            if status == 401:
+                # authenticate again
+                self.conn.token = None
+            self.dtp.fallback_stream()
+        else:
+            logging.error("evented GET failed after %s bytes: %s" % (self.pushed, error))
+            self.dtp.abort_stream("Object storage error")
+
+    def _admitted(self, latency=None):
+        """The request is no longer in flight for the admission control"""
+        if self.admitted:
+            self.admitted = False
+            self.conn.admission.finish(latency)
+
+    def _report(self, ok, latency=None):
+        """
+        Report the result of the request to the endpoint pool and the circuit
+        breaker, once (ok is None if it was aborted by us).
+        """
+        if self.reported:
+            return
+        self.reported = True
+        if self.endpoint is not None:
+            self.conn.endpoints.release(self.endpoint, ok, latency)
+        if self.conn.breaker is not None and ok is not None:
+            self.conn.breaker.record(ok)
+
+    def _close_connection(self):
+        if self.raw_conn is not None:
+            # the response was read by us, the connection can't be reused
+            self.raw_conn.close()
+            if self.http_pool is not None:
+                self.http_pool._put_conn(self.raw_conn)
+            self.raw_conn = None
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._admitted()
+        if self.deadline is not None:
+            self.deadline.cancel()
+            self.deadline = None
+        if self.fileno is not None:
+            try:
+                self.ioloop.unregister(self.fileno)
+            except (KeyError, EnvironmentError):
+                pass
+        # closed by the client, not an object storage failure
+        self._report(None)
+        self._close_connection()
@@ -8,19 +8,32 @@ Authors: Chmouel Boudjnah <chmouel@chmouel.com>
 
 import os
 import sys
+import copy
 import time
+import random
 import mimetypes
 import stat
+import socket
 import logging
 from urllib import unquote
+from email.utils import parsedate
 from errno import EPERM, ENOENT, EACCES, EIO, ENOTDIR, ENOTEMPTY
-from swiftclient.client import Connection, ClientException, quote
+from swiftclient.client import Connection, ClientException, quote, get_object
+from requests.exceptions import RequestException
 from chunkobject import ChunkObject
 from errors import IOSError
+from index import MetadataIndex
+from cache import create_cache
+from auth import TokenCache, CredentialCache, get_auth_1_0
+from hedge import hedged
+from breaker import CircuitOpen
+from engine import ReadAhead
+from evented import ObjectStream
+from sizing import ChunkSizer
 import posixpath
 from utils import smart_str, smart_unicode
 from functools import wraps
-import memcache
+import threading
 import multiprocessing
 try:
     from hashlib import md5
@@ -38,64 +51,300 @@ class ProxyConnection(Connection):
     Add custom HTTP headers to all requests.
     """
 
-    # max time to cache auth tokens (seconds), based on swift defaults
-    TOKEN_TTL = 86400
-
-    def __init__(self, memcache, *args, **kwargs):
-        self.memcache = memcache
+    # auth tokens and verified credentials caches shared by all the connections in the process
+    tokens = TokenCache()
+    credentials = CredentialCache()
+    # HTTP connections pool shared by all the connections in the process (None disables)
+    pool = None
+    # EndpointPool to load balance the requests (None: use the storage URL)
+    endpoints = None
+    # CircuitBreaker shared by all the connections in the process (None disables)
+    breaker = None
+    # AdmissionController tracking the requests in flight and their latency (None disables)
+    admission = None
+    # StorageEngine to run independent requests concurrently (None: one after the other)
+    engine = None
+    # seconds to wait for the auth service and for the object storage per operation (None: no timeout);
+    # for get it's the time to get the first byte (and between reads), for put between writes
+    timeouts = dict(auth=None, head=None, listing=None, get=None, put=None)
+    # default retries of idempotent operations, waiting a random time up to an exponential backoff
+    max_retries = 5
+    retry_backoff = 1
+    retry_max_backoff = 64
+    # operation of the swiftclient functions, other functions are "put"
+    OPERATIONS = dict(head_account="head", head_container="head", head_object="head",
+                      get_account="listing", get_container="listing", get_object="get",
+                      get_capabilities="head",
+                      )
+    IDEMPOTENT = ("head_account", "head_container", "head_object", "get_account", "get_container",
+                  "get_object", "get_capabilities", "put_container", "post_account", "post_container",
+                  "post_object", "delete_container", "delete_object",
+                  )
+
+    def __init__(self, cache, *args, **kwargs):
+        self.cache = cache
         self.real_ip = None
-        self.ignore_auth_cache = False
+        # last token returned by get_auth
+        self.auth_token = None
         self.tenant_name = None
         if kwargs.get('auth_version') == "2.0":
             self.tenant_name = kwargs['tenant_name']
         elif kwargs.get('auth_version') == "3":
             self.tenant_name = kwargs['os_options']['project_name']
+        kwargs.setdefault('timeout', self.timeouts['auth'])
+        kwargs.setdefault('retries', self.max_retries)
+        kwargs.setdefault('starting_backoff', self.retry_backoff)
+        kwargs.setdefault('max_backoff', self.retry_max_backoff)
         super(ProxyConnection, self).__init__(*args, **kwargs)
 
-    def http_connection(self):
+    def http_connection(self, url=None):
         def request_wrapper(fn):
             @wraps(fn)
-            def request_header_injection(method, url, data=None, headers=None):
+            def request_header_injection(method, url, data=None, headers=None, files=None):
                 if headers is None:
                     headers = {}
                 if self.real_ip:
                     headers['X-Forwarded-For'] = self.real_ip
                     headers['X-Client-IP'] = self.real_ip
-                fn(method, url, data=data, headers=headers)
+                return fn(method, url, data=data, headers=headers, files=files)
             return request_header_injection
 
-        parsed, conn = super(ProxyConnection, self).http_connection()
-        conn.request = request_wrapper(conn.request)
+        if self.pool is not None:
+            factory = lambda: super(ProxyConnection, self).http_connection(url)
+            parsed, conn = self.pool.get(self.pool_key(url), factory)
+        else:
+            parsed, conn = super(ProxyConnection, self).http_connection(url)
+        # a pooled connection may have been wrapped by another connection
+        conn.request = request_wrapper(type(conn).request.__get__(conn, type(conn)))
 
         return parsed, conn
 
+    def _retry(self, reset_func, func, *args, **kwargs):
+        """
+        Perform the request of func with the timeout of its operation.
+
+        The idempotent operations are retried if the object storage fails
+        (no response or 5xx replies). Every attempt is routed to an endpoint
+        of the pool (if any) and checked by the circuit breaker (if any).
+        """
+        name = getattr(func, "__name__", None)
+        timeout = self.timeouts.get(self.OPERATIONS.get(name, "put"))
+        retries = self.retries if self.idempotent(name, args, kwargs) else 0
+
+        def attempt(url, token, *args, **kwargs):
+            if self.breaker is not None:
+                self.breaker.check()
+            endpoint = None
+            if self.endpoints is not None:
+                endpoint = self.endpoints.acquire()
+                routed_url = endpoint.route(url)
+                if self.http_conn is None or self.http_conn[1].url != routed_url:
+                    if self.http_conn is not None:
+                        self.release_http_connection(self.http_conn)
+                    self.http_conn = self.http_connection(routed_url)
+                kwargs['http_conn'] = self.http_conn
+            kwargs['http_conn'][1].requests_args['timeout'] = timeout
+            if self.admission is not None:
+                self.admission.start()
+            start = time.time()
+            try:
+                rv = func(url, token, *args, **kwargs)
+            except Exception, e:
+                ok = self.endpoint_ok(e)
+                if endpoint is not None:
+                    self.endpoints.release(endpoint, ok)
+                if self.breaker is not None:
+                    self.breaker.record(ok)
+                if self.admission is not None:
+                    self.admission.finish(time.time() - start if ok else None)
+                raise
+            if endpoint is not None:
+                self.endpoints.release(endpoint, True, time.time() - start)
+            if self.breaker is not None:
+                self.breaker.record(True)
+            if self.admission is not None:
+                self.admission.finish(time.time() - start)
+            return rv
+
+        # swiftclient retries only after a rejected token, the backoff is ours
+        saved_retries, self.retries = self.retries, 0
+        try:
+            for retry in xrange(retries + 1):
+                try:
+                    return super(ProxyConnection, self)._retry(reset_func, attempt, *args, **kwargs)
+                except Exception, e:
+                    if retry == retries or not self.retryable(e):
+                        raise
+                    if not isinstance(e, ClientException) or e.http_status == 408:
+                        # don't reuse the connection
+                        self.http_conn = None
+                backoff = random.uniform(0, min(self.max_backoff, self.starting_backoff * 2 ** retry))
+                logging.debug("retrying %s in %.2f seconds: %s" % (name, backoff, e))
+                time.sleep(backoff)
+                if reset_func:
+                    reset_func(func, *args, **kwargs)
+        finally:
+            self.retries = saved_retries
+
+    def idempotent(self, name, args, kwargs):
+        """Check if the swiftclient function name can be retried with args and kwargs"""
+        if name == "put_object":
+            # the contents can be sent again
+            contents = args[2] if len(args) > 2 else kwargs.get("contents")
+            return isinstance(contents, (basestring, type(None))) \
+                or (hasattr(contents, "seek") and hasattr(contents, "tell"))
+        return name in self.IDEMPOTENT
+
+    def retryable(self, error):
+        """Check if the request that raised error can be retried"""
+        if isinstance(error, CircuitOpen):
+            return False
+        if isinstance(error, ClientException):
+            return error.http_status is not None and (error.http_status >= 500 or error.http_status == 408)
+        return isinstance(error, (socket.error, RequestException))
+
+    @staticmethod
+    def endpoint_ok(error):
+        """Check if the endpoint that raised error is healthy"""
+        if isinstance(error, (socket.error, RequestException)):
+            return False
+        if isinstance(error, ClientException):
+            return not (error.http_status is None or error.http_status >= 500)
+        return True
+
+    def get_object_once(self, container, obj, **kwargs):
+        """
+        Get an object using a new HTTP connection, without retries.
+
+        It can be called from a thread while the connection is in use. Returns
+        the object headers and body generator, and the HTTP connection that
+        must be released with release_http_connection after reading the body.
+        """
+        if self.breaker is not None:
+            self.breaker.check()
+        url = self.url
+        endpoint = None
+        if self.endpoints is not None:
+            endpoint = self.endpoints.acquire()
+            url = endpoint.route(url)
+        http_conn = self.http_connection(url)
+        http_conn[1].requests_args['timeout'] = self.timeouts.get("get")
+        if self.admission is not None:
+            self.admission.start()
+        start = time.time()
+        try:
+            headers, body = get_object(url, self.token, container, obj, http_conn=http_conn, **kwargs)
+        except Exception, e:
+            ok = self.endpoint_ok(e)
+            if endpoint is not None:
+                self.endpoints.release(endpoint, ok)
+            if self.breaker is not None:
+                self.breaker.record(ok)
+            if self.admission is not None:
+                self.admission.finish(time.time() - start if ok else None)
+            if isinstance(e, ClientException) and e.http_status is not None:
+                self.release_http_connection(http_conn, url)
+            else:
+                http_conn[1].request_session.close()
+            raise
+        if endpoint is not None:
+            self.endpoints.release(endpoint, True, time.time() - start)
+        if self.breaker is not None:
+            self.breaker.record(True)
+        if self.admission is not None:
+            self.admission.finish(time.time() - start)
+        return headers, body, http_conn
+
+    def clone(self):
+        """Returns a connection with the same credentials and token, to use from another thread"""
+        conn = copy.copy(self)
+        conn.http_conn = None
+        return conn
+
+    def map(self, func, items):
+        """
+        Returns [func(conn, item) for item in items].
+
+        The calls run concurrently in the engine (if any), every one with a
+        clone of this connection.
+        """
+        items = list(items)
+        if self.engine is None or len(items) < 2:
+            return [func(self, item) for item in items]
+        if not self.url or not self.token:
+            self.url, self.token = self.get_auth()
+        return self.engine.map(self.clone, func, items)
+
+    def pool_key(self, url=None):
+        """Returns the key of the HTTP connections to url in the pool"""
+        return (url or self.url, self.insecure, self.cacert, getattr(self, "cert", None),
+                getattr(self, "cert_key", None), self.timeout)
+
+    def release_http_connection(self, http_conn, url=None):
+        """Return a HTTP connection to the pool, or close it if there's no pool"""
+        conn = http_conn[1]
+        if self.pool is not None:
+            self.pool.put(self.pool_key(url or conn.url), http_conn)
+        else:
+            conn.request_session.close()
+
     def close(self):
-        """Our own close that actually closes the connection"""
+        """Our own close that actually closes the connection (or returns it to the pool)"""
         if self.http_conn and type(self.http_conn) is tuple and len(self.http_conn) > 1:
             conn = self.http_conn[1]
             if hasattr(conn, "request_session"):
-                conn.request_session.close()
+                self.release_http_connection(self.http_conn)
                 self.http_conn = None
             else:
                 super(ProxyConnection, self).close()
 
     def get_auth(self):
-        """Perform the authentication using a token cache if memcache is available"""
-        if self.memcache:
-            tenant_name = self.tenant_name or "-"
-            key = "tk%s" % md5("%s%s%s%s" % (self.authurl, self.user, tenant_name, self.key)).hexdigest()
-            cache = self.memcache.get(key)
-            if not cache or self.ignore_auth_cache:
-                logging.debug("token cache miss, key=%s" % key)
-                cache = super(ProxyConnection, self).get_auth()
-                self.memcache.set(key, cache, self.TOKEN_TTL)
-                self.ignore_auth_cache = False
-            else:
-                logging.debug("token cache hit, key=%s" % key)
-                self.ignore_auth_cache = True
-            return cache
-        # no memcache
-        return super(ProxyConnection, self).get_auth()
+        """
+        Perform the authentication using the token cache.
+
+        The cached token of the user is used only if the credentials match
+        the ones verified by the auth service to get it. It's not used either
+        if the storage rejected it (the token was reset after a 401), so it's
+        authenticated again only once.
+        """
+        tenant_name = self.tenant_name or "-"
+        domain_name = self.os_options.get('user_domain_name') or "-"
+        key = md5("%s%s%s%s" % (self.authurl, self.user, tenant_name, domain_name)).hexdigest()
+        if self.token is None and self.auth_token is not None:
+            logging.debug("token rejected, key=%s" % key)
+            self.tokens.invalidate("tk" + key, self.cache)
+            self.credentials.invalidate("cr" + key, self.cache)
+            cached = None
+        else:
+            cached = self.tokens.get("tk" + key, self.cache)
+            # credentials are verified once per connection
+            if cached and self.auth_token is None and not self.credentials.verify("cr" + key, self.key, self.cache):
+                logging.debug("credentials not verified, key=%s" % key)
+                cached = None
+        if cached:
+            logging.debug("token cache hit, key=%s" % key)
+            url, token, _ = cached
+        else:
+            logging.debug("token cache miss, key=%s" % key)
+            url, token, expires = self.authenticate()
+            expires = self.tokens.set("tk" + key, url, token, expires, self.cache)
+            self.credentials.set("cr" + key, self.key, expires, self.cache)
+        self.url, self.token = url, token
+        self.auth_token = token
+        return url, token
+
+    def authenticate(self):
+        """Returns the (url, token, expires) tuple from the auth service, expires can be None"""
+        # session, cert and cert_key are swiftclient >= 3.0
+        if self.auth_version in ("1", "1.0") and not getattr(self, "session", None):
+            return get_auth_1_0(self.authurl, self.user, self.key, self.snet,
+                                cacert=self.cacert,
+                                insecure=self.insecure,
+                                cert=getattr(self, "cert", None),
+                                cert_key=getattr(self, "cert_key", None),
+                                timeout=self.timeout)
+        url, token = super(ProxyConnection, self).get_auth()
+        return url, token, None
 
 def translate_objectstorage_error(fn):
     """
@@ -159,6 +408,14 @@ class ObjectStorageFD(object):
     split_size = 0
     storage_policy = None
     large_object_container_suffix = None
+    # HedgePolicy for the GET requests (None disables hedged reads)
+    hedging = None
+    # chunks of the object to read ahead in a thread (0 disables read ahead)
+    read_ahead = 0
+    # relay the data from the IOLoop of the data channel (see stream and attach)
+    evented = False
+    # (minimum, maximum) bytes of the chunks read, adapted to the throughput (None: the size of the first read)
+    chunk_sizes = None
 
     def _find_collisions(self):
         """Check if there are collisions with a renamed multi-part file"""
@@ -198,8 +455,9 @@ class ObjectStorageFD(object):
             else:
                 raise IOSError(ENOENT, "Failed to read object %s metadata." % self.name)
 
-    def __init__(self, connection, container, obj, mode):
+    def __init__(self, connection, container, obj, mode, listdir_cache=None):
         self.conn = connection
+        self.listdir_cache = listdir_cache
         self.container = container
         self.name = obj
         self.mode = mode
@@ -219,6 +477,14 @@ class ObjectStorageFD(object):
         self.slo_manifest = dict()
 
         self.obj = None
+        # HTTP connection of a hedged read
+        self.obj_conn = None
+        # IOLoop sending the written data and callback when it's sent
+        self.ioloop = None
+        self.on_drain = None
+        self.sizer = None
+        if self.chunk_sizes is not None and 'r' in mode:
+            self.sizer = ChunkSizer(*self.chunk_sizes)
 
         # this is only used by `seek`, so we delay the HEAD request until is required
         self.size = None
@@ -281,7 +547,8 @@ class ObjectStorageFD(object):
                         self.conn.put_container(self.large_object_container, headers=self.headers)
                     except ClientException, e:
                         logging.error("Failed to create container %s: %s" % (self.large_object_container, e.http_reason))
-                        sys.exit(1)
+                        # don't exit, the process may serve other sessions
+                        raise IOSError(EIO, "Failed to create container %s" % self.large_object_container)
 
         def copy_task(conn, container, name, part_name, part_base_name):
             # open a new connection
@@ -339,7 +606,7 @@ class ObjectStorageFD(object):
         except ClientException as ex:
             logging.error("Failed to store the manifest %s: %s" % (self.name, ex.http_reason))
             self.delete_orphaned_segments(self.part_base_name)
-            sys.exit(1)
+            raise IOSError(EIO, "Failed to store the manifest %s" % self.name)
 
     def delete_orphaned_segments(self, prefix=None):
         container = None
@@ -350,14 +617,16 @@ class ObjectStorageFD(object):
             logging.debug("searching for orphaned segments on container %s with prefix %s" % (self.large_object_container, prefix))
             _, objects = self.conn.get_container(self.large_object_container, prefix=prefix)
 
-        for obj in objects:
+        def delete(conn, obj):
             if prefix is None:
                 _, container, name = obj['name'].split('/', 2)
             else:
                 container = self.large_object_container
                 name = obj['name']
             logging.debug("deleting orphaned segment: %s/%s" % (container, name))
-            self.conn.delete_object(container, name)
+            conn.delete_object(container, name)
+
+        self.conn.map(delete, objects)
 
 
     @translate_objectstorage_error
@@ -365,10 +634,13 @@ class ObjectStorageFD(object):
         """Write data to the object."""
         if 'r' in self.mode:
             raise IOSError(EPERM, "File is opened for read")
+        self.total_size += len(data)
 
         # large file support
         if self.split_size:
             # data can be of any size, so we need to split it in split_size chunks
+            # (views of data, so it's not copied)
+            view = memoryview(data)
             offs = 0
             while offs < len(data):
                 if self.part_size + len(data) - offs > self.split_size:
@@ -386,7 +658,9 @@ class ObjectStorageFD(object):
                     else:
                         self.obj = ChunkObject(self.conn, self.container, self.part_name,
                                                content_type=self.content_type, reuse_token=False)
-                self.obj.send_chunk(data[offs:offs+current_size])
+                    if self.ioloop is not None:
+                        self.obj.attach(self.ioloop, self.on_drain)
+                self.obj.send_chunk(view[offs:offs+current_size])
                 offs += current_size
                 if self.part_size == self.split_size:
                     logging.debug("current size is %r, split_file is %r" % (self.part_size, self.split_size))
@@ -400,35 +674,105 @@ class ObjectStorageFD(object):
         else:
             self.obj.send_chunk(data)
 
+    def attach(self, ioloop, on_drain):
+        """
+        Send the written data from ioloop, so write doesn't block.
+
+        on_drain is called when the data waiting to be sent is low. Returns
+        False if the transfer is not evented.
+        """
+        if not self.evented or 'r' in self.mode:
+            return False
+        self.ioloop = ioloop
+        self.on_drain = on_drain
+        if self.obj is not None:
+            self.obj.attach(ioloop, on_drain)
+        return True
+
+    def backlog(self):
+        """Returns the written bytes waiting to be sent"""
+        if self.ioloop is None or self.obj is None:
+            return 0
+        return self.obj.backlog()
+
+    def update_listdir_cache(self, stored):
+        """Update the listing cache with the stored object, or flush it if the store failed"""
+        path = "/%s/%s" % (self.container, self.name)
+        if not stored or (self.part and self.large_object_container is None):
+            # the segments are listed in the same container
+            self.listdir_cache.flush(posixpath.dirname(path))
+        else:
+            self.listdir_cache.update_entry(path, dict(bytes=self.total_size,
+                                                       content_type=self.content_type or "application/octet-stream"))
+
     @translate_objectstorage_error
     def close(self):
         """Close the object and finish the data transfer."""
         if 'r' not in self.mode:
-            if self.pending_copy_task:
-                logging.debug("waiting for a pending copy task...")
-                self.pending_copy_task.join()
-                logging.debug("wait is over")
-                if self.pending_copy_task.exitcode != 0:
-                    # Cleanup orphaned segments.
-                    # We can only use prefix mode here since manifest has not been uploaded yet.
-                    if self.large_object_container is not None:
-                        self.delete_orphaned_segments(self.part_base_name)
-                    raise IOSError(EIO, 'Failed to store the file')
-            if self.obj is not None:
-                self.obj.finish_chunk()
-            # Cleanup outdated segments
-            if self.large_object_container is not None:
-                if self.part > 0:
-                    self.upload_manifest()
-                if self.x_object_manifest is not None:
-                    prefix = self.x_object_manifest.split("/", 1)[1]
-                    self.delete_orphaned_segments(prefix)
-                elif self.slo_manifest:
-                    self.delete_orphaned_segments()
+            try:
+                self._finish_write()
+            except:
+                if self.obj is not None:
+                    # the PUT may be left unfinished
+                    self.obj.close()
+                if self.listdir_cache is not None:
+                    self.update_listdir_cache(False)
+                raise
+            if self.listdir_cache is not None:
+                self.update_listdir_cache(True)
+        elif self.obj is not None:
+            # don't reuse a connection with a response partially read
+            self.obj.close()
+        if self.obj_conn is not None:
+            self.conn.release_http_connection(self.obj_conn)
+            self.obj_conn = None
         self.obj = None
         self.closed = True
         self.conn.close()
 
+    def _finish_write(self):
+        """Finish storing the object"""
+        if self.pending_copy_task:
+            logging.debug("waiting for a pending copy task...")
+            self.pending_copy_task.join()
+            logging.debug("wait is over")
+            if self.pending_copy_task.exitcode != 0:
+                # Cleanup orphaned segments.
+                # We can only use prefix mode here since manifest has not been uploaded yet.
+                if self.large_object_container is not None:
+                    self.delete_orphaned_segments(self.part_base_name)
+                raise IOSError(EIO, 'Failed to store the file')
+        if self.obj is not None:
+            self.obj.finish_chunk()
+        # Cleanup outdated segments
+        if self.large_object_container is not None:
+            if self.part > 0:
+                self.upload_manifest()
+            if self.x_object_manifest is not None:
+                prefix = self.x_object_manifest.split("/", 1)[1]
+                self.delete_orphaned_segments(prefix)
+            elif self.slo_manifest:
+                self.delete_orphaned_segments()
+
+    @translate_objectstorage_error
+    def stream(self, dtp):
+        """
+        Send the object to the data channel dtp from its IOLoop.
+
+        Returns the ObjectStream, or None if the transfer is not evented and
+        the object must be read with read. If the request fails before
+        sending any data, dtp falls back to read.
+        """
+        if not self.evented or 'r' not in self.mode or self.obj is not None:
+            return None
+        if not self.conn.url or not self.conn.token:
+            self.conn.url, self.conn.token = self.conn.get_auth()
+        stream = ObjectStream(self.conn, self.container, self.name, self.total_size)
+        if not stream.start(dtp):
+            return None
+        self.obj = stream
+        return stream
+
     @translate_objectstorage_error
     def read(self, size=65536):
         """
@@ -438,11 +782,21 @@ class ObjectStorageFD(object):
 
         NB: It uses the size passed into the first call for all subsequent calls.
         """
+        if isinstance(self.obj, ObjectStream):
+            # the evented request failed
+            self.obj = None
+        if self.sizer is not None:
+            size = self.sizer.size
         if self.obj is None:
             headers = { }
             if self.total_size > 0:
                 headers["Range"] = "bytes=%d-" % self.total_size
-            _, self.obj = self.conn.get_object(self.container, self.name, resp_chunk_size=size, headers=headers)
+            if self.hedging is not None:
+                self._hedged_get(size, headers)
+            else:
+                _, self.obj = self.conn.get_object(self.container, self.name, resp_chunk_size=size, headers=headers)
+            if self.read_ahead:
+                self.obj = ReadAhead(self.obj, self.read_ahead)
 
         logging.debug("read size=%r, total_size=%r (range_from: %s)" % (size,
                 self.total_size, self.total_size))
@@ -452,8 +806,38 @@ class ObjectStorageFD(object):
             self.total_size += len(buff)
         except StopIteration:
             return ""
-        else:
-            return buff
+        if self.sizer is not None and self.sizer.update(len(buff)):
+            # the next chunks are read with the new size
+            body = getattr(self.obj, "iterator", self.obj)
+            if hasattr(body, "chunk_size"):
+                body.chunk_size = self.sizer.size
+        return buff
+
+    def _hedged_get(self, size, headers):
+        """
+        Get the object with hedged requests.
+
+        Falls back to a regular request if the token is rejected, so it's
+        authenticated again.
+        """
+        if not self.conn.url or not self.conn.token:
+            self.conn.url, self.conn.token = self.conn.get_auth()
+
+        def request(hedge):
+            return self.conn.get_object_once(self.container, self.name, resp_chunk_size=size, headers=dict(headers))
+
+        def cleanup(result):
+            _, body, http_conn = result
+            body.close()
+            self.conn.release_http_connection(http_conn)
+
+        try:
+            _, self.obj, self.obj_conn = hedged(self.hedging, request, cleanup)
+        except ClientException, e:
+            if e.http_status != 401:
+                raise
+            self.conn.token = None
+            _, self.obj = self.conn.get_object(self.container, self.name, resp_chunk_size=size, headers=headers)
 
     @translate_objectstorage_error
     def seek(self, offset, whence=None):
@@ -487,8 +871,13 @@ class ObjectStorageFD(object):
 
             # we need to start over after a seek call
             if self.obj is not None:
+                if isinstance(self.obj, ReadAhead):
+                    self.obj.close()
                 del self.obj # GC the generator
                 self.obj = None
+            if self.obj_conn is not None:
+                self.obj_conn[1].request_session.close()
+                self.obj_conn = None
             self.total_size = offs
         else:
             raise IOSError(EPERM, "Seek not available for write operations")
@@ -508,6 +897,16 @@ def unserialize(js):
     """Unserialize a JSON object into a cache dict."""
     return dict(((smart_str(key), os.stat_result(value)) for key, value in json.loads(js).iteritems()))
 
+def meta_to_object(meta):
+    """Convert the headers of an object into a listing object."""
+    last_modified = parsedate(meta.get("last-modified", ""))
+    if last_modified:
+        last_modified = time.strftime("%Y-%m-%dT%H:%M:%S", last_modified)
+    return dict(last_modified=last_modified,
+                content_type=meta.get("content-type", "").split(";")[0].strip(),
+                bytes=int(meta.get("content-length", 0)),
+                )
+
 class ListDirCache(object):
     """
     Cache for listdir.
@@ -519,47 +918,262 @@ class ListDirCache(object):
     own caching here to avoid the stat calls each making a connection.
     """
     MAX_CACHE_TIME = 10         # seconds to cache the listdir for
-    MIN_COMPRESS_LEN = 4096     # min length in bytes to compress cache entries
-    memcache = None
+    # cache backend shared by all the sessions in the process
+    backend = None
+    backend_lock = threading.Lock()
+    # directories larger than this are stat'ed with point lookups (0 disables)
+    point_lookup_threshold = 10000
+    # max objects in a subtree to prefetch its directories (0 disables)
+    prefetch_max_objects = 0
+    # directory for the persistent metadata index (None disables)
+    index_path = None
+    index_max_age = 300         # seconds before a indexed listing is refreshed
+    index_refresh_pages = 1     # listing pages to refresh per stale listdir
+    # seconds to keep the changes made in the overlay (0 disables)
+    overlay_ttl = 60
+    # share the overlay with the other sessions of the account using the cache backend
+    overlay_shared = False
+    OVERLAY_CLOCK_SKEW = 60     # seconds of difference allowed between our clock and the storage's
+    OVERLAY_MAX_CHANGES = 1000  # changes kept per directory
 
     def __init__(self, cffs):
         self.cffs = cffs
         self.path = None
         self.cache = {}
         self.when = time.time()
-
-        if self.cffs.memcache_hosts and ListDirCache.memcache is None:
-            logging.debug("connecting to memcache %r" % self.cffs.memcache_hosts)
-            ListDirCache.memcache = memcache.Client(self.cffs.memcache_hosts)
+        # known number of entries per directory and objects per container,
+        # used to choose between a point lookup and a full listing
+        self.sizes = {}
+        self.container_counts = {}
+        # directories filled by a subtree listing (local cache only)
+        self.prefetched = {}
+        self.unsplittable = set()
+        self._index = None
+        # recent changes indexed by directory and name: (expires, stat_info or None if removed)
+        self.overlay = {}
+
+        with ListDirCache.backend_lock:
+            if ListDirCache.backend is None:
+                backend = self.cffs.cache_backend
+                if backend is None and self.cffs.memcache_hosts:
+                    backend = 'memcache'
+                ListDirCache.backend = create_cache(backend, memcache_hosts=self.cffs.memcache_hosts,
+                                                    **self.cffs.cache_options)
 
     @property
     def conn(self):
         """Connection to the storage."""
         return self.cffs.conn
 
+    @property
+    def index(self):
+        """Persistent metadata index of the account, or None if not enabled."""
+        if self._index is None and self.index_path:
+            filename = os.path.join(self.index_path, "%s.db" % self.key_base())
+            self._index = MetadataIndex(filename, self.index_max_age)
+        return self._index
+
+    def key_base(self):
+        """Returns the part of the keys identifying the user account."""
+        if not hasattr(self, "_key_base"):
+            tenant_name = self.cffs.tenant_name or "-"
+            self._key_base = md5("%s%s%s" % (self.cffs.authurl, self.cffs.username, tenant_name)).hexdigest()
+        return self._key_base
+
     def key(self, index):
         """Returns a key for a user distributed cache."""
         tenant_name = self.cffs.tenant_name or "-"
         logging.debug("cache key for %r" % [self.cffs.authurl, self.cffs.username, tenant_name, index])
-        if not hasattr(self, "_key_base"):
-            self._key_base = md5("%s%s%s" % (self.cffs.authurl, self.cffs.username, tenant_name)).hexdigest()
-        return "%s-%s" % (self._key_base, md5(smart_str(index)).hexdigest())
+        return "%s-%s" % (self.key_base(), md5(smart_str(index)).hexdigest())
 
     def flush(self, path=None):
         """Flush the listdir cache."""
         logging.debug("cache flush, current path: %s request: %s" % (self.path, path))
-        if self.memcache:
+        if self.backend:
             if path is not None:
-                logging.debug("flushing memcache for %r" % path)
-                self.memcache.delete(self.key(path))
+                logging.debug("flushing cache for %r" % path)
+                self.backend.delete(self.key(path))
                 if self.path == path:
                     self.cache = None
             elif self.path is not None:
-                logging.debug("flushing memcache for %r" % self.path)
-                self.memcache.delete(self.key(path))
+                logging.debug("flushing cache for %r" % self.path)
+                self.backend.delete(self.key(path))
                 self.cache = None
         else:
             self.cache = None
+        if path is not None:
+            self.prefetched.pop(smart_str(path), None)
+            if self.index is not None and path != "/":
+                container, obj = parse_fspath(path)
+                self.index.invalidate(smart_unicode(container), smart_unicode(obj))
+
+    def update_entry(self, path, obj=None):
+        """
+        Update the entry of path in the cached listing of its directory.
+
+        The entry is added (or replaced) using obj, a listing object, or
+        removed if obj is None. The listing is patched wherever it is cached
+        so a change doesn't require listing the directory again.
+        """
+        path = path.rstrip("/")
+        directory, leaf = posixpath.split(path)
+        logging.debug("cache update %r in %r: %r" % (leaf, directory, obj))
+        leaf = smart_str(leaf)
+        stat_info = None
+        if obj is not None:
+            obj = dict(obj)
+            if not obj.get('last_modified'):
+                obj['last_modified'] = time.strftime("%Y-%m-%dT%H:%M:%S.000000", time.gmtime())
+            stat_info = self._make_stat(**obj)
+        self.overlay_store(path, stat_info)
+
+        def patch(cache):
+            if obj is None:
+                cache.pop(leaf, None)
+            else:
+                cache[leaf] = stat_info
+            self.sizes[smart_str(directory)] = len(cache)
+
+        if self.cache is not None and self.path == directory:
+            patch(self.cache)
+        if self.backend:
+            key = self.key(directory)
+            cache = self.backend.get(key)
+            if cache:
+                cache = unserialize(cache)
+                patch(cache)
+                if not self.backend.set(key, serialize(cache), self.MAX_CACHE_TIME):
+                    logging.warning("Failed to store the cache")
+                    self.backend.delete(key)
+        prefetched = self.get_prefetched(directory)
+        if prefetched:
+            patch(prefetched[1])
+        if self.index is not None and directory != "/":
+            container, name = parse_fspath(path)
+            container, name = smart_unicode(container), smart_unicode(name)
+            if obj is None:
+                self.index.remove(container, posixpath.dirname(name), name)
+            else:
+                obj['name'] = name
+                self.index.update(container, posixpath.dirname(name), obj)
+
+    def load_overlay(self, directory):
+        """Returns the overlay of recent changes of directory by name, the shared one if enabled"""
+        directory = smart_str(directory)
+        if not (self.overlay_shared and self.backend):
+            return self.overlay.get(directory, {})
+        overlay = self.backend.get(self.key("overlay:%s" % directory))
+        if not overlay:
+            return {}
+        return dict((smart_str(name), (expires, stat_info if stat_info is None else os.stat_result(stat_info)))
+                    for name, (expires, stat_info) in json.loads(overlay).iteritems())
+
+    def save_overlay(self, directory, overlay):
+        """Store the overlay of directory, removing the expired changes (and the oldest ones if there are too many)"""
+        directory = smart_str(directory)
+        now = time.time()
+        for name, (expires, _) in overlay.items():
+            if expires < now:
+                del overlay[name]
+        if len(overlay) > self.OVERLAY_MAX_CHANGES:
+            for name in sorted(overlay, key=lambda name: overlay[name][0])[:-self.OVERLAY_MAX_CHANGES]:
+                del overlay[name]
+        if self.overlay_shared and self.backend:
+            key = self.key("overlay:%s" % directory)
+            if not overlay:
+                self.backend.delete(key)
+            elif not self.backend.set(key, serialize(overlay), self.overlay_ttl):
+                logging.warning("Failed to store the overlay")
+        elif overlay:
+            self.overlay[directory] = overlay
+        else:
+            self.overlay.pop(directory, None)
+
+    def overlay_store(self, path, stat_info):
+        """
+        Add a change to the overlay.
+
+        The change masks the directory listings until they include it or the
+        overlay TTL expires. stat_info is None if path was removed.
+        """
+        if not self.overlay_ttl:
+            return
+        directory, name = posixpath.split(path.rstrip("/"))
+        overlay = self.load_overlay(directory)
+        overlay[smart_str(name)] = (time.time() + self.overlay_ttl, stat_info)
+        self.save_overlay(directory, overlay)
+
+    def overlay_entry(self, path):
+        """Returns the (expires, stat_info) change of path in the overlay, or None"""
+        if not self.overlay_ttl:
+            return None
+        directory, name = posixpath.split(path)
+        entry = self.load_overlay(directory).get(smart_str(name))
+        if entry is None or entry[0] < time.time():
+            return None
+        logging.debug("overlay hit %r" % path)
+        return entry
+
+    def apply_overlay(self, directory, cache):
+        """
+        Apply the changes in the overlay to the listing of directory.
+
+        The changes already included in the listing are removed from the
+        overlay.
+        """
+        if not self.overlay_ttl:
+            return
+        overlay = self.load_overlay(directory)
+        changed = False
+        now = time.time()
+        for leaf, (expires, stat_info) in overlay.items():
+            if expires < now:
+                continue
+            listed = cache.get(leaf)
+            if stat_info is None:
+                caught_up = listed is None
+            else:
+                caught_up = listed is not None and (stat.S_ISDIR(listed.st_mode) or
+                                                    (listed.st_size == stat_info.st_size and
+                                                     listed.st_mtime >= stat_info.st_mtime - self.OVERLAY_CLOCK_SKEW))
+            if caught_up:
+                del overlay[leaf]
+                changed = True
+            elif stat_info is None:
+                logging.debug("overlay hides %r" % posixpath.join(directory, leaf))
+                del cache[leaf]
+            else:
+                logging.debug("overlay adds %r" % posixpath.join(directory, leaf))
+                cache[leaf] = stat_info
+        if changed:
+            self.save_overlay(directory, overlay)
+
+    def store_prefetched(self, caches):
+        """Store the caches of a subtree listing, indexed by directory path"""
+        now = time.time()
+        for path, when_cache in self.prefetched.items():
+            if now - when_cache[0] >= self.MAX_CACHE_TIME:
+                del self.prefetched[path]
+        for path, cache in caches.iteritems():
+            self.apply_overlay(path, cache)
+            self.sizes[path] = len(cache)
+            if self.backend:
+                if not self.backend.set(self.key(path), serialize(cache), self.MAX_CACHE_TIME):
+                    logging.warning("Failed to store the cache")
+            else:
+                self.prefetched[path] = (now, cache)
+        logging.debug("prefetched %r" % sorted(caches.keys()))
+
+    def get_prefetched(self, path):
+        """Returns a (when, cache) tuple if path was prefetched recently or None"""
+        when_cache = self.prefetched.get(smart_str(path))
+        if when_cache is None:
+            return None
+        if time.time() - when_cache[0] >= self.MAX_CACHE_TIME:
+            del self.prefetched[smart_str(path)]
+            return None
+        logging.debug("prefetch hit %r" % path)
+        return when_cache
 
     def _make_stat(self, last_modified=None, content_type="application/directory", count=1, bytes=0, **kwargs):
         """Make a stat object from the parameters passed in from"""
@@ -583,20 +1197,20 @@ class ListDirCache(object):
         #(mode, ino, dev, nlink, uid, gid, size, atime, mtime, ctime)
         return os.stat_result((mode, 0L, 0L, count, 0, 0, bytes, mtime, mtime, mtime))
 
-    def listdir_container(self, cache, container, path=""):
-        """Fills cache with the list dir of the container"""
-        container = smart_str(container)
-        path = smart_str(path)
-        logging.debug("listdir container %r path %r" % (container, path))
-        if path:
-            prefix = path.rstrip("/")+"/"
-        else:
-            prefix = None
-        _, objects = self.conn.get_container(container, prefix=prefix, delimiter="/")
+    def get_listing(self, container, prefix=None, delimiter="/", max_objects=None):
+        """
+        Returns the listing of the container.
+
+        The 10000 objects limit is overridden with markers. If max_objects is
+        provided and the listing has more objects, None is returned.
+        """
+        _, objects = self.conn.get_container(container, prefix=prefix, delimiter=delimiter)
 
         # override 10000 objects limit with markers
         nbobjects = len(objects)
         while nbobjects >= 10000:
+            if max_objects is not None and len(objects) > max_objects:
+                break
             # get last object as a marker
             lastobject = objects[-1]
             if 'subdir' in lastobject:
@@ -605,7 +1219,7 @@ class ListDirCache(object):
             else:
                 lastobjectname = lastobject['name']
             # get a new list with the marker
-            _, newobjects = self.conn.get_container(container, prefix=prefix, delimiter="/", marker=lastobjectname)
+            _, newobjects = self.conn.get_container(container, prefix=prefix, delimiter=delimiter, marker=lastobjectname)
             # get the new list length
             nbobjects = len(newobjects)
             logging.debug("number of objects after marker %s: %s" % (lastobjectname, nbobjects))
@@ -613,9 +1227,140 @@ class ListDirCache(object):
             objects.extend(newobjects)
         logging.debug("total number of objects %s:" % len(objects))
 
+        if max_objects is not None and len(objects) > max_objects:
+            logging.debug("listing is larger than %s objects" % max_objects)
+            return None
+        return objects
+
+    def listdir_container(self, cache, container, path=""):
+        """Fills cache with the list dir of the container"""
+        container = smart_str(container)
+        path = smart_str(path)
+        logging.debug("listdir container %r path %r" % (container, path))
+        if path:
+            prefix = path.rstrip("/")+"/"
+        else:
+            prefix = None
+        if self.index is not None:
+            objects = self.index_listing(container, path, prefix)
+        else:
+            objects = self.get_listing(container, prefix=prefix)
+        self.fill_cache(cache, container, path, objects)
+
+    def index_listing(self, container, path, prefix):
+        """
+        Returns the listing of the container from the metadata index.
+
+        A directory that hasn't been indexed is listed completely, one that is
+        stale gets index_refresh_pages listing pages refreshed before being
+        served. Refreshes continue from the last marker stored.
+        """
+        ucontainer, upath = smart_unicode(container), smart_unicode(path.rstrip("/"))
+        if self.index.is_fresh(ucontainer, upath):
+            logging.debug("index hit %r/%r" % (container, path))
+            return self.index.listing(ucontainer, upath)
+
+        if self.index.is_complete(ucontainer, upath):
+            pages = self.index_refresh_pages
+        else:
+            pages = None
+        logging.debug("index refresh %r/%r, pages: %s" % (container, path, pages))
+
+        marker = self.index.begin(ucontainer, upath)
+        while pages is None or pages > 0:
+            _, objects = self.conn.get_container(container, prefix=prefix, delimiter="/", marker=smart_str(marker))
+            self.check_manifests(container, objects)
+            if objects:
+                lastobject = objects[-1]
+                marker = lastobject['subdir'].rstrip("/") if 'subdir' in lastobject else lastobject['name']
+            done = len(objects) < 10000
+            self.index.store(ucontainer, upath, objects, marker, done)
+            if done:
+                break
+            if pages is not None:
+                pages -= 1
+        return self.index.listing(ucontainer, upath)
+
+    def check_manifests(self, container, objects):
+        """
+        Check if the listing objects are manifests, updating their size and hash.
+
+        The manifest (or None) is kept in the objects so they aren't checked
+        again. The HEAD requests run concurrently if there's a storage engine.
+        """
+        candidates = []
+        for obj in objects:
+            if 'subdir' in obj or 'manifest' in obj:
+                continue
+            obj['manifest'] = None
+            if obj.get('bytes') == 0 and obj.get('hash') and obj.get('content_type') != 'application/directory':
+                # if it's a 0 byte file, has a hash and is not a directory, we make an extra call
+                # to check if it's a manifest file and retrieve the real size / hash
+                candidates.append(obj)
+        manifest_objs = self.conn.map(lambda conn, obj: conn.head_object(container, obj['name']), candidates)
+        for obj, manifest_obj in zip(candidates, manifest_objs):
+            logging.debug("possible manifest file: %r" % manifest_obj)
+            if 'x-object-manifest' in manifest_obj:
+                logging.debug("manifest found: %s" % manifest_obj['x-object-manifest'])
+                obj['manifest'] = manifest_obj['x-object-manifest']
+                obj['hash'] = manifest_obj['etag']
+                obj['bytes'] = int(manifest_obj['content-length'])
+
+    def listdir_subtree(self, container, path=""):
+        """
+        Returns the list dirs of the container's subtree under path.
+
+        A single listing without delimiter is split in a dict of caches
+        indexed by directory path, including the virtual directories.
+        Returns None if the subtree has more than prefetch_max_objects
+        objects or can't be split.
+        """
+        container = smart_str(container)
+        # listing names are unicode
+        path = smart_unicode(smart_str(path), "utf-8").rstrip("/")
+        logging.debug("listdir subtree container %r path %r" % (container, path))
+        if path:
+            prefix = smart_str(path)+"/"
+        else:
+            prefix = None
+        objects = self.get_listing(container, prefix=prefix, delimiter=None,
+                                   max_objects=self.prefetch_max_objects)
+        if objects is None:
+            return None
+
+        # objects per directory in listing order, as a listing with delimiter would return them
+        listings = { path: [] }
+        subdirs = set()
+        for obj in objects:
+            name = obj['name']
+            if name.endswith("/") or "//" in name:
+                # empty path components can't be split like swift does
+                logging.debug("can't split subtree listing, found %r" % name)
+                return None
+            directory = posixpath.dirname(name)
+            listings.setdefault(directory, []).append(obj)
+            # add the virtual directories up to the subtree root
+            while directory != path and directory not in subdirs:
+                subdirs.add(directory)
+                parent = posixpath.dirname(directory)
+                listings.setdefault(parent, []).append({ 'subdir': directory+"/" })
+                directory = parent
+
+        caches = {}
+        for directory, directory_objects in listings.iteritems():
+            cache = {}
+            directory = smart_str(directory)
+            self.fill_cache(cache, container, directory, directory_objects)
+            caches[posixpath.join("/", container, directory).rstrip("/")] = cache
+        logging.debug("subtree split in %s directories" % len(caches))
+        return caches
+
+    def fill_cache(self, cache, container, path, objects):
+        """Fills cache with the objects of a listing of path in the container"""
         if self.cffs.hide_part_dir:
             manifests = {}
 
+        self.check_manifests(container, objects)
         for obj in objects:
             # {u'bytes': 4820,  u'content_type': '...',  u'hash': u'...',  u'last_modified': u'2008-11-05T00:56:00.406565',  u'name': u'new_object'},
             if 'subdir' in obj:
@@ -633,17 +1378,9 @@ class ListDirCache(object):
                 if self.cffs.hide_part_dir and obj['name'] in manifests:
                     logging.debug("Not adding subdir %s which would overwrite manifest" % obj['name'])
                     continue
-            elif obj.get('bytes') == 0 and obj.get('hash') and obj.get('content_type') != 'application/directory':
-                # if it's a 0 byte file, has a hash and is not a directory, we make an extra call
-                # to check if it's a manifest file and retrieve the real size / hash
-                manifest_obj = self.conn.head_object(container, obj['name'])
-                logging.debug("possible manifest file: %r" % manifest_obj)
-                if 'x-object-manifest' in manifest_obj:
-                    if self.cffs.hide_part_dir:
-                        manifests[obj['name']] = smart_unicode(unquote(manifest_obj['x-object-manifest']), "utf-8")
-                    logging.debug("manifest found: %s" % manifest_obj['x-object-manifest'])
-                    obj['hash'] = manifest_obj['etag']
-                    obj['bytes'] = int(manifest_obj['content-length'])
+            else:
+                if self.cffs.hide_part_dir and obj['manifest']:
+                    manifests[obj['name']] = smart_unicode(unquote(obj['manifest']), "utf-8")
             obj['count'] = 1
             # Keep all names in utf-8, just like the filesystem
             name = posixpath.basename(obj['name']).encode("utf-8")
@@ -671,9 +1408,11 @@ class ListDirCache(object):
             # list can raise a ResponseError, but still access to the
             # the containers we have permissions to access to
             return
-        for obj in objects:
+        if self.cffs.storage_policy is not None:
+            metas = self.conn.map(lambda conn, obj: conn.head_container(obj['name']), objects)
+        for index, obj in enumerate(objects):
             if self.cffs.storage_policy is not None:
-                meta = self.conn.head_container(obj['name'])
+                meta = metas[index]
                 if meta['x-storage-policy'] != self.cffs.storage_policy:
                     logging.debug("blacklisting container {} ({})".format(obj['name'], meta['x-storage-policy']))
                     continue
@@ -687,28 +1426,46 @@ class ListDirCache(object):
         path = path.rstrip("/") or "/"
         logging.debug("listdir %r" % path)
         cache = None
-        if self.memcache:
-            cache = self.memcache.get(self.key(path))
+        if self.backend:
+            cache = self.backend.get(self.key(path))
             if cache:
                 cache = unserialize(cache)
-                logging.debug("memcache hit %r" % self.key(path))
+                logging.debug("cache hit %r" % self.key(path))
             else:
-                logging.debug("memcache miss %r" % self.key(path))
-        if not cache:
+                logging.debug("cache miss %r" % self.key(path))
+        when = time.time()
+        prefetched = not cache and self.get_prefetched(path)
+        if prefetched:
+            when, cache = prefetched
+            self.apply_overlay(path, cache)
+        elif cache:
+            self.apply_overlay(path, cache)
+        else:
             cache = {}
             if path == "/":
                 self.listdir_root(cache)
             else:
                 container, obj = parse_fspath(path)
-                self.listdir_container(cache, container, obj)
-            if self.memcache:
-                if self.memcache.set(self.key(path), serialize(cache), self.MAX_CACHE_TIME, min_compress_len=self.MIN_COMPRESS_LEN):
-                    logging.debug("memcache stored %r" % self.key(path))
+                caches = None
+                if self.prefetch_max_objects and smart_str(path) not in self.unsplittable:
+                    caches = self.listdir_subtree(container, obj)
+                    if caches is None:
+                        self.unsplittable.add(smart_str(path))
+                if caches is None:
+                    self.listdir_container(cache, container, obj)
+                else:
+                    cache = caches.pop(smart_str(path))
+                    self.store_prefetched(caches)
+            self.apply_overlay(path, cache)
+            if self.backend:
+                if self.backend.set(self.key(path), serialize(cache), self.MAX_CACHE_TIME):
+                    logging.debug("cache stored %r" % self.key(path))
                 else:
                     logging.warning("Failed to store the cache")
         self.cache = cache
         self.path = path
-        self.when = time.time()
+        self.when = when
+        self.sizes[smart_str(path)] = len(cache)
         leaves = sorted(self.cache.keys())
         logging.debug(".. %r" % leaves)
         return leaves
@@ -726,18 +1483,106 @@ class ListDirCache(object):
     def valid(self, path):
         """Check the cache is valid for the container and directory path"""
         if not self.cache or self.path != path:
-            if self.memcache:
-                cache = self.memcache.get(self.key(path))
+            if self.backend:
+                cache = self.backend.get(self.key(path))
                 if cache:
                     cache = unserialize(cache)
-                    logging.debug("memcache hit %r" % self.key(path))
+                    logging.debug("cache hit %r" % self.key(path))
                     self.cache = cache
                     self.path = path
                     return True
+            prefetched = self.get_prefetched(path)
+            if prefetched:
+                self.when, self.cache = prefetched
+                self.path = path
+                return True
             return False
         age = time.time() - self.when
         return age < self.MAX_CACHE_TIME
 
+    def directory_size(self, directory):
+        """
+        Returns the number of entries in directory, or a guess of it.
+
+        The size of a directory we have listed is known, otherwise the object
+        count of its container is used as an upper bound. Returns None if the
+        size can't be determined.
+        """
+        if smart_str(directory) in self.sizes:
+            return self.sizes[smart_str(directory)]
+        container, _ = parse_fspath(directory)
+        if container not in self.container_counts:
+            if self.path == "/" and self.cache and smart_str(container) in self.cache:
+                count = self.cache[smart_str(container)].st_nlink
+            else:
+                try:
+                    meta = self.conn.head_container(container)
+                    count = int(meta["x-container-object-count"])
+                except (ClientException, KeyError, ValueError):
+                    return None
+            self.container_counts[container] = count
+        return self.container_counts[container]
+
+    def use_point_lookup(self, directory):
+        """Check if stat in directory should avoid listing the directory"""
+        if not self.point_lookup_threshold or directory == "/":
+            return False
+        size = self.directory_size(directory)
+        logging.debug("directory size for %r: %r" % (directory, size))
+        return size is not None and size > self.point_lookup_threshold
+
+    def point_stat(self, path):
+        """
+        Returns an os.stat_result for path without listing its directory.
+
+        A HEAD request resolves objects and a prefix listing limited to one
+        entry resolves virtual directories. Returns None if the lookup can't
+        give an answer consistent with the directory listing.
+
+        May raise IOSError.
+        """
+        container, obj = parse_fspath(path)
+        logging.debug("point lookup container %r object %r" % (container, obj))
+        try:
+            meta = self.conn.head_object(container, obj)
+        except ClientException, e:
+            if e.http_status != 404:
+                raise
+        else:
+            return self._make_stat(**meta_to_object(meta))
+
+        if self.cffs.hide_part_dir:
+            # the listing may hide this directory, can't tell without it
+            return None
+
+        _, objects = self.conn.get_container(smart_str(container), prefix=smart_str(obj)+"/",
+                                             delimiter="/", limit=1)
+        if not objects:
+            raise IOSError(ENOENT, 'No such file or directory %s' % obj)
+        return self._make_stat()
+
+    def index_stat(self, path):
+        """
+        Returns an os.stat_result for path from the metadata index.
+
+        Returns None if the listing of the directory in the index is not fresh
+        or path is not in it.
+        """
+        if self.cffs.hide_part_dir:
+            # the whole listing is required to hide the segments
+            return None
+        container, obj = parse_fspath(path)
+        container, obj = smart_unicode(container), smart_unicode(obj)
+        directory = posixpath.dirname(obj)
+        if not self.index.is_fresh(container, directory):
+            return None
+        found = self.index.lookup(container, directory, obj)
+        if found is None:
+            return None
+        cache = {}
+        self.fill_cache(cache, smart_str(container), smart_str(directory), [found])
+        return cache.values()[0]
+
     def stat(self, path, retry=1):
         """
         Returns an os.stat_result for path or raises IOSError.
@@ -748,8 +1593,26 @@ class ListDirCache(object):
         path = path.rstrip("/") or "/"
         logging.debug("stat path %r" % (path))
         directory, leaf = posixpath.split(path)
+        overlaid = path != "/" and self.overlay_entry(path)
+        if overlaid:
+            if overlaid[1] is None:
+                raise IOSError(ENOENT, 'No such file or directory %s' % leaf)
+            logging.debug("stat path (overlay): %r" % overlaid[1])
+            return overlaid[1]
+        valid = self.valid(directory)
+        if not valid and directory != "/" and self.index is not None:
+            stat_info = self.index_stat(path)
+            if stat_info is not None:
+                logging.debug("stat path (index): %r" % stat_info)
+                return stat_info
+        # Avoid listing large directories just to stat one of their entries
+        if not valid and path != "/" and self.use_point_lookup(directory):
+            stat_info = self.point_stat(path)
+            if stat_info is not None:
+                logging.debug("stat path (point lookup): %r" % stat_info)
+                return stat_info
         # Refresh the cache it if is old, or wrong
-        if not self.valid(directory):
+        if not valid:
             logging.debug("invalid cache for %r (path: %r)" % (directory, self.path))
             self.listdir(directory)
             # Bypass cache flush for this iteration since already done just above
@@ -797,6 +1660,9 @@ class ObjectStorageFS(object):
     of the same name.
     """
     memcache_hosts = None
+    # cache backend name (memcache if memcache_hosts is set) and its options
+    cache_backend = None
+    cache_options = {}
 
     @translate_objectstorage_error
     def __init__(self, username, api_key, authurl, keystone=None, hide_part_dir=False,
@@ -881,7 +1747,7 @@ class ObjectStorageFS(object):
                                             region_name=ks['region_name'],
                                             )
 
-        self.conn = ProxyConnection(self._listdir_cache.memcache,
+        self.conn = ProxyConnection(self._listdir_cache.backend,
                                     user=username,
                                     key=api_key,
                                     insecure=self.insecure,
@@ -930,9 +1796,8 @@ class ObjectStorageFS(object):
         """Open path with mode, raise IOError on error"""
         path = self.abspath(path)
         logging.debug("open %r mode %r" % (path, mode))
-        self._listdir_cache.flush(posixpath.dirname(path))
         container, obj = parse_fspath(path)
-        return ObjectStorageFD(self.conn, container, obj, mode)
+        return ObjectStorageFD(self.conn, container, obj, mode, self._listdir_cache)
 
     def chdir(self, path):
         """Change current directory, raise OSError on error"""
@@ -975,14 +1840,14 @@ class ObjectStorageFS(object):
         logging.debug("mkdir %r" % path)
         container, obj = parse_fspath(path)
         if obj:
-            self._listdir_cache.flush(posixpath.dirname(path))
             logging.debug("Making directory %r in %r" % (obj, container))
             self._container_exists(container)
             self.conn.put_object(container, obj, contents=None, content_type="application/directory", headers=self.headers)
+            self._listdir_cache.update_entry(path, dict(content_type="application/directory"))
         else:
-            self._listdir_cache.flush("/")
             logging.debug("Making container %r" % (container,))
             self.conn.put_container(container, headers=self.headers)
+            self._listdir_cache.update_entry(path, dict(count=0))
 
     @close_when_done
     @translate_objectstorage_error
@@ -1030,13 +1895,12 @@ class ObjectStorageFS(object):
             raise IOSError(ENOTEMPTY, "Directory not empty: %s" % path)
 
         if obj:
-            self._listdir_cache.flush(posixpath.dirname(path))
             logging.debug("Removing directory %r in %r" % (obj, container))
             self.conn.delete_object(container, obj)
         else:
-            self._listdir_cache.flush("/")
             logging.debug("Removing container %r" % (container,))
             self.conn.delete_container(container)
+        self._listdir_cache.update_entry(path)
 
     @close_when_done
     @translate_objectstorage_error
@@ -1064,7 +1928,7 @@ class ObjectStorageFS(object):
         elif 'x-static-large-object' in meta:
             query_string="multipart-manifest=delete"
         self.conn.delete_object(container, name, query_string=query_string)
-        self._listdir_cache.flush(posixpath.dirname(path))
+        self._listdir_cache.update_entry(path)
         return not name
 
     def _remove_path_folder_files(self, path):
@@ -1080,7 +1944,8 @@ class ObjectStorageFS(object):
         # Delete the old container first, raising error if not empty
         self.conn.delete_container(src_container_name)
         self.conn.put_container(dst_container_name, headers=self.headers)
-        self._listdir_cache.flush("/")
+        self._listdir_cache.update_entry("/" + src_container_name)
+        self._listdir_cache.update_entry("/" + dst_container_name, dict(count=0))
 
     @close_when_done
     @translate_objectstorage_error
@@ -1093,7 +1958,6 @@ class ObjectStorageFS(object):
         src = self.abspath(src)
         dst = self.abspath(dst)
         logging.debug("rename %r -> %r" % (src, dst))
-        self._listdir_cache.flush()
         # Check not renaming to itself
         if src == dst:
             logging.debug("Renaming %r to itself - doing nothing" % src)
@@ -1145,8 +2009,8 @@ class ObjectStorageFS(object):
                              contents=None, query_string=query_string)
         # Delete src
         self.conn.delete_object(src_container_name, src_path)
-        self._listdir_cache.flush(posixpath.dirname(src))
-        self._listdir_cache.flush(posixpath.dirname(dst))
+        self._listdir_cache.update_entry(src)
+        self._listdir_cache.update_entry(dst, meta_to_object(meta))
 
     def chmod(self, path, mode):
         """Change file/directory mode"""
@@ -1246,6 +2110,11 @@ class ObjectStorageFS(object):
         if self._listdir_cache:
             self._listdir_cache.flush()
 
+    @property
+    def cache(self):
+        """The cache backend, None if there's no cache"""
+        return self._listdir_cache.backend
+
     def get_user_by_uid(self, uid):
         """
         Return the username associated with user id.
@@ -0,0 +1,149 @@
+"""
+    Hedged requests to cut the tail latency of the object storage.
+
+A request that is slower than most of the previous ones is sent again, and
+the first response is used.
+"""
+
+import time
+import logging
+import threading
+from Queue import Queue, Empty
+from collections import deque
+
+__all__ = ['HedgePolicy', 'hedged']
+
+class HedgePolicy(object):
+    """
+    When to hedge a request, per process.
+
+    A request is hedged when it takes longer than the percentile of the
+    latency of the last samples requests (between min_delay and max_delay
+    seconds, default_delay until there are min_samples requests).
+
+    Every request adds budget hedges to a bucket of at most burst hedges,
+    and a request is only hedged if there's a hedge in the bucket, so the
+    hedges are at most budget of the requests.
+    """
+
+    def __init__(self, percentile=95, budget=0.1, burst=10, min_delay=0.05, max_delay=5,
+                 default_delay=0.5, samples=1000, min_samples=20):
+        if not 0 < percentile <= 100:
+            raise ValueError("Invalid percentile: %r" % percentile)
+        self.percentile = percentile
+        self.budget = budget
+        self.burst = burst
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.default_delay = default_delay
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+        self.samples = deque(maxlen=samples)
+        self.tokens = float(burst)
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def delay(self):
+        """Returns the seconds to wait before hedging a request"""
+        with self.lock:
+            if len(self.samples) < self.min_samples:
+                return self.default_delay
+            ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100.0))
+        return min(max(ordered[index], self.min_delay), self.max_delay)
+
+    def record(self, latency):
+        """Record the latency of a request"""
+        with self.lock:
+            self.samples.append(latency)
+
+    def start(self):
+        """A new request, add to the budget"""
+        with self.lock:
+            self.requests += 1
+            self.tokens = min(self.burst, self.tokens + self.budget)
+
+    def allow(self):
+        """Check if a request can be hedged, using the budget"""
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            self.hedged += 1
+            return True
+
+    def stats(self):
+        """Returns a dict with the hedging statistics"""
+        return dict(requests=self.requests,
+                    hedged=self.hedged,
+                    hedge_wins=self.hedge_wins,
+                    delay=self.delay(),
+                    )
+
+def hedged(policy, request, cleanup):
+    """
+    Call request(hedge) and return its result.
+
+    If there's no result after the policy delay, request(True) is called in
+    parallel (if the budget allows it) and the first successful result is
+    returned. cleanup(result) is called with the result that isn't used.
+
+    The exception of the first request is raised if all the requests fail.
+    """
+    lock = threading.Lock()
+    state = dict(done=False)
+    results = Queue()
+
+    def run(hedge):
+        start = time.time()
+        try:
+            result, error = request(hedge), None
+        except Exception, e:
+            result, error = None, e
+        else:
+            policy.record(time.time() - start)
+        with lock:
+            if not state["done"]:
+                results.put((hedge, result, error))
+                return
+        if error is None:
+            logging.debug("hedged request: discarding %s response" % ("hedge" if hedge else "first"))
+            cleanup(result)
+
+    policy.start()
+    thread = threading.Thread(target=run, args=(False,), name="ftpcloudfs-hedge")
+    thread.daemon = True
+    thread.start()
+    pending = 1
+    first_error = None
+    try:
+        hedge, result, error = results.get(True, policy.delay())
+    except Empty:
+        if policy.allow():
+            logging.debug("hedging request")
+            thread = threading.Thread(target=run, args=(True,), name="ftpcloudfs-hedge")
+            thread.daemon = True
+            thread.start()
+            pending += 1
+        hedge, result, error = results.get()
+    pending -= 1
+    while error is not None and pending:
+        first_error = first_error or (None if hedge else error)
+        hedge, result, error = results.get()
+        pending -= 1
+
+    with lock:
+        state["done"] = True
+    # a result may have been queued before done was set
+    while not results.empty():
+        _, extra, extra_error = results.get()
+        if extra_error is None:
+            cleanup(extra)
+
+    if error is not None:
+        raise first_error or error
+    if hedge:
+        with policy.lock:
+            policy.hedge_wins += 1
+    return result
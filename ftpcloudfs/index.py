@@ -0,0 +1,178 @@
+"""
+    Persistent metadata index for ObjectStorageFS.
+
+Keeps the container listings of an account in a local SQLite database so
+large directories don't need to be listed again from the object storage
+every time the cache expires.
+"""
+
+import time
+import logging
+import sqlite3
+
+__all__ = ['MetadataIndex']
+
+class MetadataIndex(object):
+    """
+    SQLite index of the directory listings of an account.
+
+    Every directory has a refresh generation. Listing pages are stored as
+    they are retrieved with the generation being refreshed and, once the
+    last page is stored, the entries of previous generations (objects that
+    are gone) are removed. The marker of the last stored page is kept so an
+    incomplete refresh continues where it was left.
+    """
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS directories (
+            container TEXT NOT NULL,
+            path TEXT NOT NULL,
+            generation INTEGER NOT NULL DEFAULT 0,
+            marker TEXT,
+            complete INTEGER NOT NULL DEFAULT 0,
+            refreshed REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (container, path))""",
+        """CREATE TABLE IF NOT EXISTS entries (
+            container TEXT NOT NULL,
+            path TEXT NOT NULL,
+            name TEXT NOT NULL,
+            subdir INTEGER NOT NULL DEFAULT 0,
+            bytes INTEGER,
+            content_type TEXT,
+            hash TEXT,
+            last_modified TEXT,
+            manifest TEXT,
+            generation INTEGER NOT NULL,
+            PRIMARY KEY (container, path, name))""",
+    )
+    FIELDS = ('name', 'subdir', 'bytes', 'content_type', 'hash', 'last_modified', 'manifest')
+
+    def __init__(self, filename, max_age=300):
+        self.filename = filename
+        self.max_age = max_age
+        logging.debug("opening metadata index %r" % filename)
+        self.db = sqlite3.connect(filename, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            for statement in self.SCHEMA:
+                self.db.execute(statement)
+
+    def close(self):
+        """Close the database"""
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def _directory(self, container, path):
+        """Returns the (generation, marker, complete, refreshed) tuple of a directory or None"""
+        return self.db.execute("SELECT generation, marker, complete, refreshed FROM directories "
+                               "WHERE container=? AND path=?", (container, path)).fetchone()
+
+    def is_complete(self, container, path):
+        """Check if there's a complete listing of the directory"""
+        directory = self._directory(container, path)
+        return directory is not None and directory[2] == 1
+
+    def is_fresh(self, container, path):
+        """Check if the listing of the directory is complete and recent enough"""
+        directory = self._directory(container, path)
+        return directory is not None and directory[2] == 1 and time.time() - directory[3] < self.max_age
+
+    def begin(self, container, path):
+        """
+        Returns the marker to continue refreshing the directory from.
+
+        A new refresh generation is started if there isn't a refresh in
+        progress.
+        """
+        directory = self._directory(container, path)
+        if directory is not None and directory[1] is not None:
+            return directory[1]
+        with self.db:
+            if directory is None:
+                self.db.execute("INSERT INTO directories (container, path, generation, marker) "
+                                "VALUES (?, ?, 1, '')", (container, path))
+            else:
+                self.db.execute("UPDATE directories SET generation=generation+1, marker='' "
+                                "WHERE container=? AND path=?", (container, path))
+        return ''
+
+    def store(self, container, path, objects, marker, done):
+        """
+        Store a listing page of the directory.
+
+        marker is the marker to continue the refresh, done means this was the
+        last page of the listing.
+        """
+        with self.db:
+            generation = self._directory(container, path)[0]
+            rows = []
+            for obj in objects:
+                if 'subdir' in obj:
+                    rows.append((container, path, obj['subdir'], 1, None, None, None, None, None, generation))
+                else:
+                    rows.append((container, path, obj['name'], 0, obj.get('bytes'), obj.get('content_type'),
+                                 obj.get('hash'), obj.get('last_modified'), obj.get('manifest'), generation))
+            self.db.executemany("INSERT OR REPLACE INTO entries (container, path, name, subdir, bytes, "
+                                "content_type, hash, last_modified, manifest, generation) "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            if done:
+                self.db.execute("DELETE FROM entries WHERE container=? AND path=? AND generation<?",
+                                (container, path, generation))
+                self.db.execute("UPDATE directories SET marker=NULL, complete=1, refreshed=? "
+                                "WHERE container=? AND path=?", (time.time(), container, path))
+            else:
+                self.db.execute("UPDATE directories SET marker=? WHERE container=? AND path=?",
+                                (marker, container, path))
+        logging.debug("index stored %s entries for %r/%r (done: %s)" % (len(rows), container, path, done))
+
+    def invalidate(self, container, path):
+        """Mark the directory listing as stale so it is refreshed on next use"""
+        with self.db:
+            self.db.execute("UPDATE directories SET refreshed=0 WHERE container=? AND path=?",
+                            (container, path))
+
+    def update(self, container, path, obj):
+        """Add or replace an object in the stored listing of the directory"""
+        with self.db:
+            directory = self._directory(container, path)
+            if directory is None:
+                return
+            self.db.execute("INSERT OR REPLACE INTO entries (container, path, name, subdir, bytes, "
+                            "content_type, hash, last_modified, manifest, generation) "
+                            "VALUES (?, ?, ?, 0, ?, ?, ?, ?, ?, ?)",
+                            (container, path, obj['name'], obj.get('bytes'), obj.get('content_type'),
+                             obj.get('hash'), obj.get('last_modified'), obj.get('manifest'), directory[0]))
+
+    def remove(self, container, path, name):
+        """Remove an object from the stored listing of the directory"""
+        with self.db:
+            self.db.execute("DELETE FROM entries WHERE container=? AND path=? AND name=? AND subdir=0",
+                            (container, path, name))
+
+    def _to_object(self, row):
+        """Convert an entries row into a listing object"""
+        obj = dict(zip(self.FIELDS, row))
+        if obj.pop('subdir'):
+            return { 'subdir': obj['name'] }
+        return obj
+
+    def listing(self, container, path):
+        """Returns the stored listing of the directory in listing order"""
+        rows = self.db.execute("SELECT %s FROM entries WHERE container=? AND path=? ORDER BY name" %
+                               ", ".join(self.FIELDS), (container, path))
+        return [self._to_object(row) for row in rows]
+
+    def lookup(self, container, path, name):
+        """
+        Returns the listing object for name in the directory.
+
+        As in the listing, a virtual directory takes precedence over an
+        object with the same name. Returns None if name is not found.
+        """
+        rows = self.db.execute("SELECT %s FROM entries WHERE container=? AND path=? AND name IN (?, ?) "
+                               "ORDER BY subdir" % ", ".join(self.FIELDS),
+                               (container, path, name, name + "/")).fetchall()
+        if not rows:
+            return None
+        return self._to_object(rows[-1])
@@ -3,7 +3,6 @@ __author__ = "Chmouel Boudjnah <chmouel@chmouel.com>"
 
 import sys
 import os
-import signal
 import socket
 from ConfigParser import RawConfigParser, ParsingError
 import logging
@@ -14,12 +13,25 @@ import pyftpdlib.servers
 import swiftclient
 
 from server import ObjectStorageFtpFS
-from fs import ObjectStorageFD
+from fs import ObjectStorageFD, ListDirCache, ProxyConnection
+from pool import ConnectionPool
+from auth import TokenCache
+from threadpool import ThreadPool
+from endpoints import EndpointPool
+from hedge import HedgePolicy
+from breaker import CircuitBreaker
+from engine import StorageEngine
+from sizing import ChunkSizer
+from bandwidth import BandwidthScheduler
+from admission import AdmissionController
+from prefork import PreforkFTPServer
+from conntrack import ConnectionTracker
+from ports import PortAllocator
+from cache import create_cache
 from constants import version, default_address, default_port, \
     default_config_file, default_banner, \
     default_ks_tenant_separator, default_ks_service_type, default_ks_endpoint_type
-from monkeypatching import MyFTPHandler
-from multiprocessing import Manager
+from monkeypatching import MyFTPHandler, MyDTPHandler
 
 def modify_supported_ftp_commands():
     """Remove the FTP commands we don't / can't support, and add the extensions."""
@@ -73,8 +85,10 @@ class Main(object):
                                 level=self.options.log_level)
 
         # warnings
-        if self.config.get("ftpcloudfs", "workers") is not None:
-            logging.warning("workers configuration token has been deprecated and has no effect")
+        if self.config.get("ftpcloudfs", "workers") is not None and self.config.get("ftpcloudfs", "server-mode") != "prefork":
+            logging.warning("workers configuration token has no effect unless server-mode is prefork")
+        if self.config.getboolean("ftpcloudfs", "reuse-port") and self.config.get("ftpcloudfs", "server-mode") != "prefork":
+            logging.warning("reuse-port configuration token has no effect unless server-mode is prefork")
         if self.config.get("ftpcloudfs", "service-net") is not None:
             logging.warning("service-net configuration token has been deprecated and has no effect (see ChangeLog)")
 
@@ -103,7 +117,15 @@ class Main(object):
                                   'port': default_port,
                                   'bind-address': default_address,
                                   'workers': None,
+                                  'server-mode': 'process',
+                                  'worker-max-sessions': '1000',
+                                  'worker-max-memory': '0',
+                                  'reuse-port': 'no',
                                   'memcache': None,
+                                  'cache': None,
+                                  'cache-entries': '1000',
+                                  'cache-file': None,
+                                  'cache-size': '64',
                                   'max-cons-per-ip': '0',
                                   'permit-foreign-addresses': 'no',
                                   'auth-url': None,
@@ -119,6 +141,55 @@ class Main(object):
                                   'passive-ports': None,
                                   'split-large-files': '0',
                                   'hide-part-dir': 'no',
+                                  'point-lookup-threshold': '10000',
+                                  'prefetch-subtree-objects': '0',
+                                  'metadata-index-path': None,
+                                  'metadata-index-max-age': '300',
+                                  'metadata-index-refresh-pages': '1',
+                                  'read-your-writes': 'session',
+                                  'read-your-writes-ttl': '60',
+                                  'connection-pool-size': '4',
+                                  'auth-token-ttl': '3600',
+                                  'auth-token-refresh': '300',
+                                  'connection-pool-idle-timeout': '60',
+                                  'storage-endpoints': None,
+                                  'storage-endpoint-policy': 'least-loaded',
+                                  'storage-endpoint-max-failures': '3',
+                                  'storage-endpoint-eject-time': '30',
+                                  'storage-endpoint-check-interval': '10',
+                                  'storage-endpoint-check-path': '/healthcheck',
+                                  'timeout-auth': '30',
+                                  'timeout-head': '30',
+                                  'timeout-listing': '60',
+                                  'timeout-get': '60',
+                                  'timeout-put': '120',
+                                  'retries': '3',
+                                  'retry-backoff': '1',
+                                  'retry-max-backoff': '16',
+                                  'circuit-breaker-failures': '10',
+                                  'circuit-breaker-reset': '30',
+                                  'hedged-reads': 'no',
+                                  'hedged-reads-percentile': '95',
+                                  'hedged-reads-budget': '10',
+                                  'storage-threads': '4',
+                                  'read-ahead': '0',
+                                  'evented-transfers': 'no',
+                                  'adaptive-chunks': 'no',
+                                  'adaptive-chunks-min': '65536',
+                                  'adaptive-chunks-max': '4194304',
+                                  'adaptive-socket-buffer-max': '4194304',
+                                  'bandwidth-limit': '0',
+                                  'bandwidth-user-limit': '0',
+                                  'bandwidth-ip-limit': '0',
+                                  'bandwidth-burst': '1',
+                                  'bandwidth-weights': '',
+                                  'admission-max-requests': '0',
+                                  'admission-max-node-requests': '0',
+                                  'admission-max-latency': '0',
+                                  'admission-retry-after': '5',
+                                  'auth-threads': '4',
+                                  'auth-timeout': '30',
+                                  'auth-max-pending': '32',
                                   # keystone auth support
                                   'keystone-auth': False,
                                   'keystone-auth-version': '2.0',
@@ -314,6 +385,54 @@ class Main(object):
 
         self.options = options
 
+    def setup_cache(self):
+        """Select the cache backend."""
+        backend = self.config.get('ftpcloudfs', 'cache')
+        if backend is None:
+            # backwards compatible: use memcache if it is configured
+            if self.options.memcache:
+                backend = 'memcache'
+            elif self.config.get('ftpcloudfs', 'server-mode') == 'threaded':
+                # all the sessions share the process
+                backend = 'local'
+            else:
+                backend = 'none'
+
+        options = dict()
+        if backend == 'memcache':
+            if not self.options.memcache:
+                sys.exit('Cache error: memcache cache requires memcache servers')
+        elif backend == 'local':
+            try:
+                options['entries'] = int(self.config.get('ftpcloudfs', 'cache-entries'))
+            except ValueError, errmsg:
+                sys.exit('Cache entries error: %s' % errmsg)
+        elif backend in ('mmap', 'shm'):
+            if backend == 'mmap':
+                options['path'] = self.config.get('ftpcloudfs', 'cache-file')
+                if not options['path']:
+                    # a predictable file in a shared directory could be created by another user
+                    sys.exit('Cache error: mmap cache requires a cache-file in a private directory')
+            try:
+                options['size'] = int(self.config.get('ftpcloudfs', 'cache-size'))*1024**2
+            except ValueError, errmsg:
+                sys.exit('Cache size error: %s' % errmsg)
+        elif backend != 'none':
+            sys.exit('Cache error: unsupported cache %r' % backend)
+
+        ObjectStorageFtpFS.cache_backend = backend
+        ObjectStorageFtpFS.cache_options = options
+
+    def setup_shared_cache(self):
+        """
+        Create the shared memory cache.
+
+        It must be called before forking the workers so they all inherit the
+        shared memory segment.
+        """
+        if ObjectStorageFtpFS.cache_backend == 'shm':
+            ListDirCache.backend = create_cache('shm', **ObjectStorageFtpFS.cache_options)
+
     def setup_server(self):
         """Run the main ftp server loop."""
         banner = self.config.get('ftpcloudfs', 'banner').replace('%v', version)
@@ -325,6 +444,7 @@ class Main(object):
         ObjectStorageFtpFS.insecure = self.options.insecure
         ObjectStorageFtpFS.keystone = self.options.keystone
         ObjectStorageFtpFS.memcache_hosts = self.options.memcache
+        self.setup_cache()
         ObjectStorageFtpFS.storage_policy = self.options.storage_policy
         ObjectStorageFtpFS.hide_part_dir = self.config.getboolean('ftpcloudfs', 'hide-part-dir')
         ObjectStorageFtpFS.snet = self.config.getboolean('ftpcloudfs', 'rackspace-service-net')
@@ -335,6 +455,153 @@ class Main(object):
         except ValueError, errmsg:
             sys.exit('Split large files error: %s' % errmsg)
 
+        try:
+            ListDirCache.point_lookup_threshold = int(self.config.get('ftpcloudfs', 'point-lookup-threshold'))
+        except ValueError, errmsg:
+            sys.exit('Point lookup threshold error: %s' % errmsg)
+
+        try:
+            ListDirCache.prefetch_max_objects = int(self.config.get('ftpcloudfs', 'prefetch-subtree-objects'))
+        except ValueError, errmsg:
+            sys.exit('Prefetch subtree objects error: %s' % errmsg)
+
+        index_path = self.config.get('ftpcloudfs', 'metadata-index-path')
+        if index_path:
+            if not os.path.isdir(index_path):
+                sys.exit('Metadata index path error: %s is not a directory' % index_path)
+            ListDirCache.index_path = index_path
+            try:
+                ListDirCache.index_max_age = int(self.config.get('ftpcloudfs', 'metadata-index-max-age'))
+                ListDirCache.index_refresh_pages = int(self.config.get('ftpcloudfs', 'metadata-index-refresh-pages'))
+            except ValueError, errmsg:
+                sys.exit('Metadata index error: %s' % errmsg)
+
+        try:
+            ProxyConnection.tokens = TokenCache(int(self.config.get('ftpcloudfs', 'auth-token-ttl')),
+                                                int(self.config.get('ftpcloudfs', 'auth-token-refresh')))
+        except ValueError, errmsg:
+            sys.exit('Auth token cache error: %s' % errmsg)
+
+        try:
+            pool_size = int(self.config.get('ftpcloudfs', 'connection-pool-size'))
+            pool_idle_timeout = int(self.config.get('ftpcloudfs', 'connection-pool-idle-timeout'))
+        except ValueError, errmsg:
+            sys.exit('Connection pool error: %s' % errmsg)
+        if pool_size > 0:
+            ProxyConnection.pool = ConnectionPool(pool_size, pool_idle_timeout)
+
+        endpoints = self.config.get('ftpcloudfs', 'storage-endpoints')
+        if endpoints:
+            try:
+                ProxyConnection.endpoints = EndpointPool(
+                    [endpoint.strip() for endpoint in endpoints.split(",") if endpoint.strip()],
+                    policy=self.config.get('ftpcloudfs', 'storage-endpoint-policy'),
+                    max_failures=int(self.config.get('ftpcloudfs', 'storage-endpoint-max-failures')),
+                    eject_time=int(self.config.get('ftpcloudfs', 'storage-endpoint-eject-time')),
+                    check_interval=int(self.config.get('ftpcloudfs', 'storage-endpoint-check-interval')),
+                    check_path=self.config.get('ftpcloudfs', 'storage-endpoint-check-path'),
+                    insecure=self.options.insecure,
+                    )
+            except ValueError, errmsg:
+                sys.exit('Storage endpoints error: %s' % errmsg)
+
+        try:
+            timeouts = dict()
+            for operation in ('auth', 'head', 'listing', 'get', 'put'):
+                timeouts[operation] = float(self.config.get('ftpcloudfs', 'timeout-%s' % operation)) or None
+            ProxyConnection.timeouts = timeouts
+            ProxyConnection.max_retries = int(self.config.get('ftpcloudfs', 'retries'))
+            ProxyConnection.retry_backoff = float(self.config.get('ftpcloudfs', 'retry-backoff'))
+            ProxyConnection.retry_max_backoff = float(self.config.get('ftpcloudfs', 'retry-max-backoff'))
+        except ValueError, errmsg:
+            sys.exit('Timeouts and retries error: %s' % errmsg)
+
+        try:
+            breaker_failures = int(self.config.get('ftpcloudfs', 'circuit-breaker-failures'))
+            breaker_reset = int(self.config.get('ftpcloudfs', 'circuit-breaker-reset'))
+        except ValueError, errmsg:
+            sys.exit('Circuit breaker error: %s' % errmsg)
+        if breaker_failures > 0:
+            ProxyConnection.breaker = CircuitBreaker(breaker_failures, breaker_reset)
+
+        if self.config.getboolean('ftpcloudfs', 'hedged-reads'):
+            try:
+                ObjectStorageFD.hedging = HedgePolicy(
+                    percentile=float(self.config.get('ftpcloudfs', 'hedged-reads-percentile')),
+                    budget=float(self.config.get('ftpcloudfs', 'hedged-reads-budget')) / 100,
+                    )
+            except ValueError, errmsg:
+                sys.exit('Hedged reads error: %s' % errmsg)
+
+        try:
+            storage_threads = int(self.config.get('ftpcloudfs', 'storage-threads'))
+            ObjectStorageFD.read_ahead = int(self.config.get('ftpcloudfs', 'read-ahead'))
+        except ValueError, errmsg:
+            sys.exit('Storage threads error: %s' % errmsg)
+        if storage_threads > 0:
+            ProxyConnection.engine = StorageEngine(storage_threads)
+
+        ObjectStorageFD.evented = self.config.getboolean('ftpcloudfs', 'evented-transfers')
+
+        if self.config.getboolean('ftpcloudfs', 'adaptive-chunks'):
+            try:
+                chunk_sizes = (int(self.config.get('ftpcloudfs', 'adaptive-chunks-min')),
+                               int(self.config.get('ftpcloudfs', 'adaptive-chunks-max')))
+                MyDTPHandler.max_socket_buffer = int(self.config.get('ftpcloudfs', 'adaptive-socket-buffer-max'))
+                ChunkSizer(*chunk_sizes)
+            except ValueError, errmsg:
+                sys.exit('Adaptive chunks error: %s' % errmsg)
+            ObjectStorageFD.chunk_sizes = MyDTPHandler.chunk_sizes = chunk_sizes
+
+        try:
+            limits = [int(self.config.get('ftpcloudfs', 'bandwidth-%s' % name))
+                      for name in ('limit', 'user-limit', 'ip-limit')]
+            burst = float(self.config.get('ftpcloudfs', 'bandwidth-burst'))
+            weights = {}
+            for item in self.config.get('ftpcloudfs', 'bandwidth-weights').split(","):
+                if item.strip():
+                    user, weight = item.rsplit(":", 1)
+                    weights[user.strip()] = float(weight)
+                    if weights[user.strip()] <= 0:
+                        raise ValueError("invalid weight for %s" % user.strip())
+            if any(limits):
+                # before forking, so all the processes share it
+                MyDTPHandler.bandwidth = BandwidthScheduler(*limits, burst=burst, weights=weights)
+        except ValueError, errmsg:
+            sys.exit('Bandwidth error: %s' % errmsg)
+
+        try:
+            max_requests = int(self.config.get('ftpcloudfs', 'admission-max-requests'))
+            max_node_requests = int(self.config.get('ftpcloudfs', 'admission-max-node-requests'))
+            max_latency = float(self.config.get('ftpcloudfs', 'admission-max-latency'))
+            retry_after = int(self.config.get('ftpcloudfs', 'admission-retry-after'))
+            if max_requests or max_node_requests or max_latency:
+                # before forking, so all the processes share it
+                ProxyConnection.admission = AdmissionController(max_requests, max_node_requests,
+                                                                max_latency, retry_after)
+        except ValueError, errmsg:
+            sys.exit('Admission control error: %s' % errmsg)
+
+        try:
+            auth_threads = int(self.config.get('ftpcloudfs', 'auth-threads'))
+            auth_max_pending = int(self.config.get('ftpcloudfs', 'auth-max-pending'))
+            MyFTPHandler.auth_timeout = int(self.config.get('ftpcloudfs', 'auth-timeout'))
+        except ValueError, errmsg:
+            sys.exit('Auth threads error: %s' % errmsg)
+        if auth_threads > 0:
+            MyFTPHandler.auth_pool = ThreadPool(auth_threads, max(auth_max_pending, auth_threads))
+
+        read_your_writes = self.config.get('ftpcloudfs', 'read-your-writes')
+        if read_your_writes not in ('none', 'session', 'account'):
+            sys.exit('Read your writes error: unsupported mode %r' % read_your_writes)
+        try:
+            ListDirCache.overlay_ttl = int(self.config.get('ftpcloudfs', 'read-your-writes-ttl'))
+        except ValueError, errmsg:
+            sys.exit('Read your writes TTL error: %s' % errmsg)
+        if read_your_writes == 'none':
+            ListDirCache.overlay_ttl = 0
+        ListDirCache.overlay_shared = read_your_writes == 'account'
+
         if self.config.getboolean('ftpcloudfs', 'large-object-container'):
             try:
                 ObjectStorageFD.large_object_container_suffix = self.config.get('ftpcloudfs', 'large-object-container-suffix')
@@ -368,10 +635,27 @@ class Main(object):
         except ValueError, errmsg:
             sys.exit('Max connections per IP error: %s' % errmsg)
 
-        ftpd = pyftpdlib.servers.MultiprocessFTPServer((self.options.bind_address,
-                                                        self.options.port),
-                                                       MyFTPHandler,
-                                                       )
+        server_mode = self.config.get('ftpcloudfs', 'server-mode')
+        if server_mode == 'process':
+            server_class = pyftpdlib.servers.MultiprocessFTPServer
+        elif server_mode == 'threaded':
+            server_class = pyftpdlib.servers.ThreadedFTPServer
+        elif server_mode == 'prefork':
+            server_class = PreforkFTPServer
+            try:
+                workers = self.config.get('ftpcloudfs', 'workers')
+                PreforkFTPServer.workers = int(workers) if workers else None
+                PreforkFTPServer.max_sessions = int(self.config.get('ftpcloudfs', 'worker-max-sessions'))
+                PreforkFTPServer.max_memory = int(self.config.get('ftpcloudfs', 'worker-max-memory'))*1024**2
+            except ValueError, errmsg:
+                sys.exit('Prefork workers error: %s' % errmsg)
+            PreforkFTPServer.reuse_port = self.config.getboolean('ftpcloudfs', 'reuse-port')
+            if PreforkFTPServer.reuse_port and not hasattr(socket, 'SO_REUSEPORT'):
+                sys.exit('Reuse port error: SO_REUSEPORT is not supported')
+        else:
+            sys.exit('Server mode error: unsupported mode %r' % server_mode)
+
+        ftpd = server_class((self.options.bind_address, self.options.port), MyFTPHandler)
 
         # set it to unlimited, we use our own checks with a shared dict
         ftpd.max_cons_per_ip = 0
@@ -404,13 +688,6 @@ class Main(object):
 
         return daemonContext
 
-    def signal_handler(self, signal, frame):
-        """Catch signals and propagate them to child processes."""
-        if self.shm_manager:
-            self.shm_manager.shutdown()
-            self.shm_manager = None
-        self.old_signal_handler(signal, frame)
-
     def main(self):
         """Main entry point."""
         self.pid = os.getpid()
@@ -420,19 +697,23 @@ class Main(object):
 
         ftpd = self.setup_server()
 
+        if MyFTPHandler.max_cons_per_ip:
+            # before forking, so all the processes share it
+            MyFTPHandler.conn_tracker = ConnectionTracker()
+        if MyFTPHandler.passive_ports:
+            MyFTPHandler.passive_allocator = PortAllocator(MyFTPHandler.passive_ports[0],
+                                                           MyFTPHandler.passive_ports[-1])
+
         if self.options.foreground:
-            MyFTPHandler.shared_ip_map = None
             self.setup_log()
+            self.setup_shared_cache()
             ftpd.serve_forever()
             return
 
-        daemonContext = self.setup_daemon([ftpd.socket.fileno(), ftpd.ioloop.fileno(),])
+        # the listening sockets of the prefork workers are created before dropping privileges
+        sockets = getattr(ftpd, "sockets", [ftpd.socket])
+        daemonContext = self.setup_daemon([sock.fileno() for sock in sockets] + [ftpd.ioloop.fileno(),])
         with daemonContext:
-            self.old_signal_handler = signal.signal(signal.SIGTERM, self.signal_handler)
-
-            self.shm_manager = Manager()
-            MyFTPHandler.shared_ip_map = self.shm_manager.dict()
-            MyFTPHandler.shared_lock = self.shm_manager.Lock()
-
             self.setup_log()
+            self.setup_shared_cache()
             ftpd.serve_forever()
@@ -1,16 +1,247 @@
+import os
 import sys
 import socket
-from pyftpdlib.handlers import DTPHandler, FTPHandler, _strerror
+import logging
+from pyftpdlib.servers import MultiprocessFTPServer
+from pyftpdlib.handlers import DTPHandler, PassiveDTP, FTPHandler, FileProducer, _strerror, proto_cmds
+from pyftpdlib.handlers import _FileReadWriteError
+from pyftpdlib.ioloop import _ERRNOS_RETRY, _ERRNOS_DISCONNECTED
+from pyftpdlib.authorizers import AuthenticationFailed, AuthorizerError
+from pyftpdlib.log import logger
 from ftpcloudfs.utils import smart_str
+from ftpcloudfs.evented import HIGH_WATER, LOW_WATER
+from ftpcloudfs.sizing import ChunkSizer, grow_socket_buffer
 from server import ObjectStorageAuthorizer
-from multiprocessing.managers import RemoteError
+from fs import ProxyConnection
 
 class MyDTPHandler(DTPHandler):
+    # port from the passive ports allocator used by the connection
+    passive_port = None
+    # ObjectStream pushing the file to send (evented RETR)
+    stream = None
+    # not reading until the written data is sent (evented STOR)
+    paused = False
+
+    # buffer reused to receive the data (see handle_read)
+    recv_buffer = None
+    # (minimum, maximum) bytes of the buffers, adapted to the throughput (None: fixed buffers)
+    chunk_sizes = None
+    # max bytes of the socket buffers grown for high bandwidth-delay connections
+    max_socket_buffer = 4194304
+    sizer = None
+
+    # BandwidthScheduler shared by the server processes (None: no limits)
+    bandwidth = None
+    # Transfer of the data channel in the bandwidth scheduler
+    transfer = None
+    # waiting to stay within the bandwidth limits (see throttle)
+    sleeping = False
+    wake_events = None
+    throttler = None
+
     def send(self, data):
-        data = smart_str(data)
-        return DTPHandler.send(self, data)
+        # strings and buffers are sent as they are, without copying them
+        if isinstance(data, unicode):
+            data = smart_str(data)
+        sent = DTPHandler.send(self, data)
+        if sent and self.chunk_sizes is not None:
+            self.adapt_buffers(sent, socket.SO_SNDBUF)
+        if sent and self.bandwidth is not None:
+            self.throttle(sent)
+        return sent
+
+    def throttle(self, nbytes):
+        """
+        Account nbytes transferred in the bandwidth scheduler and stop
+        sending or receiving for as long as the limits require.
+        """
+        if self.transfer is None:
+            self.transfer = self.bandwidth.start(self.cmd_channel.username, self.cmd_channel.remote_ip)
+        delay = self.bandwidth.charge(self.transfer, nbytes)
+        if delay > 0 and not self.sleeping and not self._closed:
+            self.wake_events = self._current_io_events
+            self.modify_ioloop_events(0)
+            self.sleeping = True
+            self.throttler = self.ioloop.call_later(delay, self.wake_up, _errback=self.handle_error)
+
+    def wake_up(self):
+        self.sleeping = False
+        self.throttler = None
+        if not self._closed:
+            self.modify_ioloop_events(self.wake_events)
+
+    def modify_ioloop_events(self, events, logdebug=False):
+        if self.sleeping:
+            # set when the channel wakes up
+            self.wake_events = events
+            return
+        DTPHandler.modify_ioloop_events(self, events, logdebug)
+
+    def adapt_buffers(self, nbytes, option):
+        """Adapt the buffers to the throughput after transferring nbytes"""
+        if self.sizer is None:
+            self.sizer = ChunkSizer(*self.chunk_sizes)
+        if not self.sizer.update(nbytes):
+            return
+        self.ac_in_buffer_size = self.ac_out_buffer_size = self.sizer.size
+        if self.stream is not None:
+            self.stream.recv_size = self.sizer.size
+        size = grow_socket_buffer(self.socket, option, self.sizer.rate, self.max_socket_buffer)
+        if size is not None:
+            logging.debug("data channel socket buffer grown to %s bytes (%s bytes/s)" % (size, self.sizer.rate))
+
+    def push_with_producer(self, producer):
+        """Send the file from the IOLoop if the transfer can be evented"""
+        stream = getattr(self.file_obj, "stream", None)
+        if stream is not None and self.cmd_channel._current_type == 'i':
+            try:
+                self.stream = stream(self)
+            except EnvironmentError, e:
+                # the blocking read will report it
+                self.cmd_channel.logline("Evented transfer not started: %s" % e)
+            if self.stream is not None:
+                self._initialized = True
+                self._wanted_io_events = self.ioloop.WRITE
+                # wait for the data of the stream
+                self.modify_ioloop_events(0)
+                return
+        DTPHandler.push_with_producer(self, producer)
+
+    def close_when_done(self):
+        # the stream closes the channel when it's done
+        if self.stream is None:
+            DTPHandler.close_when_done(self)
+
+    def initiate_send(self):
+        """
+        Send the data of the first string (or producer) of the fifo.
+
+        Like asynchat's, but the rest of a string partially sent is kept as a
+        memoryview instead of a copy.
+        """
+        if self.sleeping:
+            # the data is sent when the channel wakes up
+            return
+        while self.producer_fifo and self.connected:
+            first = self.producer_fifo[0]
+            if first is None:
+                del self.producer_fifo[0]
+                self.handle_close()
+                return
+            if isinstance(first, unicode):
+                first = self.producer_fifo[0] = smart_str(first)
+            elif not isinstance(first, (str, memoryview)):
+                data = first.more()
+                if data:
+                    self.producer_fifo.appendleft(data)
+                else:
+                    del self.producer_fifo[0]
+                continue
+            if not first:
+                del self.producer_fifo[0]
+                continue
+            data = first
+            if len(first) > self.ac_out_buffer_size:
+                data = memoryview(first)[:self.ac_out_buffer_size]
+            try:
+                sent = self.send(data)
+            except socket.error:
+                self.handle_error()
+                return
+            if sent:
+                if sent < len(first):
+                    self.producer_fifo[0] = memoryview(first)[sent:]
+                else:
+                    del self.producer_fifo[0]
+            break
+
+        if self.stream is not None and not self._closed:
+            if not self.producer_fifo:
+                self.modify_ioloop_events(0)
+            self.stream.sent()
+
+    def end_stream(self):
+        """All the data of the stream was pushed"""
+        self.stream = None
+        DTPHandler.close_when_done(self)
+        self.modify_ioloop_events(self.ioloop.WRITE)
+
+    def abort_stream(self, msg):
+        """The stream failed after sending some data"""
+        self.stream = None
+        self._resp = ("426 %s; transfer aborted." % msg, logger.warning)
+        self.close()
+
+    def fallback_stream(self):
+        """The stream failed before sending any data, read the file blocking"""
+        self.stream = None
+        DTPHandler.push_with_producer(self, FileProducer(self.file_obj, self.cmd_channel._current_type))
+        DTPHandler.close_when_done(self)
+
+    def enable_receiving(self, type, cmd):
+        DTPHandler.enable_receiving(self, type, cmd)
+        attach = getattr(self.file_obj, "attach", None)
+        if attach is not None:
+            attach(self.ioloop, self.resume_receiving)
+
+    def handle_read(self):
+        """
+        Receive data into the reused buffer and write a view of it to the file
+        (so the file must copy the data it keeps).
+
+        Pause receiving if there's too much written data waiting to be sent.
+        """
+        if self.recv_buffer is None or len(self.recv_buffer) != self.ac_in_buffer_size:
+            self.recv_buffer = bytearray(self.ac_in_buffer_size)
+        try:
+            size = self.socket.recv_into(self.recv_buffer)
+        except socket.error, err:
+            if err.errno in _ERRNOS_RETRY:
+                return
+            if err.errno in _ERRNOS_DISCONNECTED:
+                size = 0
+            else:
+                self.handle_error()
+                return
+        if not size:
+            self.transfer_finished = True
+            self.handle_close()
+            return
+        self.tot_bytes_received += size
+        chunk = memoryview(self.recv_buffer)[:size]
+        if self.chunk_sizes is not None:
+            self.adapt_buffers(size, socket.SO_RCVBUF)
+        if self.bandwidth is not None:
+            self.throttle(size)
+        if self._data_wrapper is not None:
+            chunk = self._data_wrapper(chunk.tobytes())
+        try:
+            self.file_obj.write(chunk)
+        except OSError, err:
+            raise _FileReadWriteError(err)
+        if not self._closed and self.file_obj is not None and \
+                self.file_obj.backlog() > max(HIGH_WATER, 4*self.ac_in_buffer_size):
+            self.paused = True
+            self.modify_ioloop_events(0)
+
+    handle_read_event = handle_read
+
+    def resume_receiving(self):
+        """The file sent data, resume receiving if it's waiting for it"""
+        if self.paused and not self._closed and \
+                self.file_obj.backlog() < max(LOW_WATER, self.ac_in_buffer_size):
+            self.paused = False
+            self.modify_ioloop_events(self.ioloop.READ)
 
     def close(self):
+        if self.throttler is not None:
+            if not self.throttler.cancelled:
+                self.throttler.cancel()
+            self.throttler = None
+        if self.transfer is not None:
+            self.bandwidth.finish(self.transfer)
+            self.transfer = None
+
         if self.file_obj is not None and not self.file_obj.closed:
             try:
                 self.file_obj.close()
@@ -21,35 +252,169 @@ class MyDTPHandler(DTPHandler):
             finally:
                 self.file_obj = None
 
+        if self.passive_port is not None:
+            self.cmd_channel.passive_allocator.release(self.passive_port)
+            self.passive_port = None
+
         DTPHandler.close(self)
 
+class MyPassiveDTP(PassiveDTP):
+    """
+    Passive data server using a port from the allocator of the command
+    channel, if there's one.
+
+    The port is in use until both the listening socket and the data
+    connection are closed.
+    """
+    def __init__(self, cmd_channel, extmode=False):
+        self.passive_port = None
+        allocator = cmd_channel.passive_allocator
+        if allocator is None:
+            PassiveDTP.__init__(self, cmd_channel, extmode)
+            return
+
+        port = allocator.allocate()
+        if port is None:
+            cmd_channel.logline("No free passive ports: %r" % allocator.stats())
+        # PassiveDTP binds one of the command channel passive ports
+        # (a kernel-assigned port if it's None or it can't be bound)
+        cmd_channel.passive_ports = [port] if port is not None else None
+        try:
+            PassiveDTP.__init__(self, cmd_channel, extmode)
+        except:
+            if port is not None:
+                allocator.release(port)
+            raise
+        finally:
+            del cmd_channel.passive_ports
+        if port is not None:
+            if self.socket is not None and self.socket.getsockname()[1] == port:
+                self.passive_port = port
+            else:
+                allocator.release(port)
+
+    def handle_accepted(self, sock, addr):
+        port = self.passive_port
+        if port is not None:
+            # for the data connection
+            self.cmd_channel.passive_allocator.hold(port)
+        PassiveDTP.handle_accepted(self, sock, addr)
+        if port is not None:
+            data_channel = self.cmd_channel.data_channel
+            if data_channel is not None and data_channel.socket is sock:
+                data_channel.passive_port = port
+            else:
+                self.cmd_channel.passive_allocator.release(port)
+
+    def close(self):
+        if self.passive_port is not None:
+            self.cmd_channel.passive_allocator.release(self.passive_port)
+            self.passive_port = None
+        PassiveDTP.close(self)
+
 class MyFTPHandler(FTPHandler):
     # don't kick off client in long time transactions
     timeout = 0
     dtp_handler = MyDTPHandler
+    passive_dtp = MyPassiveDTP
+    # PortAllocator for the passive ports shared by the server processes
+    passive_allocator = None
     authorizer = ObjectStorageAuthorizer()
     max_cons_per_ip = 0
+    # ConnectionTracker shared by the server processes (None: no tracking)
+    conn_tracker = None
     use_sendfile = False
+    # ThreadPool to authenticate off the IOLoop (None: authenticate in the IOLoop)
+    auth_pool = None
+    auth_timeout = 30
+    # commands starting data transfers, rejected by the admission control if the object storage is overloaded
+    shed_cmds = ('APPE', 'LIST', 'MLSD', 'NLST', 'RETR', 'STOR', 'STOU')
 
     @staticmethod
     def abstracted_fs(root, cmd_channel):
         """Get an AbstractedFs for the user logged in on the cmd_channel."""
-        cffs = cmd_channel.authorizer.get_abstracted_fs(cmd_channel.username)
+        cffs = cmd_channel.authorizer.get_abstracted_fs(cmd_channel)
         cffs.init_abstracted_fs(root, cmd_channel)
+        # the connection belongs to this session, set the remote ip once
+        cffs.conn.real_ip = cmd_channel.remote_ip
         return cffs
 
     def process_command(self, cmd, *args, **kwargs):
         """
-        Flush the FS cache with every new FTP command (non-shared cache).
+        Flush the FS cache with every new FTP command (no cache backend).
 
-        Also track the remote ip to set the X-Forwarded-For header.
+        Also fail fast the commands using the object storage if it's
+        unavailable, and reject the data transfers if it's overloaded.
         """
-        if self.fs:
-            if self.fs.memcache_hosts is None:
-                self.fs.flush()
-            self.fs.conn.real_ip = self.remote_ip
+        breaker = ProxyConnection.breaker
+        if breaker is not None and self.authenticated and proto_cmds.get(cmd, {}).get('perm') \
+                and breaker.is_open():
+            self.respond("450 Object storage temporarily unavailable, try again in %s seconds." % breaker.retry_after())
+            return
+        admission = ProxyConnection.admission
+        if admission is not None and self.authenticated and cmd in self.shed_cmds:
+            reason = admission.overloaded()
+            if reason is not None:
+                self.logline("Rejecting %s, object storage overloaded: %s" % (cmd, reason))
+                self.respond("450 Server busy, try again in %s seconds." % admission.retry_after)
+                return
+        if self.fs and self.fs.cache is None:
+            self.fs.flush()
         FTPHandler.process_command(self, cmd, *args, **kwargs)
 
+    def ftp_PASS(self, line):
+        """
+        Check username's password against the authorizer in the auth pool.
+
+        The control channel is removed from the IOLoop until the
+        authentication completes, so the other sessions aren't blocked
+        while the auth service replies. The logins are rejected while the
+        object storage is overloaded.
+        """
+        admission = ProxyConnection.admission
+        if admission is not None and not self.authenticated and self.username:
+            reason = admission.overloaded()
+            if reason is not None:
+                self.logerror("Rejecting user %s, object storage overloaded: %s" % (self.username, reason))
+                self.respond("421 Server busy, try again in %s seconds." % admission.retry_after)
+                self.close_when_done()
+                return
+
+        if self.auth_pool is None or self.authenticated or not self.username:
+            return FTPHandler.ftp_PASS(self, line)
+
+        username = self.username
+
+        def authenticate():
+            self.authorizer.validate_authentication(username, line, self)
+            return self.authorizer.get_home_dir(username), self.authorizer.get_msg_login(username)
+
+        def done(result, error):
+            if self._closed:
+                self.authorizer.discard_abstracted_fs(self)
+                return
+            self.add_channel()
+            if error is None:
+                home, msg_login = result
+                self.handle_auth_success(home, line, msg_login)
+            elif isinstance(error, (AuthenticationFailed, AuthorizerError)):
+                self.handle_auth_failed(str(error), line)
+            else:
+                self.authorizer.discard_abstracted_fs(self)
+                self.logerror("Authentication failed for user %s: %s" % (username, error))
+                self.handle_auth_failed("Authentication failed", line)
+
+        def late(result, error):
+            # timed out, the session has moved on
+            self.authorizer.discard_abstracted_fs(self)
+
+        if not self.auth_pool.submit(self.ioloop, authenticate, done, self.auth_timeout, late):
+            self.logerror("Too many logins in progress, rejecting user %s" % username)
+            self.respond("421 Too many logins in progress, try again later.")
+            self.close_when_done()
+            return
+        self.del_channel()
+
     def ftp_MD5(self, path):
         line = self.fs.fs2ftp(path)
         try:
@@ -63,23 +428,17 @@ class MyFTPHandler(FTPHandler):
 
     def handle(self):
         """Track the ip and check max cons per ip (if needed)."""
-        if self.max_cons_per_ip and self.remote_ip and self.shared_ip_map != None:
-            count = 0
-            try:
-                self.shared_lock.acquire()
-                count = self.shared_ip_map.get(self.remote_ip, 0) + 1
-                self.shared_ip_map[self.remote_ip] = count
-                self.logline("Connected, shared ip map: %s" % self.shared_ip_map)
-            except RemoteError, e:
-                self.logerror("Connection tracking failed: %s" % e)
-            finally:
-                self.shared_lock.release()
-
+        self.tracked_pid = None
+        if self.max_cons_per_ip and self.remote_ip and self.conn_tracker is not None:
+            count = self.conn_tracker.connect(self.remote_ip)
             self.logline("Connection track: %s -> %s" % (self.remote_ip, count))
 
-            if count > self.max_cons_per_ip:
-                self.handle_max_cons_per_ip()
-                return
+            if count is not None:
+                if count > self.max_cons_per_ip:
+                    self.conn_tracker.disconnect(self.remote_ip)
+                    self.handle_max_cons_per_ip()
+                    return
+                self.tracked_pid = os.getpid()
 
         FTPHandler.handle(self)
 
@@ -95,20 +454,26 @@ class MyFTPHandler(FTPHandler):
         FTPHandler.handle_error(self)
 
     def close(self):
-        """Remove the ip from the shared map before calling close."""
-        if not self._closed and self.max_cons_per_ip and self.shared_ip_map != None:
-            try:
-                self.shared_lock.acquire()
-                if self.remote_ip in self.shared_ip_map:
-                    self.shared_ip_map[self.remote_ip] -= 1
-                    if self.shared_ip_map[self.remote_ip] <= 0:
-                        del self.shared_ip_map[self.remote_ip]
-                self.logline("Disconnected, shared ip map: %s" % self.shared_ip_map)
-            except RemoteError, e:
-                self.logerror("Connection tracking cleanup failed: %s" % e)
-            finally:
-                self.shared_lock.release()
+        """Remove the connection from the tracked ones before calling close."""
+        if not self._closed and self.fs and self.fs.cache is not None:
+            self.logline("Cache stats: %r" % self.fs.cache.stats())
+        if not self._closed:
+            self.authorizer.discard_abstracted_fs(self)
+        if not self._closed and self.fs and self.fs.conn and self.fs.conn.pool is not None:
+            self.logline("Connection pool stats: %r" % self.fs.conn.pool.stats())
+        if not self._closed and self.passive_allocator is not None:
+            self.logline("Passive ports stats: %r" % self.passive_allocator.stats())
+        if not self._closed and MyDTPHandler.bandwidth is not None:
+            self.logline("Bandwidth stats: %r" % MyDTPHandler.bandwidth.stats())
+        if not self._closed and ProxyConnection.admission is not None:
+            self.logline("Admission stats: %r" % ProxyConnection.admission.stats())
 
+        if not self._closed and getattr(self, "tracked_pid", None) is not None:
+            # the spawning process closes its copy of the session after forking
+            if not (isinstance(self.server, MultiprocessFTPServer) and os.getpid() == self.tracked_pid):
+                count = self.conn_tracker.disconnect(self.remote_ip)
+                self.logline("Disconnected, connection track: %s -> %s" % (self.remote_ip, count))
+                self.tracked_pid = None
 
         FTPHandler.close(self)
 
@@ -0,0 +1,115 @@
+"""
+    Pool of HTTP connections to the object storage.
+
+The connections are kept open between FTP commands (and between sessions
+served by the same process) to avoid a new TCP/TLS handshake per request.
+"""
+
+import os
+import time
+import logging
+import threading
+
+__all__ = ['ConnectionPool']
+
+class ConnectionPool(object):
+    """
+    Per process pool of idle HTTP connections.
+
+    Connections are swiftclient (parsed url, HTTPConnection) tuples indexed by
+    a key identifying the storage URL and the connection settings. Every
+    HTTPConnection has its own requests session that keeps the sockets open.
+
+    A connection idle for more than idle_timeout seconds or older than
+    max_age seconds is closed instead of being reused. The sockets of a
+    session are checked by urllib3 before sending a request, so a socket
+    closed by the server is reopened transparently.
+
+    The pool is emptied in a forked process because the sockets are shared
+    with the parent process.
+    """
+
+    def __init__(self, max_size=4, idle_timeout=60, max_age=600):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        # (last used, key, connection), least recently used first
+        self.idle = []
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+
+    def _check_pid(self):
+        """Forget the connections of the parent process"""
+        if self.pid != os.getpid():
+            self.idle = []
+            self.pid = os.getpid()
+
+    def _healthy(self, http_conn, last_used, now):
+        """Check if the connection can be reused"""
+        conn = http_conn[1]
+        return getattr(conn, "request_session", None) is not None \
+            and now - last_used < self.idle_timeout \
+            and now - getattr(conn, "pool_created", now) < self.max_age
+
+    def _discard(self, http_conn):
+        """Close a connection"""
+        self.discarded += 1
+        conn = http_conn[1]
+        if getattr(conn, "request_session", None) is not None:
+            conn.request_session.close()
+
+    def get(self, key, factory):
+        """
+        Returns an idle connection for key.
+
+        If there's no idle connection that can be reused, a new one is
+        created calling factory.
+        """
+        now = time.time()
+        with self.lock:
+            self._check_pid()
+            for index in xrange(len(self.idle)-1, -1, -1):
+                last_used, idle_key, http_conn = self.idle[index]
+                if idle_key != key:
+                    continue
+                del self.idle[index]
+                if self._healthy(http_conn, last_used, now):
+                    self.reused += 1
+                    logging.debug("reusing pooled connection for %r" % (key,))
+                    return http_conn
+                self._discard(http_conn)
+            self.created += 1
+        logging.debug("new connection for %r" % (key,))
+        http_conn = factory()
+        http_conn[1].pool_created = now
+        return http_conn
+
+    def put(self, key, http_conn):
+        """Return a connection to the pool"""
+        now = time.time()
+        with self.lock:
+            self._check_pid()
+            if self.max_size <= 0 or not self._healthy(http_conn, now, now):
+                self._discard(http_conn)
+                return
+            self.idle.append((now, key, http_conn))
+            while len(self.idle) > self.max_size:
+                self._discard(self.idle.pop(0)[2])
+
+    def close(self):
+        """Close all the idle connections"""
+        with self.lock:
+            self._check_pid()
+            while self.idle:
+                self._discard(self.idle.pop()[2])
+
+    def stats(self):
+        """Returns a dict with the pool statistics"""
+        return dict(idle=len(self.idle),
+                    created=self.created,
+                    reused=self.reused,
+                    discarded=self.discarded,
+                    )
@@ -0,0 +1,121 @@
+"""
+    Passive ports shared by the server processes.
+
+The free ports are kept in a ring in an anonymous shared memory segment
+created before forking, so all the processes take different ports without
+trying to bind the ports in use.
+"""
+
+import os
+import mmap
+import errno
+import struct
+import logging
+import multiprocessing
+
+__all__ = ['PortAllocator']
+
+class PortAllocator(object):
+    """
+    Allocator of the ports from first to last (included).
+
+    allocate takes the free port at the head of the ring and release puts it
+    back at the tail, so a released port is the last one to be reused. Every
+    port has a reference count (the listening socket and the data
+    connection) and the pid of the process using it: when there are no free
+    ports, the ports of the processes that are gone are reclaimed.
+    """
+    # head of the ring, free ports, failed allocations, reclaimed ports
+    HEADER = struct.Struct("<IIII")
+    PORT = struct.Struct("<H")
+    # reference count, pid
+    OWNER = struct.Struct("<ii")
+
+    def __init__(self, first, last):
+        if not 0 < first <= last < 65536:
+            raise ValueError("Invalid port range: %s:%s" % (first, last))
+        self.first = first
+        self.size = last - first + 1
+        self.ring = self.HEADER.size
+        self.owners = self.ring + self.size*self.PORT.size
+        self.map = mmap.mmap(-1, self.owners + self.size*self.OWNER.size, mmap.MAP_SHARED)
+        self.lock = multiprocessing.Lock()
+        for index in xrange(self.size):
+            self.PORT.pack_into(self.map, self.ring + index*self.PORT.size, first + index)
+        self.HEADER.pack_into(self.map, 0, 0, self.size, 0, 0)
+
+    def _owner(self, port):
+        index = port - self.first
+        if not 0 <= index < self.size:
+            raise ValueError("Port out of range: %s" % port)
+        return self.owners + index*self.OWNER.size
+
+    def _push(self, port):
+        """Put port at the tail of the ring, must be called holding the lock"""
+        head, free, failed, reclaimed = self.HEADER.unpack_from(self.map, 0)
+        self.PORT.pack_into(self.map, self.ring + ((head + free) % self.size)*self.PORT.size, port)
+        self.HEADER.pack_into(self.map, 0, head, free + 1, failed, reclaimed)
+
+    def _reclaim(self):
+        """Free the ports of the processes that are gone, must be called holding the lock"""
+        count = 0
+        for index in xrange(self.size):
+            offset = self.owners + index*self.OWNER.size
+            refs, pid = self.OWNER.unpack_from(self.map, offset)
+            if refs <= 0:
+                continue
+            try:
+                os.kill(pid, 0)
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    continue
+                self.OWNER.pack_into(self.map, offset, 0, 0)
+                self._push(self.first + index)
+                count += 1
+        if count:
+            head, free, failed, reclaimed = self.HEADER.unpack_from(self.map, 0)
+            self.HEADER.pack_into(self.map, 0, head, free, failed, reclaimed + count)
+            logging.debug("reclaimed %s passive ports" % count)
+
+    def allocate(self):
+        """Returns a free port or None if all of them are in use"""
+        with self.lock:
+            if self.HEADER.unpack_from(self.map, 0)[1] == 0:
+                self._reclaim()
+            head, free, failed, reclaimed = self.HEADER.unpack_from(self.map, 0)
+            if free == 0:
+                self.HEADER.pack_into(self.map, 0, head, free, failed + 1, reclaimed)
+                return None
+            port = self.PORT.unpack_from(self.map, self.ring + head*self.PORT.size)[0]
+            self.HEADER.pack_into(self.map, 0, (head + 1) % self.size, free - 1, failed, reclaimed)
+            self.OWNER.pack_into(self.map, self._owner(port), 1, os.getpid())
+        return port
+
+    def hold(self, port):
+        """Add a reference to an allocated port"""
+        with self.lock:
+            offset = self._owner(port)
+            refs, pid = self.OWNER.unpack_from(self.map, offset)
+            self.OWNER.pack_into(self.map, offset, refs + 1, os.getpid())
+
+    def release(self, port):
+        """Remove a reference to port, it's free when there are no references left"""
+        with self.lock:
+            offset = self._owner(port)
+            refs, pid = self.OWNER.unpack_from(self.map, offset)
+            if refs <= 0:
+                return
+            if refs > 1:
+                self.OWNER.pack_into(self.map, offset, refs - 1, pid)
+                return
+            self.OWNER.pack_into(self.map, offset, 0, 0)
+            self._push(port)
+
+    def stats(self):
+        """Returns a dict with the usage of the ports"""
+        _, free, failed, reclaimed = self.HEADER.unpack_from(self.map, 0)
+        return dict(ports=self.size,
+                    in_use=self.size - free,
+                    failed=failed,
+                    reclaimed=reclaimed,
+                    )
@@ -0,0 +1,238 @@
+"""
+    Preforked FTP server.
+
+A pool of long lived worker processes accept the connections on the same
+listening socket, every worker serves many sessions in its IOLoop. The
+caches and connection pools of a worker are reused by its sessions.
+
+With reuse_port every worker accepts from its own socket bound with
+SO_REUSEPORT, and the kernel spreads the new connections between them. The
+sockets are created by the main process (before dropping privileges), and
+the worker replacing another one accepts the connections waiting in the
+same socket.
+"""
+
+import os
+import time
+import errno
+import signal
+import socket
+import logging
+import resource
+from multiprocessing import util
+
+from pyftpdlib.servers import FTPServer
+from pyftpdlib.ioloop import IOLoop
+from pyftpdlib.prefork import cpu_count, _reseed_random
+
+__all__ = ['PreforkFTPServer']
+
+class PreforkFTPServer(FTPServer):
+    """
+    FTP server with a pool of worker processes.
+
+    The main process only keeps the pool: a worker exiting is replaced by a
+    new one. A worker stops accepting connections and exits when its
+    sessions are done after serving max_sessions sessions, or when it uses
+    more than max_memory bytes (0 means no limit).
+    """
+    workers = None
+    max_sessions = 0
+    max_memory = 0
+    # a listening socket per worker (created by the main process)
+    reuse_port = False
+    # set in the worker processes
+    worker = False
+    # seconds between checks of the worker memory
+    check_interval = 5
+    # min seconds between starts of the same worker (to not spin on errors)
+    restart_delay = 1
+
+    def __init__(self, address_or_socket, handler, ioloop=None, backlog=100):
+        FTPServer.__init__(self, address_or_socket, handler, ioloop=ioloop, backlog=backlog)
+        self.nworkers = self.workers or cpu_count()
+        # listening sockets by worker id
+        self.sockets = [self.socket]
+        if self.reuse_port:
+            for _ in xrange(self.nworkers - 1):
+                self.sockets.append(self.reuse_port_socket())
+        self.children = {}
+        self.sessions = 0
+        self.recycling = False
+
+    def set_reuse_addr(self):
+        FTPServer.set_reuse_addr(self)
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+    def reuse_port_socket(self):
+        """Returns a new socket listening on the address of the server"""
+        sock = socket.socket(self.socket.family, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(self.socket.getsockname())
+            sock.listen(self.backlog)
+        except socket.error:
+            sock.close()
+            raise
+        sock.setblocking(0)
+        return sock
+
+    def use_socket(self, worker_id):
+        """Accept from the socket of the worker, the others are closed in this process"""
+        sock = self.sockets[worker_id % len(self.sockets)]
+        for other in self.sockets:
+            if other is not sock:
+                other.close()
+        self.sockets = [sock]
+        self.socket, self._fileno = sock, sock.fileno()
+
+    def handle_accepted(self, sock, addr):
+        handler = FTPServer.handle_accepted(self, sock, addr)
+        if handler is not None:
+            self.sessions += 1
+            if self.max_sessions and self.sessions >= self.max_sessions:
+                self.recycle("served %s sessions" % self.sessions)
+        return handler
+
+    def recycle(self, reason):
+        """Stop accepting connections, the worker exits when its sessions are done"""
+        if self.recycling:
+            return
+        self.recycling = True
+        logging.info("worker %s recycling: %s (%s sockets open)" % (os.getpid(), reason, len(self.ioloop.socket_map) - 1))
+        self.close()
+
+    def memory_usage(self):
+        """Returns the resident memory of the process in bytes"""
+        try:
+            with open("/proc/self/statm") as statm:
+                return int(statm.read().split()[1]) * resource.getpagesize()
+        except (IOError, IndexError, ValueError):
+            # peak usage, in KB on Linux
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def check_memory(self):
+        usage = self.memory_usage()
+        if usage > self.max_memory:
+            self.recycle("using %s bytes of memory" % usage)
+
+    def start_worker(self, worker_id):
+        """Fork a worker, returns in the parent"""
+        pid = os.fork()
+        if pid:
+            self.children[pid] = (worker_id, time.time())
+            return
+
+        # worker process
+        exit_code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            _reseed_random()
+            # as multiprocessing.Process does
+            util._run_after_forkers()
+            self.children = {}
+            self.worker = True
+            # the poller can't be shared with the other processes
+            parent_ioloop = self.ioloop
+            IOLoop._instance = None
+            self.ioloop = IOLoop.instance()
+            poller = getattr(parent_ioloop, "_poller", None)
+            if hasattr(poller, "close"):
+                poller.close()
+            self.use_socket(worker_id)
+            self.add_channel()
+            if self.max_memory:
+                self.ioloop.call_every(self.check_interval, self.check_memory)
+            logging.info("worker %s started (pid %s)" % (worker_id, os.getpid()))
+            self.ioloop.loop(timeout=1.0)
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        except Exception:
+            logging.exception("worker %s failed" % worker_id)
+            exit_code = 1
+        logging.shutdown()
+        os._exit(exit_code)
+
+    def terminate(self, *args):
+        raise SystemExit("Terminating on signal")
+
+    def wait_worker(self, timeout=None):
+        """
+        Wait for a worker to exit for up to timeout seconds (None: no
+        limit), returns its pid and exit status (pid 0 on timeout).
+        """
+        if timeout is None:
+            return os.wait()
+        deadline = time.time() + timeout
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno != errno.ECHILD:
+                    raise
+                # all the workers are waiting to be started again
+                pid, status = 0, 0
+            remaining = deadline - time.time()
+            if pid or remaining <= 0:
+                return pid, status
+            time.sleep(min(remaining, 0.05))
+
+    def serve_forever(self, timeout=None, blocking=True, handle_exit=True):
+        logging.info("starting %s worker processes (pid %s%s)" % (self.nworkers, os.getpid(),
+                                                                 ", reuse port" if self.reuse_port else ""))
+        if signal.getsignal(signal.SIGTERM) in (signal.SIG_DFL, None):
+            signal.signal(signal.SIGTERM, self.terminate)
+
+        # time a worker can be started again by worker id
+        restarts = {}
+        try:
+            for worker_id in xrange(self.nworkers):
+                self.start_worker(worker_id)
+            while self.children or restarts:
+                now = time.time()
+                for worker_id, not_before in restarts.items():
+                    if not_before <= now:
+                        del restarts[worker_id]
+                        self.start_worker(worker_id)
+                try:
+                    pid, status = self.wait_worker(max(min(restarts.values()) - now, 0) if restarts else None)
+                except OSError, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                if pid not in self.children:
+                    continue
+                worker_id, started = self.children.pop(pid)
+                if os.WIFSIGNALED(status):
+                    logging.warning("worker %s (pid %s) killed by signal %s" % (worker_id, pid, os.WTERMSIG(status)))
+                elif os.WEXITSTATUS(status):
+                    logging.warning("worker %s (pid %s) exited with status %s" % (worker_id, pid, os.WEXITSTATUS(status)))
+                else:
+                    logging.info("worker %s (pid %s) exited" % (worker_id, pid))
+                restarts[worker_id] = started + self.restart_delay
+        except (KeyboardInterrupt, SystemExit):
+            logging.info("shutting down %s worker processes" % len(self.children))
+        finally:
+            self.close_all()
+
+    def close_all(self):
+        """Terminate the workers"""
+        for pid in self.children.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    raise
+        for pid in self.children.keys():
+            try:
+                os.waitpid(pid, 0)
+            except OSError, e:
+                if e.errno not in (errno.ECHILD, errno.EINTR):
+                    raise
+        self.children = {}
+        for sock in self.sockets[1:]:
+            sock.close()
+        return FTPServer.close_all(self)
@@ -48,7 +48,9 @@ class ObjectStorageAuthorizer(DummyAuthorizer):
         """
         Validates the username and passwords.
 
-        This creates the AbstractedFS at the same time and caches it under the username for retrieval with get_abstracted_fs.
+        This creates the AbstractedFS at the same time and caches it under the handler for retrieval with get_abstracted_fs.
+
+        It may run in a worker thread (see MyFTPHandler.ftp_PASS).
         """
         try:
             cffs = ObjectStorageFtpFS(username, password)
@@ -56,16 +58,22 @@ class ObjectStorageAuthorizer(DummyAuthorizer):
             msg = "Failed to authenticate user %s: %s" % (username, e)
             handler.logerror(msg)
             raise AuthenticationFailed(msg)
-        self.abstracted_fs_for_user[username] = cffs
+        self.abstracted_fs_for_user[handler] = cffs
         handler.log("Authentication validated for user %s" % username)
 
-    def get_abstracted_fs(self, username):
+    def get_abstracted_fs(self, handler):
         """
-        Gets an AbstractedFs object for the user.
+        Gets the AbstractedFs object for the user logged in on handler.
 
-        Raises KeyError if username isn't found.
+        Raises KeyError if handler isn't found.
         """
-        return self.abstracted_fs_for_user.pop(username)
+        return self.abstracted_fs_for_user.pop(handler)
+
+    def discard_abstracted_fs(self, handler):
+        """Forget the AbstractedFs of a login that won't be completed."""
+        cffs = self.abstracted_fs_for_user.pop(handler, None)
+        if cffs is not None:
+            cffs.close()
 
     def has_user(self, username):
         return username != 'anonymous'
@@ -0,0 +1,100 @@
+"""
+    Adaptive chunk and buffer sizes.
+
+The size of the chunks of a transfer follows its throughput, so a fast
+transfer moves more data per read, write and system call, and the socket
+buffers of a connection are grown when its bandwidth-delay product doesn't
+fit in them (high-latency WAN clients).
+"""
+
+import time
+import socket
+import struct
+
+__all__ = ['ChunkSizer', 'tcp_rtt', 'grow_socket_buffer']
+
+# struct tcp_info (Linux), the first 8 bytes and 24 32-bit fields; tcpi_rtt is
+# the 16th field (microseconds)
+TCP_INFO = getattr(socket, "TCP_INFO", None)
+TCP_INFO_STRUCT = struct.Struct("<8B24I")
+TCP_INFO_RTT = 8 + 15
+
+class ChunkSizer(object):
+    """
+    Size of the chunks of a transfer, between minimum and maximum.
+
+    The throughput is measured in windows of window seconds, and the size is
+    doubled (or halved) while a chunk takes less than half (or more than
+    twice) interval seconds at that rate.
+    """
+
+    def __init__(self, minimum=65536, maximum=4194304, interval=0.01, window=0.25):
+        if not 0 < minimum <= maximum:
+            raise ValueError("Invalid chunk sizes: %s-%s" % (minimum, maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.interval = interval
+        self.window = window
+        self.size = minimum
+        # bytes per second (None until the first window is complete)
+        self.rate = None
+        self.start = None
+        self.bytes = 0
+
+    def update(self, nbytes, now=None):
+        """Account nbytes transferred, returns True if a window is complete (the size may change)"""
+        if now is None:
+            now = time.time()
+        if self.start is None:
+            self.start = now
+        self.bytes += nbytes
+        elapsed = now - self.start
+        if elapsed < self.window:
+            return False
+        rate = self.bytes / elapsed
+        self.rate = rate if self.rate is None else (self.rate + rate) / 2
+        self.start, self.bytes = now, 0
+
+        target = self.rate * self.interval
+        size = self.size
+        while size < self.maximum and target >= size * 2:
+            size *= 2
+        while size > self.minimum and target * 2 < size:
+            size //= 2
+        self.size = max(self.minimum, min(size, self.maximum))
+        return True
+
+def tcp_rtt(sock):
+    """Returns the smoothed round trip time of the TCP socket sock in seconds, or None if it's not available"""
+    if TCP_INFO is None:
+        return None
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, TCP_INFO, TCP_INFO_STRUCT.size)
+    except socket.error:
+        return None
+    if len(info) < TCP_INFO_STRUCT.size:
+        return None
+    return TCP_INFO_STRUCT.unpack(info)[TCP_INFO_RTT] / 1000000.0
+
+def grow_socket_buffer(sock, option, rate, maximum):
+    """
+    Double the socket buffer option (SO_SNDBUF or SO_RCVBUF) of sock, up to
+    maximum bytes, if the bandwidth-delay product of the connection at rate
+    bytes per second fills half of it.
+
+    A buffer sized by the kernel autotuning is bigger than that and it's not
+    changed (setting it disables the autotuning). Returns the new size, or
+    None if it wasn't changed.
+    """
+    rtt = tcp_rtt(sock)
+    if not rtt:
+        return None
+    try:
+        current = sock.getsockopt(socket.SOL_SOCKET, option)
+        if current >= maximum or rate * rtt * 2 < current:
+            return None
+        size = min(current * 2, maximum)
+        sock.setsockopt(socket.SOL_SOCKET, option, size)
+    except socket.error:
+        return None
+    return size
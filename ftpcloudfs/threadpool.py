@@ -0,0 +1,207 @@
+"""
+    Thread pool running blocking calls off the pyftpdlib IOLoop.
+
+The calls run in worker threads and their results are delivered back to the
+IOLoop that submitted them through a pipe registered in that IOLoop.
+"""
+
+import os
+import sys
+import fcntl
+import errno
+import logging
+import threading
+from Queue import Queue
+from collections import deque
+
+__all__ = ['ThreadPool', 'TaskTimeout']
+
+class TaskTimeout(Exception):
+    """The task didn't finish in time"""
+
+class IOLoopWaker(object):
+    """
+    Pipe registered in an IOLoop to run callbacks posted by other threads.
+
+    The IOLoop keeps running while the waker is registered, so it must be
+    closed when there are no more callbacks to wait for.
+    """
+
+    def __init__(self, ioloop):
+        self.ioloop = ioloop
+        self._read_fd, self._write_fd = os.pipe()
+        for fd in (self._read_fd, self._write_fd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        self._fileno = self._read_fd
+        self.callbacks = deque()
+        self.closed = False
+        ioloop.register(self._read_fd, self, ioloop.READ)
+
+    def post(self, callback, *args):
+        """Run callback(*args) in the IOLoop thread, can be called from any thread"""
+        self.callbacks.append((callback, args))
+        try:
+            os.write(self._write_fd, "x")
+        except OSError, e:
+            # the pipe is full, the IOLoop will be woken up anyway
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read_event(self):
+        try:
+            while os.read(self._read_fd, 4096):
+                pass
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        while self.callbacks:
+            callback, args = self.callbacks.popleft()
+            try:
+                callback(*args)
+            except Exception:
+                logging.exception("Error running callback %r" % callback)
+
+    def handle_error(self):
+        logging.error("IOLoop waker error: %s" % (sys.exc_info()[1],))
+
+    def handle_close(self):
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.ioloop.unregister(self._read_fd)
+        except (KeyError, EnvironmentError):
+            pass
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+class ThreadPool(object):
+    """
+    Pool of worker threads.
+
+    The workers are started on demand, up to threads, and there are at most
+    max_pending tasks running or waiting for a worker. The pool is reset in
+    a forked process (threads don't survive a fork).
+    """
+
+    def __init__(self, threads=4, max_pending=32):
+        self.threads = threads
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def _check_pid(self):
+        """Start from scratch in a new process"""
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.queue = Queue()
+            self.workers = []
+            self.pending = 0
+            # one waker per IOLoop with tasks pending: [waker, pending tasks]
+            self.wakers = {}
+
+    def _worker(self):
+        while True:
+            self.queue.get().run()
+
+    def _done(self):
+        """A task finished running, called from the worker thread"""
+        with self.lock:
+            self.pending -= 1
+
+    def submit(self, ioloop, func, callback, timeout=None, late_callback=None):
+        """
+        Run func() in a worker thread.
+
+        Must be called from the IOLoop thread. callback(result, error) is
+        called in the IOLoop when func returns (error is None) or raises
+        (result is None). If timeout seconds pass before that, callback is
+        called with a TaskTimeout error, and late_callback(result, error) is
+        called in the IOLoop if func finishes later.
+
+        Returns False if there are too many pending tasks.
+        """
+        with self.lock:
+            self._check_pid()
+            if self.pending >= self.max_pending:
+                return False
+            self.pending += 1
+            if len(self.workers) < min(self.pending, self.threads):
+                worker = threading.Thread(target=self._worker, name="ftpcloudfs-worker")
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+            waker = self.wakers.get(ioloop)
+            if waker is None:
+                waker = self.wakers[ioloop] = [IOLoopWaker(ioloop), 0]
+            waker[1] += 1
+        task = _Task(self, waker, func, callback, late_callback)
+        if timeout:
+            task.timer = ioloop.call_later(timeout, task.timed_out)
+        self.queue.put(task)
+        return True
+
+    def _release(self, ioloop, waker):
+        """A task of the IOLoop is done, close its waker if it was the last one"""
+        with self.lock:
+            waker[1] -= 1
+            if waker[1] == 0:
+                waker[0].close()
+                del self.wakers[ioloop]
+
+    def stats(self):
+        """Returns a dict with the pool statistics"""
+        return dict(workers=len(getattr(self, "workers", [])), pending=getattr(self, "pending", 0))
+
+class _Task(object):
+    """Task running in the thread pool"""
+
+    def __init__(self, pool, waker, func, callback, late_callback):
+        self.pool = pool
+        self.waker = waker
+        self.func = func
+        self.callback = callback
+        self.late_callback = late_callback
+        self.timer = None
+        self.done = False
+
+    def run(self):
+        """Run in a worker thread"""
+        try:
+            result, error = self.func(), None
+        except Exception, e:
+            result, error = None, e
+        # before posting the result, the IOLoop may submit a new task when it runs
+        self.pool._done()
+        self.waker[0].post(self.finished, result, error)
+
+    def finished(self, result, error):
+        """Run in the IOLoop"""
+        ioloop = self.waker[0].ioloop
+        try:
+            if not self.done:
+                self.done = True
+                if self.timer is not None:
+                    self.timer.cancel()
+                self.callback(result, error)
+            elif self.late_callback is not None:
+                self.late_callback(result, error)
+        finally:
+            self.pool._release(ioloop, self.waker)
+
+    def timed_out(self):
+        """Run in the IOLoop"""
+        if not self.done:
+            self.done = True
+            self.callback(None, TaskTimeout("Timed out"))
@@ -2,10 +2,39 @@
 import unittest
 import os
 import sys
+import stat
+import shutil
+import tempfile
+import socket
+import time
+import threading
+import signal
+import select
 from datetime import datetime
 from swiftclient import client
-from ftpcloudfs.fs import ObjectStorageFS, ListDirCache
+from ftpcloudfs.fs import ObjectStorageFS, ListDirCache, ProxyConnection
 from ftpcloudfs.errors import IOSError
+from ftpcloudfs.cache import LocalCache, MmapCache, SharedMemoryCache
+from ftpcloudfs.pool import ConnectionPool
+from ftpcloudfs.auth import TokenCache, CredentialCache
+from ftpcloudfs.threadpool import ThreadPool, TaskTimeout
+from ftpcloudfs.endpoints import EndpointPool
+from ftpcloudfs.hedge import HedgePolicy, hedged
+from ftpcloudfs.breaker import CircuitBreaker, CircuitOpen
+from ftpcloudfs.conntrack import ConnectionTracker
+from ftpcloudfs.ports import PortAllocator
+from ftpcloudfs.engine import StorageEngine, ReadAhead
+from ftpcloudfs.evented import ObjectStream
+from ftpcloudfs.chunkobject import ChunkObject
+from ftpcloudfs.sizing import ChunkSizer
+from ftpcloudfs.bandwidth import BandwidthScheduler
+from ftpcloudfs.admission import AdmissionController
+from ftpcloudfs.monkeypatching import MyDTPHandler, MyFTPHandler
+from ftpcloudfs.prefork import PreforkFTPServer
+from pyftpdlib.ioloop import IOLoop
+from pyftpdlib.handlers import FTPHandler
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
 
 import logging
 logging.getLogger("swiftclient").setLevel(logging.CRITICAL)
@@ -730,6 +759,7 @@ class MockupConnection(object):
     def __init__(self, num_objects, objects):
         self.num_objects = num_objects
         self.objects = objects
+        self.listings = 0
 
     @staticmethod
     def gen_object(name):
@@ -742,16 +772,42 @@ class MockupConnection(object):
     def gen_subdir(name):
         return dict(subdir=name)
 
+    def map(self, func, items):
+        return [func(self, item) for item in items]
+
     def list_containers_info(self):
         return [dict(count=self.num_objects, bytes=1024*self.num_objects, name='container'),]
 
     def get_account(self):
         return {}, [{ "name": "container", "count": self.num_objects, "bytes": self.num_objects*1024 },]
 
+    def head_container(self, container):
+        if container != 'container':
+            raise client.ClientException("Not found", http_status=404)
+        return { "x-container-object-count": str(self.num_objects),
+                 "x-container-bytes-used": str(self.num_objects*1024) }
+
+    def head_object(self, container, name):
+        if container == 'container' and not self.objects:
+            index = name[len('object'):-len('.txt')]
+            if name.startswith('object') and name.endswith('.txt') and index.isdigit() \
+               and int(index) < self.num_objects:
+                return { "content-length": "1024",
+                         "content-type": "text/plain",
+                         "etag": "c644eacf6e9c21c7d2cca3ce8bb0ec13",
+                         "last-modified": "Wed, 20 Jun 2012 00:00:00 GMT" }
+        raise client.ClientException("Not found", http_status=404)
+
     def get_container(self, container, prefix=None, delimiter=None, marker=None, limit=10000):
         if container != 'container':
             raise client.ClientException("Not found", http_status=404)
 
+        self.listings += 1
+
+        if prefix and not self.objects:
+            # no virtual directories in generated objects
+            return {}, []
+
         # test provided objects
         if self.objects:
             index = 0
@@ -790,9 +846,13 @@ class MockupConnection(object):
 class MockupOSFS(object):
     '''Mockup object to simulate a CFFS.'''
     memcache_hosts = None
-    auth_url = 'https://auth.service.fake/v1'
+    cache_backend = None
+    cache_options = {}
+    authurl = auth_url = 'https://auth.service.fake/v1'
     username = 'user'
+    tenant_name = None
     hide_part_dir = False
+    storage_policy = None
 
     def __init__(self, num_objects, objects=None):
         if objects and len(objects) != num_objects:
@@ -848,5 +908,1091 @@ class ListDirTest(unittest.TestCase):
         self.assertEqual(ld[0], '00dir_name')
         self.assertEqual(ld[1:], sorted(['object%s.txt' % i for i in xrange(10099)]))
 
+    def test_stat_point_lookup(self):
+        """Test stat in a large directory doesn't list the directory"""
+        cffs = MockupOSFS(10100)
+        lc = ListDirCache(cffs)
+        lc.point_lookup_threshold = 1000
+
+        st = lc.stat('/container/object42.txt')
+        self.assertEqual(st.st_size, 1024)
+        self.assertTrue(stat.S_ISREG(st.st_mode))
+        self.assertEqual(cffs.conn.listings, 0)
+        self.assertRaises(IOSError, lc.stat, '/container/missing.txt')
+        self.assertEqual(cffs.conn.listings, 1)
+
+    def test_stat_small_directory_lists(self):
+        """Test stat in a small directory uses the directory listing"""
+        cffs = MockupOSFS(100)
+        lc = ListDirCache(cffs)
+        lc.point_lookup_threshold = 1000
+
+        st = lc.stat('/container/object42.txt')
+        self.assertEqual(st.st_size, 1024)
+        self.assertEqual(cffs.conn.listings, 1)
+
+    def test_listdir_prefetch_subtree(self):
+        """Test listdir prefetching the subtree with one listing"""
+        objects = [MockupConnection.gen_object("a.txt"),
+                   MockupConnection.gen_object("dir/b.txt"),
+                   MockupConnection.gen_object("dir/sub/c.txt"),
+                   ]
+        cffs = MockupOSFS(3, objects)
+        lc = ListDirCache(cffs)
+        lc.prefetch_max_objects = 100
+
+        self.assertEqual(lc.listdir('/container'), ['a.txt', 'dir'])
+        self.assertEqual(lc.listdir('/container/dir'), ['b.txt', 'sub'])
+        self.assertEqual(lc.listdir('/container/dir/sub'), ['c.txt'])
+        self.assertTrue(stat.S_ISDIR(lc.stat('/container/dir/sub').st_mode))
+        self.assertEqual(lc.stat('/container/dir/sub/c.txt').st_size, 1024)
+        self.assertEqual(cffs.conn.listings, 1)
+
+    def test_listdir_index(self):
+        """Test listdir using the persistent metadata index"""
+        index_path = tempfile.mkdtemp()
+        try:
+            cffs = MockupOSFS(100)
+            lc = ListDirCache(cffs)
+            lc.index_path = index_path
+            ld = lc.listdir('/container')
+            self.assertEqual(len(ld), 100)
+            self.assertEqual(cffs.conn.listings, 1)
+
+            # a new session uses the index
+            lc = ListDirCache(cffs)
+            lc.index_path = index_path
+            self.assertEqual(lc.stat('/container/object42.txt').st_size, 1024)
+            self.assertEqual(sorted(lc.listdir('/container')), sorted(ld))
+            self.assertEqual(cffs.conn.listings, 1)
+
+            # flushing refreshes the listing
+            lc.flush('/container')
+            self.assertEqual(sorted(lc.listdir('/container')), sorted(ld))
+            self.assertEqual(cffs.conn.listings, 2)
+            lc.index.close()
+        finally:
+            shutil.rmtree(index_path)
+
+    def test_update_entry(self):
+        """Test changes update the cached listing instead of listing again"""
+        cffs = MockupOSFS(100)
+        lc = ListDirCache(cffs)
+        lc.backend = LocalCache()
+        lc.listdir('/container')
+        lc.update_entry('/container/new.txt', dict(bytes=10, content_type='text/plain'))
+        self.assertEqual(lc.stat('/container/new.txt').st_size, 10)
+        lc.update_entry('/container/dir', dict(content_type='application/directory'))
+        self.assertTrue(stat.S_ISDIR(lc.stat('/container/dir').st_mode))
+        lc.update_entry('/container/object42.txt')
+        ld = lc.listdir('/container')
+        self.assertEqual(len(ld), 101)
+        self.assertTrue('object42.txt' not in ld)
+        self.assertEqual(cffs.conn.listings, 1)
+
+    def test_overlay(self):
+        """Test recent changes mask a lagging listing"""
+        cffs = MockupOSFS(100)
+        lc = ListDirCache(cffs)
+        lc.update_entry('/container/new.txt', dict(bytes=10, content_type='text/plain'))
+        lc.update_entry('/container/object42.txt')
+        lc.update_entry('/container/object1.txt', MockupConnection.gen_object('object1.txt'))
+        ld = lc.listdir('/container')
+        self.assertTrue('new.txt' in ld)
+        self.assertTrue('object42.txt' not in ld)
+        self.assertEqual(lc.stat('/container/new.txt').st_size, 10)
+        self.assertRaises(IOSError, lc.stat, '/container/object42.txt')
+        # the listing includes object1.txt already
+        self.assertEqual(sorted(lc.overlay['/container'].keys()), ['new.txt', 'object42.txt'])
+        self.assertEqual(cffs.conn.listings, 1)
+
+    def test_shared_overlay(self):
+        """Test the shared overlay keeps the changes of the sessions per directory"""
+        cffs = MockupOSFS(100)
+        lc = ListDirCache(cffs)
+        other = ListDirCache(cffs)
+        lc.backend = other.backend = LocalCache()
+        lc.overlay_shared = other.overlay_shared = True
+        lc.update_entry('/container/new.txt', dict(bytes=10, content_type='text/plain'))
+        other.update_entry('/container/other.txt', dict(bytes=20, content_type='text/plain'))
+        other.update_entry('/container2/new.txt', dict(bytes=30, content_type='text/plain'))
+        self.assertEqual(sorted(lc.load_overlay('/container').keys()), ['new.txt', 'other.txt'])
+        self.assertEqual(lc.overlay_entry('/container2/new.txt')[1].st_size, 30)
+        self.assertEqual(lc.overlay, {})
+
+class CacheTest(unittest.TestCase):
+    '''Cache backends Tests.'''
+
+    def test_local_cache(self):
+        """Test the in-process LRU cache"""
+        cache = LocalCache(2)
+        cache.set("a", "1", 10)
+        cache.set("b", "2", 10)
+        self.assertEqual(cache.get("a"), "1")
+        cache.set("c", "3", 10)
+        # b was the least recently used
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("c"), "3")
+        cache.set("d", "4", -1)
+        self.assertEqual(cache.get("d"), None)
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['evictions'], 2)
+
+    def test_local_cache_threads(self):
+        """Test the in-process cache shared by several threads"""
+        cache = LocalCache(50)
+        def worker(n):
+            for i in xrange(500):
+                key = "%s-%s" % (n, i % 100)
+                cache.set(key, str(i), 10)
+                cache.get(key)
+                cache.delete("%s-%s" % (n, (i + 1) % 100))
+        threads = [threading.Thread(target=worker, args=(n,)) for n in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(len(cache.entries) <= 50)
+
+    def test_mmap_cache(self):
+        """Test the memory mapped file cache"""
+        path = tempfile.mktemp()
+        try:
+            cache = MmapCache(path, size=1024**2, slot_size=64*1024)
+            self.assertTrue(cache.set("a", "1"*4096, 10))
+            self.assertEqual(cache.get("a"), "1"*4096)
+            # another process opening the same file
+            other = MmapCache(path, size=1024**2, slot_size=64*1024)
+            self.assertEqual(other.get("a"), "1"*4096)
+            other.delete("a")
+            self.assertEqual(cache.get("a"), None)
+            self.assertFalse(cache.set("b", os.urandom(128*1024), 10))
+            self.assertEqual(cache.stats()['hits'], 1)
+            self.assertEqual(cache.stats()['too_large'], 1)
+            # a corrupt slot is a miss
+            self.assertTrue(cache.set("c", "3", 10))
+            _, offset = cache._slot("c")
+            cache.map[offset+MmapCache.HEADER.size:offset+MmapCache.HEADER.size+2] = "xx"
+            self.assertEqual(cache.get("c"), None)
+        finally:
+            os.remove(path)
+
+    def test_mmap_cache_unsafe_file(self):
+        """Test the mmap cache isn't used with a file accessible by others"""
+        fd, path = tempfile.mkstemp()
+        try:
+            os.close(fd)
+            os.chmod(path, 0644)
+            cache = MmapCache(path, size=1024**2, slot_size=64*1024)
+            self.assertFalse(cache.set("a", "1", 10))
+            self.assertEqual(cache.get("a"), None)
+            self.assertEqual(os.path.getsize(path), 0)
+        finally:
+            os.remove(path)
+
+    def test_shm_cache(self):
+        """Test the shared memory cache"""
+        # a single bucket
+        cache = SharedMemoryCache(size=4*4096, slot_size=4096)
+        pid = os.fork()
+        if pid == 0:
+            cache.set("a", "1", 10)
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(cache.get("a"), "1")
+        for key in "bcde":
+            self.assertTrue(cache.set(key, key, 10))
+        # a was the oldest
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(cache.get("e"), "e")
+        cache.delete("e")
+        self.assertEqual(cache.get("e"), None)
+        self.assertFalse(cache.set("f", os.urandom(8192), 10))
+        stats = cache.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['too_large'], 1)
+
+class TokenCacheTest(unittest.TestCase):
+    '''Auth token cache Tests'''
+
+    class MockupProxyConnection(ProxyConnection):
+        auths = 0
+        def authenticate(self):
+            self.auths += 1
+            return 'https://storage.service.fake/v1/AUTH_user', 'token%s' % self.auths, None
+
+    def test_token_cache(self):
+        """Test tokens are cached and a rejected token is refreshed"""
+        self.MockupProxyConnection.tokens = TokenCache()
+        conn = self.MockupProxyConnection(None, authurl='https://auth.service.fake/v1', user='user', key='key')
+        self.assertEqual(conn.get_auth()[1], 'token1')
+        self.assertEqual(conn.get_auth()[1], 'token1')
+        # another connection in the process
+        other = self.MockupProxyConnection(None, authurl='https://auth.service.fake/v1', user='user', key='key')
+        self.assertEqual(other.get_auth()[1], 'token1')
+        self.assertEqual(other.auths, 0)
+        # the storage returned 401
+        conn.token = None
+        self.assertEqual(conn.get_auth()[1], 'token2')
+        self.assertEqual(conn.auths, 2)
+        # a different password must be verified by the auth service
+        other = self.MockupProxyConnection(None, authurl='https://auth.service.fake/v1', user='user', key='other')
+        self.assertEqual(other.get_auth()[1], 'token1')
+        self.assertEqual(other.auths, 1)
+
+    def test_credential_cache(self):
+        """Test credentials verification"""
+        credentials = CredentialCache()
+        backend = LocalCache()
+        credentials.set("key", "secret", time.time() + 60, backend)
+        self.assertTrue("secret" not in backend.get("key"))
+        self.assertTrue(credentials.verify("key", "secret"))
+        self.assertFalse(credentials.verify("key", "other"))
+        # from the shared cache
+        self.assertTrue(CredentialCache().verify("key", "secret", backend))
+        self.assertFalse(CredentialCache().verify("key", "secret"))
+
+    def test_token_refresh(self):
+        """Test tokens about to expire are not used"""
+        tokens = TokenCache(refresh_margin=300)
+        backend = LocalCache()
+        tokens.set("key", "url", "token", time.time() + 200, backend)
+        self.assertEqual(tokens.get("key", backend), None)
+        tokens.set("key", "url", "token", time.time() + 400, backend)
+        self.assertEqual(TokenCache().get("key", backend)[:2], ("url", "token"))
+
+class ConnectionPoolTest(unittest.TestCase):
+    '''ConnectionPool Tests'''
+
+    class MockupSession(object):
+        closed = False
+        def close(self):
+            self.closed = True
+
+    class MockupHTTPConnection(object):
+        def __init__(self):
+            self.request_session = ConnectionPoolTest.MockupSession()
+
+    def factory(self):
+        return (None, self.MockupHTTPConnection())
+
+    def test_pool(self):
+        """Test connections are reused"""
+        pool = ConnectionPool(max_size=1, idle_timeout=60)
+        first = pool.get("a", self.factory)
+        pool.put("a", first)
+        self.assertTrue(pool.get("b", self.factory) is not first)
+        self.assertTrue(pool.get("a", self.factory) is first)
+        second = pool.get("a", self.factory)
+        pool.put("a", first)
+        pool.put("a", second)
+        # max size
+        self.assertTrue(first[1].request_session.closed)
+        pool.idle_timeout = 0
+        self.assertTrue(pool.get("a", self.factory) is not second)
+        self.assertTrue(second[1].request_session.closed)
+        self.assertEqual(pool.stats(), dict(idle=0, created=4, reused=1, discarded=2))
+
+class ConnectionTrackerTest(unittest.TestCase):
+    '''ConnectionTracker Tests.'''
+
+    def test_tracking(self):
+        """Test counting the connections per ip from several processes"""
+        tracker = ConnectionTracker(buckets=1)
+        self.assertEqual(tracker.connect("10.0.0.1"), 1)
+        self.assertEqual(tracker.connect("10.0.0.2"), 1)
+        pid = os.fork()
+        if pid == 0:
+            tracker.connect("10.0.0.1")
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(tracker.get("10.0.0.1"), 2)
+        self.assertEqual(tracker.disconnect("10.0.0.2"), 0)
+        # a single bucket: the free slots are reused
+        for n in xrange(tracker.WAYS - 1):
+            self.assertEqual(tracker.connect("10.0.1.%s" % n), 1)
+        self.assertEqual(tracker.connect("10.0.2.1"), None)
+        self.assertEqual(tracker.disconnect("10.0.2.1"), 0)
+        self.assertEqual(tracker.get("10.0.0.1"), 2)
+
+class PortAllocatorTest(unittest.TestCase):
+    '''PortAllocator Tests.'''
+
+    def test_allocate(self):
+        """Test allocating and releasing passive ports"""
+        allocator = PortAllocator(60000, 60002)
+        ports = [allocator.allocate() for _ in xrange(3)]
+        self.assertEqual(ports, [60000, 60001, 60002])
+        self.assertEqual(allocator.allocate(), None)
+        allocator.hold(60001)
+        allocator.release(60001)
+        self.assertEqual(allocator.allocate(), None)
+        allocator.release(60001)
+        allocator.release(60000)
+        # released ports are reused last
+        self.assertEqual(allocator.allocate(), 60001)
+        self.assertEqual(allocator.stats(), dict(ports=3, in_use=2, failed=2, reclaimed=0))
+
+    def test_reclaim(self):
+        """Test reclaiming the ports of a process that is gone"""
+        allocator = PortAllocator(60000, 60001)
+        self.assertEqual(allocator.allocate(), 60000)
+        pid = os.fork()
+        if pid == 0:
+            allocator.allocate()
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(allocator.allocate(), 60001)
+        self.assertEqual(allocator.stats()['reclaimed'], 1)
+
+class ThreadPoolTest(unittest.TestCase):
+    '''ThreadPool Tests'''
+
+    def setUp(self):
+        self.ioloop = IOLoop()
+        self.results = []
+
+    def tearDown(self):
+        self.ioloop.close()
+
+    def callback(self, result, error):
+        self.results.append((result, error))
+
+    def run_ioloop(self, results=1):
+        deadline = time.time() + 5
+        while len(self.results) < results and time.time() < deadline:
+            self.ioloop.loop(timeout=0.1, blocking=False)
+
+    def test_submit(self):
+        """Test the results are delivered in the IOLoop"""
+        pool = ThreadPool(threads=2, max_pending=2)
+        event = threading.Event()
+        self.assertTrue(pool.submit(self.ioloop, lambda: event.wait(5) and 42, self.callback))
+        self.assertTrue(pool.submit(self.ioloop, lambda: event.wait(5) and 1/0, self.callback))
+        self.assertFalse(pool.submit(self.ioloop, lambda: 0, self.callback))
+        event.set()
+        self.run_ioloop(2)
+        self.assertEqual(len(self.results), 2)
+        self.assertTrue((42, None) in self.results)
+        self.assertTrue([error for _, error in self.results if isinstance(error, ZeroDivisionError)])
+        # the waker is unregistered when there's nothing pending
+        self.assertEqual(self.ioloop.socket_map, {})
+        self.assertEqual(pool.stats(), dict(workers=2, pending=0))
+
+    def test_timeout(self):
+        """Test a task timing out"""
+        pool = ThreadPool(threads=1)
+        late = []
+        self.assertTrue(pool.submit(self.ioloop, lambda: time.sleep(0.5) or 42, self.callback,
+                                    timeout=0.1, late_callback=lambda *args: late.append(args)))
+        self.run_ioloop()
+        self.assertEqual(len(self.results), 1)
+        self.assertTrue(isinstance(self.results[0][1], TaskTimeout))
+        deadline = time.time() + 5
+        while not late and time.time() < deadline:
+            self.ioloop.loop(timeout=0.1, blocking=False)
+        self.assertEqual(late, [(42, None)])
+        self.assertEqual(len(self.results), 1)
+
+class FakeSwiftHandler(BaseHTTPRequestHandler):
+    """Replies to any request with the status of the server"""
+    protocol_version = "HTTP/1.1"
+
+    def reply(self):
+        self.server.requests.append((self.command, self.path))
+        body = self.server.body if self.command == "GET" else ""
+        self.send_response(self.server.status)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Account-Container-Count", "0")
+        self.send_header("X-Account-Object-Count", "0")
+        self.send_header("X-Account-Bytes-Used", "0")
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_HEAD = reply
+
+    def do_PUT(self):
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            data = []
+            while True:
+                size = int(self.rfile.readline(), 16)
+                data.append(self.rfile.read(size + 2)[:size])
+                if not size:
+                    break
+            self.server.body = "".join(data)
+        else:
+            self.server.body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.reply()
+
+    def log_message(self, *args):
+        pass
+
+class FakeSwiftServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class FakeSwiftTestCase(unittest.TestCase):
+    """Base of the tests using fake object storage servers"""
+
+    def setUp(self):
+        self.servers = []
+        for _ in xrange(2):
+            server = FakeSwiftServer(("127.0.0.1", 0), FakeSwiftHandler)
+            server.status = 204
+            server.requests = []
+            server.body = ""
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            self.servers.append(server)
+        self.urls = ["http://127.0.0.1:%s" % server.server_port for server in self.servers]
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+class SwiftRequestsTest(FakeSwiftTestCase):
+    '''Requests to fake object storage servers Tests'''
+
+    def test_health_check(self):
+        """Test an endpoint failing the health check is ejected"""
+        pool = EndpointPool(self.urls, check_interval=0)
+        self.servers[1].status = 503
+        self.assertTrue(pool.check(pool.endpoints[0]))
+        self.assertFalse(pool.check(pool.endpoints[1]))
+        self.assertEqual(self.servers[1].requests, [("GET", "/healthcheck")])
+        for _ in xrange(4):
+            endpoint = pool.acquire()
+            self.assertEqual(endpoint.url, self.urls[0])
+        self.assertEqual(pool.stats()[self.urls[0]]["in_flight"], 4)
+        self.assertTrue(pool.stats()[self.urls[1]]["ejected"])
+        self.servers[1].status = 200
+        self.assertTrue(pool.check(pool.endpoints[1]))
+        # least loaded
+        self.assertEqual(pool.acquire().url, self.urls[1])
+
+    def test_shared_health_check(self):
+        """Test the health checks run in one process and their results are shared"""
+        pool = EndpointPool(self.urls, check_interval=60)
+        self.assertTrue(pool._claim_checker())
+        self.servers[1].status = 503
+        self.assertFalse(pool.check(pool.endpoints[1]))
+        pid = os.fork()
+        if pid == 0:
+            urls = set(pool.acquire().url for _ in xrange(4))
+            # no checker in this process, the result of the check is used
+            os._exit(0 if pool.checker is None and urls == set([self.urls[0]]) else 1)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertEqual(self.servers[1].requests, [("GET", "/healthcheck")])
+
+    def test_routing(self):
+        """Test the requests are routed to the endpoints"""
+        pool = EndpointPool(self.urls, max_failures=1, check_interval=0)
+        conn = ProxyConnection(None, preauthurl="http://storage/v1/AUTH_test", preauthtoken="token",
+                               retries=1, starting_backoff=0)
+        conn.endpoints = pool
+        conn.head_account()
+        conn.head_account()
+        self.assertEqual(self.servers[0].requests, [("HEAD", "/v1/AUTH_test")])
+        self.assertEqual(self.servers[1].requests, [("HEAD", "/v1/AUTH_test")])
+        # the failing endpoint is ejected and the request retried
+        self.servers[0].status = 503
+        conn.head_account()
+        conn.head_account()
+        self.assertEqual(len(self.servers[0].requests), 2)
+        self.assertEqual(len(self.servers[1].requests), 3)
+        self.assertTrue(pool.stats()[self.urls[0]]["ejected"])
+        self.assertEqual(pool.stats()[self.urls[1]]["in_flight"], 0)
+        conn.close()
+
+    def test_concurrent_requests(self):
+        """Test the requests run concurrently with clones of the connection"""
+        conn = ProxyConnection(None, preauthurl=self.urls[0] + "/v1/AUTH_test", preauthtoken="token")
+        conn.engine = StorageEngine(threads=2)
+        names = ["object%s" % index for index in xrange(4)]
+        results = conn.map(lambda clone, name: clone.head_object("container", name), names)
+        self.assertEqual(len(results), 4)
+        self.assertEqual(sorted(self.servers[0].requests),
+                         [("HEAD", "/v1/AUTH_test/container/%s" % name) for name in names])
+        self.assertEqual(conn.http_conn, None)
+        conn.close()
+
+    def test_retries(self):
+        """Test only the idempotent requests are retried"""
+        self.servers[0].status = 503
+        conn = ProxyConnection(None, preauthurl="%s/v1/AUTH_test" % self.urls[0], preauthtoken="token",
+                               retries=2, starting_backoff=0)
+        self.assertRaises(client.ClientException, conn.head_object, "container", "object")
+        self.assertEqual(len(self.servers[0].requests), 3)
+        self.assertRaises(client.ClientException, conn.put_object, "container", "object", iter(["data"]))
+        self.assertEqual(len(self.servers[0].requests), 4)
+        conn.close()
+
+    def test_circuit_breaker(self):
+        """Test the requests fail fast when the circuit is open"""
+        self.servers[0].status = 503
+        conn = ProxyConnection(None, preauthurl="%s/v1/AUTH_test" % self.urls[0], preauthtoken="token",
+                               retries=2, starting_backoff=0)
+        conn.breaker = CircuitBreaker(max_failures=2, reset_timeout=0.2)
+        self.assertRaises(CircuitOpen, conn.head_object, "container", "object")
+        self.assertEqual(len(self.servers[0].requests), 2)
+        self.assertTrue(conn.breaker.is_open())
+        self.assertRaises(CircuitOpen, conn.head_object, "container", "object")
+        self.assertEqual(len(self.servers[0].requests), 2)
+        time.sleep(0.3)
+        # half open, a single request
+        self.servers[0].status = 204
+        conn.head_object("container", "object")
+        self.assertEqual(len(self.servers[0].requests), 3)
+        self.assertEqual(conn.breaker.stats(), dict(state="closed", failures=0, opened=1, rejected=2))
+        conn.close()
+
+    def test_circuit_breaker_half_open(self):
+        """Test a test request that is never recorded doesn't keep the circuit half open"""
+        breaker = CircuitBreaker(max_failures=1, reset_timeout=0.2)
+        breaker.record(False)
+        time.sleep(0.3)
+        breaker.check()
+        self.assertTrue(breaker.is_open())
+        self.assertRaises(CircuitOpen, breaker.check)
+        time.sleep(0.3)
+        self.assertFalse(breaker.is_open())
+        breaker.check()
+
+    def test_chunk_object_connect_error(self):
+        """Test a PUT that can't connect is reported to the circuit breaker"""
+        # nothing listening
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        conn = ProxyConnection(None, preauthurl="http://127.0.0.1:%s/v1/AUTH_test" % port, preauthtoken="token")
+        conn.breaker = CircuitBreaker(max_failures=1, reset_timeout=0)
+        conn.breaker.record(False)
+        conn.admission = AdmissionController(workers=4)
+        obj = ChunkObject(conn, "container", "object")
+        self.assertEqual(conn.admission.stats()["requests"], 0)
+        self.assertRaises(client.ClientException, obj.send_chunk, "data")
+        self.assertRaises(client.ClientException, obj.finish_chunk)
+        self.assertEqual(conn.breaker.stats()["state"], "open")
+        self.assertEqual(conn.admission.stats()["requests"], 0)
+
+    def test_chunk_object_abandoned(self):
+        """Test an abandoned PUT is no longer in flight"""
+        conn = ProxyConnection(None, preauthurl="%s/v1/AUTH_test" % self.urls[0], preauthtoken="token")
+        conn.breaker = CircuitBreaker(max_failures=1)
+        conn.admission = AdmissionController(workers=4)
+        obj = ChunkObject(conn, "container", "object")
+        obj.send_chunk("data")
+        self.assertEqual(conn.admission.stats()["requests"], 1)
+        obj.close()
+        self.assertEqual(conn.admission.stats()["requests"], 0)
+        self.assertEqual(conn.breaker.stats()["failures"], 0)
+        conn.close()
+
+class FakeDTP(object):
+    """Data channel receiving the data of an ObjectStream"""
+
+    def __init__(self, ioloop):
+        self.ioloop = ioloop
+        self.data = []
+        self.tot_bytes_sent = 0
+        self.result = None
+
+    def push(self, data):
+        self.data.append(data)
+        self.tot_bytes_sent += len(data)
+
+    def end_stream(self):
+        self.result = "end"
+
+    def abort_stream(self, msg):
+        self.result = "abort"
+
+    def fallback_stream(self):
+        self.result = "fallback"
+
+class EventedTest(FakeSwiftTestCase):
+    '''Evented transfers Tests'''
+
+    def setUp(self):
+        FakeSwiftTestCase.setUp(self)
+        self.ioloop = IOLoop()
+        self.conn = ProxyConnection(None, preauthurl=self.urls[0] + "/v1/AUTH_test", preauthtoken="token")
+
+    def tearDown(self):
+        self.conn.close()
+        self.ioloop.close()
+        FakeSwiftTestCase.tearDown(self)
+
+    def run_ioloop(self, done):
+        deadline = time.time() + 5
+        while not done() and time.time() < deadline:
+            self.ioloop.loop(timeout=0.1, blocking=False)
+
+    def test_stream(self):
+        """Test an object is pushed to the data channel from the IOLoop"""
+        self.servers[0].status = 200
+        self.servers[0].body = "x" * 300000
+        dtp = FakeDTP(self.ioloop)
+        stream = ObjectStream(self.conn, "container", "object")
+        self.assertTrue(stream.start(dtp))
+        self.run_ioloop(lambda: dtp.result)
+        self.assertEqual(dtp.result, "end")
+        self.assertEqual("".join(dtp.data), self.servers[0].body)
+        self.assertEqual(self.ioloop.socket_map, {})
+        # failing before sending any data
+        self.servers[0].status = 404
+        dtp = FakeDTP(self.ioloop)
+        self.assertTrue(ObjectStream(self.conn, "container", "object").start(dtp))
+        self.run_ioloop(lambda: dtp.result)
+        self.assertEqual(dtp.result, "fallback")
+        self.assertEqual(self.servers[0].requests, [("GET", "/v1/AUTH_test/container/object")]*2)
+
+    def test_stream_closed(self):
+        """Test a stream closed by the client isn't an object storage failure"""
+        self.conn.breaker = CircuitBreaker(max_failures=1)
+        self.conn.endpoints = EndpointPool(self.urls, max_failures=1, check_interval=0)
+        stream = ObjectStream(self.conn, "container", "object")
+        self.assertTrue(stream.start(FakeDTP(self.ioloop)))
+        endpoint = stream.endpoint
+        self.assertEqual(endpoint.in_flight, 1)
+        stream.close()
+        self.assertEqual(self.ioloop.socket_map, {})
+        self.assertEqual(endpoint.in_flight, 0)
+        self.assertEqual(endpoint.failures, 0)
+        self.assertEqual(self.conn.breaker.stats()["state"], "closed")
+        self.assertEqual(self.conn.breaker.stats()["failures"], 0)
+
+    def test_chunk_object(self):
+        """Test the chunks of a PUT are sent from the IOLoop"""
+        drained = []
+        obj = ChunkObject(self.conn, "container", "object")
+        obj.attach(self.ioloop, lambda: drained.append(obj.backlog()))
+        # views of a reused buffer
+        data = bytearray(65536)
+        for index in xrange(16):
+            data[:] = chr(65 + index) * 65536
+            obj.send_chunk(memoryview(data))
+        obj.send_chunk("small")
+        self.run_ioloop(lambda: obj.backlog() == 0)
+        self.assertEqual(obj.backlog(), 0)
+        obj.finish_chunk()
+        self.assertEqual(self.ioloop.socket_map, {})
+        self.assertEqual(self.servers[0].body, "".join(chr(65 + index) * 65536 for index in xrange(16)) + "small")
+        self.assertEqual(self.servers[0].requests, [("PUT", "/v1/AUTH_test/container/object")])
+
+    def test_timeout(self):
+        """Test the evented transfers time out when the object storage stalls"""
+        # connections are accepted by the kernel, but nothing is read or replied
+        stalled = socket.socket()
+        stalled.bind(("127.0.0.1", 0))
+        stalled.listen(5)
+        conn = ProxyConnection(None, preauthurl="http://127.0.0.1:%s/v1/AUTH_test" % stalled.getsockname()[1],
+                               preauthtoken="token")
+        conn.timeouts = dict(conn.timeouts, get=0.2, put=0.2)
+        conn.breaker = CircuitBreaker(max_failures=2)
+        dtp = FakeDTP(self.ioloop)
+        self.assertTrue(ObjectStream(conn, "container", "object").start(dtp))
+        self.run_ioloop(lambda: dtp.result)
+        self.assertEqual(dtp.result, "fallback")
+        self.assertEqual(conn.breaker.stats()["failures"], 1)
+        # the data is pending until the socket buffers are full
+        obj = ChunkObject(conn, "container", "object")
+        obj.attach(self.ioloop, lambda: None)
+        while not obj.backlog():
+            obj.send_chunk("x" * 1048576)
+        self.run_ioloop(lambda: obj.error)
+        self.assertEqual(obj.error, "timed out")
+        self.assertRaises(client.ClientException, obj.finish_chunk)
+        self.assertEqual(conn.breaker.stats()["state"], "open")
+        self.assertEqual(self.ioloop.socket_map, {})
+        conn.close()
+        stalled.close()
+
+class ChunkSizerTest(unittest.TestCase):
+    '''ChunkSizer Tests'''
+
+    def test_sizes(self):
+        """Test the chunk size follows the throughput"""
+        sizer = ChunkSizer(minimum=1024, maximum=65536, interval=0.01, window=1)
+        self.assertFalse(sizer.update(1000000, now=0))
+        # 1MB/s, 10KB in an interval
+        self.assertTrue(sizer.update(0, now=1))
+        self.assertEqual(sizer.size, 8192)
+        # 100MB/s (averaged with the previous window)
+        sizer.update(100000000, now=2)
+        self.assertEqual(sizer.size, 65536)
+        # slow windows
+        for now in xrange(3, 16):
+            sizer.update(0, now=now)
+        self.assertEqual(sizer.size, 1024)
+        self.assertRaises(ValueError, ChunkSizer, 2048, 1024)
+
+class FakeCmdChannel(object):
+    """Command channel of a data channel"""
+    username = "user"
+    remote_ip = "127.0.0.1"
+    passive_allocator = None
+
+    def __init__(self, ioloop):
+        self.ioloop = ioloop
+
+    def log(self, msg):
+        pass
+
+    log_exception = respond = log
+
+    def _on_dtp_close(self):
+        pass
+
+    def get_repr_info(self, as_str=False):
+        return "fake"
+
+class BandwidthSchedulerTest(unittest.TestCase):
+    '''BandwidthScheduler Tests'''
+
+    def test_user_limit(self):
+        """Test the transfers of a user share its limit"""
+        scheduler = BandwidthScheduler(user_limit=1000, burst=1, buckets=16)
+        transfer = scheduler.start("user", "127.0.0.1")
+        self.assertEqual(scheduler.charge(transfer, 1000, now=0), 0)
+        self.assertEqual(scheduler.charge(transfer, 500, now=0), 0.5)
+        other = scheduler.start("user", "127.0.0.2")
+        self.assertEqual(scheduler.charge(other, 500, now=1), 0)
+        scheduler.finish(other)
+        scheduler.finish(transfer)
+        self.assertEqual(scheduler.stats()["users"], 0)
+        self.assertEqual(transfer.entry, None)
+
+    def test_fair_share(self):
+        """Test the server limit is shared by user and then by transfer"""
+        scheduler = BandwidthScheduler(limit=1000, burst=1, buckets=16)
+        a = scheduler.start("a", "127.0.0.1")
+        b1 = scheduler.start("b", "127.0.0.1")
+        b2 = scheduler.start("b", "127.0.0.1")
+        self.assertEqual(scheduler.stats(), dict(users=2, weight=2, reclaimed=0))
+        # a gets 500 bytes/s, every transfer of b 250 bytes/s
+        self.assertEqual(scheduler.charge(a, 1000, now=0), 1.0)
+        self.assertEqual(scheduler.charge(b1, 500, now=0), 1.0)
+        scheduler.finish(b1)
+        scheduler.finish(b2)
+        self.assertEqual(scheduler.stats(), dict(users=1, weight=1, reclaimed=0))
+        self.assertRaises(ValueError, BandwidthScheduler, -1)
+
+    def test_reclaim(self):
+        """Test the transfers of a process that is gone are reclaimed"""
+        scheduler = BandwidthScheduler(user_limit=1000, burst=1, buckets=16, transfers=2)
+        pid = os.fork()
+        if pid == 0:
+            # gone without finishing the transfers
+            scheduler.start("a", "127.0.0.1")
+            scheduler.start("a", "127.0.0.1")
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(scheduler.stats(), dict(users=1, weight=1, reclaimed=0))
+        # the table is full, the transfers are reclaimed to make room
+        transfer = scheduler.start("b", "127.0.0.1")
+        self.assertNotEqual(transfer.entry, None)
+        self.assertEqual(scheduler.stats(), dict(users=1, weight=1, reclaimed=2))
+        # the user bucket is free again
+        self.assertEqual(scheduler.charge(scheduler.start("a", "127.0.0.1"), 1000, now=0), 0)
+        self.assertEqual(scheduler.sweep(), 0)
+
+    def test_throttle(self):
+        """Test the data channel stops transferring while it's over the limits"""
+        ioloop = IOLoop()
+        sock, other = socket.socketpair()
+        dtp = MyDTPHandler(sock, FakeCmdChannel(ioloop))
+        dtp.bandwidth = BandwidthScheduler(user_limit=1000, burst=1, buckets=16)
+        dtp.modify_ioloop_events(ioloop.WRITE)
+        dtp.throttle(1000)
+        self.assertFalse(dtp.sleeping)
+        dtp.throttle(100)
+        self.assertTrue(dtp.sleeping)
+        self.assertEqual(dtp._current_io_events, 0)
+        self.assertNotEqual(dtp.throttler, None)
+        # the events wanted while sleeping are set when it wakes up
+        dtp.modify_ioloop_events(ioloop.READ)
+        self.assertEqual(dtp._current_io_events, 0)
+        dtp.wake_up()
+        self.assertFalse(dtp.sleeping)
+        self.assertEqual(dtp._current_io_events, ioloop.READ)
+        self.assertEqual(dtp.bandwidth.stats()["users"], 1)
+        # closing a sleeping channel cancels the throttler and finishes the transfer
+        dtp.throttle(1000)
+        throttler = dtp.throttler
+        dtp.close()
+        self.assertTrue(throttler.cancelled)
+        self.assertEqual(dtp.throttler, None)
+        self.assertEqual(dtp.transfer, None)
+        self.assertEqual(dtp.bandwidth.stats()["users"], 0)
+        other.close()
+        ioloop.close()
+
+class FakeFTPHandler(MyFTPHandler):
+    """Command channel recording the replies"""
+
+    def __init__(self, authenticated):
+        self.authenticated = authenticated
+        self.username = "user"
+        self.fs = None
+        self.replies = []
+        self.closing = False
+
+    def respond(self, resp, logfun=None):
+        self.replies.append(resp)
+
+    def close_when_done(self):
+        self.closing = True
+
+    def logline(self, msg, *args, **kwargs):
+        pass
+
+    logerror = logline
+
+class AdmissionControllerTest(unittest.TestCase):
+    '''AdmissionController Tests'''
+
+    def test_requests(self):
+        """Test the requests in flight of the processes are limited"""
+        admission = AdmissionController(max_requests=2, max_node_requests=3, workers=4)
+        admission.start()
+        self.assertEqual(admission.overloaded(), None)
+        admission.start()
+        self.assertNotEqual(admission.overloaded(), None)
+        admission.finish()
+        admission.finish(0.1)
+        self.assertEqual(admission.overloaded(), None)
+
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            for _ in range(3):
+                admission.start()
+            os.write(write, "x")
+            time.sleep(10)
+            os._exit(0)
+        try:
+            os.read(read, 1)
+            self.assertEqual(admission.stats()["node_requests"], 3)
+            self.assertNotEqual(admission.overloaded(), None)
+        finally:
+            os.kill(pid, 9)
+            os.waitpid(pid, 0)
+            os.close(read)
+            os.close(write)
+        # the requests of a process that is gone don't count
+        self.assertEqual(admission.overloaded(), None)
+        self.assertEqual(admission.stats()["rejected"], 2)
+
+    def test_latency(self):
+        """Test the recent latency is limited"""
+        admission = AdmissionController(max_latency=1, halflife=0.1)
+        for _ in range(10):
+            admission.start()
+            admission.finish(5)
+        self.assertNotEqual(admission.overloaded(), None)
+        # decays without responses
+        time.sleep(0.5)
+        self.assertEqual(admission.overloaded(), None)
+        self.assertRaises(ValueError, AdmissionController, 0, 0, 0, 0)
+
+    def test_shedding(self):
+        """Test the logins and the data transfers are rejected while overloaded"""
+        admission = AdmissionController(max_requests=1, retry_after=3)
+        admission.start()
+        ProxyConnection.admission = admission
+        try:
+            handler = FakeFTPHandler(authenticated=False)
+            handler.ftp_PASS("password")
+            self.assertEqual(handler.replies, ["421 Server busy, try again in 3 seconds."])
+            self.assertTrue(handler.closing)
+            handler = FakeFTPHandler(authenticated=True)
+            for cmd in MyFTPHandler.shed_cmds:
+                handler.process_command(cmd, "file")
+            self.assertEqual(handler.replies,
+                             ["450 Server busy, try again in 3 seconds."] * len(MyFTPHandler.shed_cmds))
+            self.assertFalse(handler.closing)
+            self.assertEqual(admission.stats()["rejected"], 1 + len(MyFTPHandler.shed_cmds))
+        finally:
+            ProxyConnection.admission = None
+
+class HedgeTest(unittest.TestCase):
+    '''Hedged requests Tests'''
+
+    def test_hedged(self):
+        """Test a slow request is hedged within the budget"""
+        policy = HedgePolicy(budget=0, burst=1, default_delay=0.05)
+        discarded = []
+        def request(hedge):
+            if not hedge:
+                time.sleep(0.3)
+            return hedge
+        self.assertEqual(hedged(policy, request, discarded.append), True)
+        self.assertEqual(hedged(policy, request, discarded.append), False)
+        time.sleep(0.5)
+        self.assertEqual(discarded, [False])
+        self.assertEqual(policy.stats(), dict(requests=2, hedged=1, hedge_wins=1, delay=0.05))
+
+    def test_hedged_errors(self):
+        """Test the first error is raised if all the requests fail"""
+        policy = HedgePolicy(default_delay=0.05)
+        def request(hedge):
+            if hedge:
+                raise ValueError("hedge")
+            time.sleep(0.1)
+            raise KeyError("first")
+        self.assertRaises(KeyError, hedged, policy, request, None)
+        def request(hedge):
+            if hedge:
+                raise ValueError("hedge")
+            time.sleep(0.1)
+            return "first"
+        self.assertEqual(hedged(policy, request, None), "first")
+
+    def test_delay(self):
+        """Test the delay is a percentile of the latency"""
+        policy = HedgePolicy(percentile=90, min_samples=10, min_delay=0)
+        for latency in xrange(100):
+            policy.record(latency / 100.0)
+        self.assertEqual(policy.delay(), 0.9)
+
+class StorageEngineTest(unittest.TestCase):
+    '''StorageEngine Tests'''
+
+    class Conn(object):
+        closed = 0
+        def close(self):
+            StorageEngineTest.Conn.closed += 1
+
+    def test_map(self):
+        """Test running the calls concurrently"""
+        engine = StorageEngine(threads=4)
+        threads = set()
+        def func(conn, item):
+            time.sleep(0.05)
+            threads.add(threading.current_thread())
+            return item * 2
+        start = time.time()
+        self.assertEqual(engine.map(self.Conn, func, range(8)), range(0, 16, 2))
+        self.assertTrue(time.time() - start < 0.3)
+        self.assertEqual(len(threads), 4)
+        self.assertEqual(self.Conn.closed, 8)
+        def fail(conn, item):
+            if item % 2:
+                raise ValueError(item)
+        self.assertRaises(ValueError, engine.map, self.Conn, fail, range(4))
+        self.assertEqual(engine.stats(), dict(workers=4, requests=12))
+
+    def test_read_ahead(self):
+        """Test reading an iterator ahead"""
+        read = []
+        def chunks():
+            for chunk in "abcd":
+                read.append(chunk)
+                yield chunk
+        self.assertEqual(list(ReadAhead(chunks())), list("abcd"))
+        del read[:]
+        reader = ReadAhead(chunks(), depth=1)
+        self.assertEqual(reader.next(), "a")
+        time.sleep(0.1)
+        # one chunk in the queue and one waiting
+        self.assertEqual(read, list("abc"))
+        reader.close()
+        self.assertRaises(StopIteration, reader.next)
+        def error():
+            yield "a"
+            raise IOError("failed")
+        reader = ReadAhead(error())
+        self.assertEqual(reader.next(), "a")
+        self.assertRaises(IOError, reader.next)
+
+class PidFTPHandler(FTPHandler):
+    """Command channel telling the pid of the worker in the banner"""
+
+    def handle(self):
+        self.banner = "worker %s" % os.getpid()
+        FTPHandler.handle(self)
+
+class PreforkFTPServerTest(unittest.TestCase):
+    '''PreforkFTPServer Tests'''
+
+    def setUp(self):
+        self.pid = None
+
+    def tearDown(self):
+        if self.pid is not None:
+            os.kill(self.pid, signal.SIGTERM)
+            os.waitpid(self.pid, 0)
+
+    def start_server(self, **settings):
+        """Run a server in a new process, returns its port"""
+        class Server(PreforkFTPServer):
+            pass
+        for name, value in settings.items():
+            setattr(Server, name, value)
+        server = Server(("127.0.0.1", 0), PidFTPHandler, ioloop=IOLoop())
+        port = server.socket.getsockname()[1]
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        server.close_all()
+        return port
+
+    def connect(self, port):
+        """Returns the socket of a new session and the pid of its worker"""
+        sock = socket.create_connection(("127.0.0.1", port), timeout=10)
+        banner = sock.makefile().readline()
+        self.assertTrue(banner.startswith("220 worker "), banner)
+        return sock, int(banner.split()[2])
+
+    def test_reuse_port(self):
+        """Test the connections are served while the workers with their own sockets are replaced"""
+        port = self.start_server(workers=2, max_sessions=1, reuse_port=True, restart_delay=0.1)
+        pids = set()
+        for _ in range(6):
+            sock, pid = self.connect(port)
+            sock.close()
+            pids.add(pid)
+        # a worker per session
+        self.assertEqual(len(pids), 6)
+
+    def test_max_sessions(self):
+        """Test a worker stops accepting after max_sessions and is replaced when its sessions are done"""
+        port = self.start_server(workers=1, max_sessions=1, restart_delay=0.1)
+        first, pid = self.connect(port)
+        waiting = socket.create_connection(("127.0.0.1", port), timeout=10)
+        # not accepted by the recycling worker
+        self.assertEqual(select.select([waiting], [], [], 0.5)[0], [])
+        # the open session keeps working
+        first.sendall("NOOP\r\n")
+        self.assertTrue(first.makefile().readline().startswith("200 "))
+        first.close()
+        banner = waiting.makefile().readline()
+        self.assertTrue(banner.startswith("220 worker "), banner)
+        self.assertNotEqual(int(banner.split()[2]), pid)
+        waiting.close()
+
+    def test_close_all(self):
+        """Test closing the server terminates and reaps the workers"""
+        server = PreforkFTPServer(("127.0.0.1", 0), PidFTPHandler, ioloop=IOLoop())
+        for worker_id in range(2):
+            pid = os.fork()
+            if pid == 0:
+                while True:
+                    time.sleep(1)
+            server.children[pid] = (worker_id, time.time())
+        pids = server.children.keys()
+        server.close_all()
+        self.assertEqual(server.children, {})
+        for pid in pids:
+            self.assertRaises(OSError, os.waitpid, pid, os.WNOHANG)
+
 if __name__ == '__main__':
     unittest.main()